@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmark of the pySCENIC pipeline on synthetic data, starting from the adjacencies (i.e. without network
+inference): modules_from_adjacencies, prune2df, df2regulons and aucell. For each execution mode the wall time, the CPU
+utilisation and the peak resident memory of every stage are recorded. The stages of the first mode include the
+compilation of the numba kernels.
+
+These benchmarks can be run via airspeed velocity or directly as a script:
+
+    python -m benchmarks.bench_pipeline --n_cells 2000 --n_genes 10000 --n_tfs 50 --n_features 2000 --output stats.json
+"""
+
+import os
+import json
+import shutil
+import argparse
+import tempfile
+from multiprocessing import cpu_count
+
+from pyscenic.utils import modules_from_adjacencies
+from pyscenic.prune import prune2df
+from pyscenic.transform import df2regulons
+from pyscenic.aucell import aucell
+from pyscenic.rnkdb import FeatherRankingDatabase
+from pyscenic.profiling import Profiler
+
+from . import synthetic
+
+
+MODES = ['custom_multiprocessing', 'dask_multiprocessing', 'local_cluster']
+STAGES = ['modules', 'prune2df', 'df2regulons', 'aucell']
+
+
+class PipelineData:
+    """
+    The synthetic inputs of the pipeline written to a folder.
+    """
+    def __init__(self, folder: str, n_cells: int, n_genes: int, n_tfs: int, n_features: int):
+        self.ex_mtx, self.adjacencies = synthetic.expression_and_adjacencies(n_cells, n_genes, n_tfs)
+        tfs = self.adjacencies[synthetic.COLUMN_NAME_TF].unique()
+        self.db = FeatherRankingDatabase(synthetic.feather_database(folder, n_features, n_genes), name="synthetic")
+        self.motif_annotations_fname = synthetic.motif_annotations(os.path.join(folder, "motifs.tsv"),
+                                                                   n_features, len(tfs), tfs)
+
+
+def _client_or_address(mode: str, num_workers: int):
+    if mode == 'local_cluster':
+        from distributed import Client, LocalCluster
+        return Client(LocalCluster(n_workers=num_workers, threads_per_worker=1))
+    return mode
+
+
+def run_pipeline(data: PipelineData, mode: str, num_workers: int = cpu_count(), module_chunksize: int = 10) -> dict:
+    """
+    Run the pipeline on synthetic data in a given mode.
+
+    :return: The statistics of each stage (with the peak resident memory in MB).
+    """
+    profiler = Profiler(interval=0.05)
+    client_or_address = _client_or_address(mode, num_workers)
+    try:
+        with profiler.stage('modules'):
+            modules = list(modules_from_adjacencies(data.adjacencies, data.ex_mtx))
+        with profiler.stage('prune2df'):
+            df = prune2df([data.db], modules, data.motif_annotations_fname, client_or_address=client_or_address,
+                          num_workers=num_workers, module_chunksize=module_chunksize)
+        with profiler.stage('df2regulons'):
+            regulons = df2regulons(df)
+        with profiler.stage('aucell'):
+            aucell(data.ex_mtx, regulons, num_workers=num_workers)
+    finally:
+        if mode == 'local_cluster':
+            client_or_address.close()
+    return {stats['stage']: dict(stats, peak_rss=stats['peak_rss'] / float(1 << 20)) for stats in profiler.stages}
+
+
+class Pipeline:
+    params = (MODES, STAGES)
+    param_names = ['mode', 'stage']
+    timeout = 1800
+
+    n_cells, n_genes, n_tfs, n_features = 1000, 5000, 20, 1000
+
+    def setup_cache(self):
+        folder = tempfile.mkdtemp()
+        try:
+            data = PipelineData(folder, self.n_cells, self.n_genes, self.n_tfs, self.n_features)
+            return {mode: run_pipeline(data, mode) for mode in MODES}
+        finally:
+            shutil.rmtree(folder)
+
+    def track_wall_time(self, stats, mode, stage):
+        return stats[mode][stage]['wall_time']
+    track_wall_time.unit = 'seconds'
+
+    def track_cpu_utilisation(self, stats, mode, stage):
+        return stats[mode][stage]['cpu_utilisation']
+    track_cpu_utilisation.unit = 'fraction'
+
+    def track_peak_rss(self, stats, mode, stage):
+        return stats[mode][stage]['peak_rss']
+    track_peak_rss.unit = 'MB'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the pipeline on synthetic data in each execution mode.')
+    parser.add_argument('--n_cells', type=int, default=Pipeline.n_cells)
+    parser.add_argument('--n_genes', type=int, default=Pipeline.n_genes)
+    parser.add_argument('--n_tfs', type=int, default=Pipeline.n_tfs)
+    parser.add_argument('--n_features', type=int, default=Pipeline.n_features)
+    parser.add_argument('--num_workers', type=int, default=cpu_count())
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--output', type=str, default=None, help='Write the statistics to a JSON file.')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        data = PipelineData(folder, args.n_cells, args.n_genes, args.n_tfs, args.n_features)
+        stats = dict()
+        print("{:<25s}{:<14s}{:>12s}{:>12s}{:>14s}".format('mode', 'stage', 'wall (s)', 'CPU (%)', 'peak RSS (MB)'))
+        for mode in args.modes:
+            stats[mode] = run_pipeline(data, mode, args.num_workers)
+            for stage in STAGES:
+                s = stats[mode][stage]
+                print("{:<25s}{:<14s}{:>12.2f}{:>12.1f}{:>14.1f}".format(
+                    mode, stage, s['wall_time'], 100.0 * s['cpu_utilisation'], s['peak_rss']))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(stats, f, indent=1)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
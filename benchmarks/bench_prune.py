@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the different modes of prune2df on synthetic data.
+
+These benchmarks can be run via airspeed velocity or directly as a script:
+
+    python -m benchmarks.bench_prune --n_features 2000 --n_genes 10000 --n_modules 64
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import argparse
+from multiprocessing import cpu_count
+
+from pyscenic.prune import prune2df
+from pyscenic.rnkdb import FeatherRankingDatabase
+
+from . import synthetic
+
+
+MODES = ['custom_multiprocessing', 'dask_multiprocessing', 'threaded']
+
+
+class PruneModes:
+    params = MODES
+    param_names = ['mode']
+    timeout = 600
+
+    n_features, n_genes, n_modules = 1000, 5000, 32
+
+    def setup(self, mode):
+        self.folder = tempfile.mkdtemp()
+        self.db = FeatherRankingDatabase(synthetic.feather_database(self.folder, self.n_features, self.n_genes),
+                                         name="synthetic")
+        self.modules = synthetic.modules(self.n_genes, self.n_modules)
+        self.motif_annotations_fname = synthetic.motif_annotations(os.path.join(self.folder, "motifs.tsv"),
+                                                                   self.n_features, self.n_modules)
+
+    def teardown(self, mode):
+        shutil.rmtree(self.folder)
+
+    def time_prune2df(self, mode):
+        prune2df([self.db], self.modules, self.motif_annotations_fname, client_or_address=mode,
+                 module_chunksize=max(1, self.n_modules // (2 * cpu_count())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the modes of prune2df on synthetic data.')
+    parser.add_argument('--n_features', type=int, default=PruneModes.n_features)
+    parser.add_argument('--n_genes', type=int, default=PruneModes.n_genes)
+    parser.add_argument('--n_modules', type=int, default=PruneModes.n_modules)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    args = parser.parse_args()
+
+    PruneModes.n_features, PruneModes.n_genes, PruneModes.n_modules = args.n_features, args.n_genes, args.n_modules
+    benchmark = PruneModes()
+    for mode in args.modes:
+        benchmark.setup(mode)
+        try:
+            start = time.perf_counter()
+            benchmark.time_prune2df(mode)
+            print("{:<25s}{:>10.2f}s".format(mode, time.perf_counter() - start))
+        finally:
+            benchmark.teardown(mode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the recovery and AUC kernels on synthetic rankings.
+
+These benchmarks can be run via airspeed velocity or directly as a script, which reports the throughput (features or
+cells per second) and the peak memory allocated by each kernel:
+
+    python -m benchmarks.bench_recovery --n_features 1000 10000 --rank_thresholds 1500 5000
+"""
+
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import pandas as pd
+from itertools import product
+
+from pyscenic.recovery import rcc2d, recovery, aucs, auc2d, weighted_auc1d, leading_edge, leading_edge2d, \
+    enrichment4cells, derive_rank_cutoff
+from pyscenic.genesig import GeneSignature
+
+
+N_FEATURES = [1000, 10000]
+RANK_THRESHOLDS = [1500, 5000]
+DTYPES = ['int16', 'int32', 'uint32']
+WEIGHTED = [False, True]
+
+TOTAL_GENES = 20000
+SIGNATURE_SIZE = 200
+AUC_THRESHOLD = 0.05
+# The kernels that process a single feature at a time are only benchmarked on a limited number of features.
+N_SINGLE_FEATURES = 100
+
+
+class Inputs:
+    """
+    The inputs of the kernels: the rankings of the genes of a signature for a number of features (or cells).
+    """
+    def __init__(self, n_features: int, rank_threshold: int, dtype: str, weighted: bool, seed: int = 42):
+        rs = np.random.RandomState(seed=seed)
+        self.n_features, self.rank_threshold = n_features, rank_threshold
+        self.n_single = min(n_features, N_SINGLE_FEATURES)
+        # The rank numbers of the genes of a signature are distinct for each feature. Sampling these from a permutation
+        # of the whole genome for each feature is slow, so a random offset is added to a single sample instead.
+        sample = rs.choice(TOTAL_GENES, SIGNATURE_SIZE, replace=False)
+        offsets = rs.randint(TOTAL_GENES, size=(n_features, 1))
+        self.rankings = ((sample[np.newaxis, :] + offsets) % TOTAL_GENES).astype(dtype)
+        self.genes = np.array(["G{}".format(idx) for idx in range(SIGNATURE_SIZE)])
+        self.weights = rs.uniform(size=SIGNATURE_SIZE) if weighted else np.ones(SIGNATURE_SIZE)
+        self.df = pd.DataFrame(data=self.rankings, columns=self.genes,
+                               index=["F{}".format(idx) for idx in range(n_features)])
+        self.rank_cutoff = derive_rank_cutoff(AUC_THRESHOLD, TOTAL_GENES)
+        self.max_auc = float((self.rank_cutoff + 1) * self.weights.sum())
+        self.rccs, _ = recovery(self.df, TOTAL_GENES, self.weights, rank_threshold, AUC_THRESHOLD, no_auc=True)
+        self.avg2stdrcc = self.rccs.mean(axis=0) + 2.0 * self.rccs.std(axis=0)
+        # The genes of the signature are the first genes of the expression rankings of cells (cf. cell_rankings).
+        self.signature = GeneSignature(name="signature", gene2weight=list(zip(self.genes.tolist(), self.weights)))
+
+
+def cell_rankings(n_cells: int, dtype: str, seed: int = 42) -> pd.DataFrame:
+    rs = np.random.RandomState(seed=seed)
+    sample = np.arange(TOTAL_GENES)
+    offsets = rs.randint(TOTAL_GENES, size=(n_cells, 1))
+    return pd.DataFrame(data=((sample[np.newaxis, :] + offsets) % TOTAL_GENES).astype(dtype),
+                        columns=["G{}".format(idx) for idx in range(TOTAL_GENES)])
+
+
+# The kernels with the number of features (or cells) they process.
+KERNELS = {
+    'rcc2d': lambda x: (rcc2d(x.rankings, x.weights, x.rank_threshold), x.n_features),
+    'recovery': lambda x: (recovery(x.df, TOTAL_GENES, x.weights, x.rank_threshold, AUC_THRESHOLD), x.n_features),
+    'aucs': lambda x: (aucs(x.df, TOTAL_GENES, x.weights, AUC_THRESHOLD), x.n_features),
+    'auc2d': lambda x: (auc2d(x.rankings, x.weights, x.rank_cutoff, x.max_auc), x.n_features),
+    'weighted_auc1d': lambda x: ([weighted_auc1d(x.rankings[idx, :], x.weights, x.rank_cutoff, x.max_auc)
+                                  for idx in range(x.n_single)], x.n_single),
+    'leading_edge': lambda x: ([leading_edge(x.rccs[idx, :], x.avg2stdrcc, x.rankings[idx, :], x.genes, x.weights)
+                                for idx in range(x.n_single)], x.n_single),
+    'leading_edge2d': lambda x: (leading_edge2d(x.rccs, x.avg2stdrcc, x.rankings), x.n_features),
+}
+
+
+class Recovery:
+    params = (N_FEATURES, RANK_THRESHOLDS, DTYPES, WEIGHTED)
+    param_names = ['n_features', 'rank_threshold', 'dtype', 'weighted']
+    timeout = 300
+
+    def setup(self, n_features, rank_threshold, dtype, weighted):
+        self.inputs = Inputs(n_features, rank_threshold, dtype, weighted)
+        # Compile the numba kernels for this dtype outside of the timed section.
+        for func in KERNELS.values():
+            func(Inputs(10, rank_threshold, dtype, weighted))
+
+    def time_rcc2d(self, *args):
+        KERNELS['rcc2d'](self.inputs)
+
+    def time_recovery(self, *args):
+        KERNELS['recovery'](self.inputs)
+
+    def time_leading_edge(self, *args):
+        KERNELS['leading_edge'](self.inputs)
+
+    def time_leading_edge2d(self, *args):
+        KERNELS['leading_edge2d'](self.inputs)
+
+    def peakmem_recovery(self, *args):
+        KERNELS['recovery'](self.inputs)
+
+
+class AUC:
+    params = (N_FEATURES, DTYPES, WEIGHTED)
+    param_names = ['n_features', 'dtype', 'weighted']
+    timeout = 300
+
+    def setup(self, n_features, dtype, weighted):
+        self.inputs = Inputs(n_features, RANK_THRESHOLDS[0], dtype, weighted)
+        for name in ('aucs', 'auc2d', 'weighted_auc1d'):
+            KERNELS[name](Inputs(N_SINGLE_FEATURES, RANK_THRESHOLDS[0], dtype, weighted))
+
+    def time_aucs(self, *args):
+        KERNELS['aucs'](self.inputs)
+
+    def time_auc2d(self, *args):
+        KERNELS['auc2d'](self.inputs)
+
+    def time_weighted_auc1d(self, *args):
+        KERNELS['weighted_auc1d'](self.inputs)
+
+    def peakmem_aucs(self, *args):
+        KERNELS['aucs'](self.inputs)
+
+
+class EnrichmentForCells:
+    params = ([1000, 10000], DTYPES)
+    param_names = ['n_cells', 'dtype']
+    timeout = 300
+
+    def setup(self, n_cells, dtype):
+        self.rankings = cell_rankings(n_cells, dtype)
+        self.signature = Inputs(10, RANK_THRESHOLDS[0], dtype, False).signature
+        enrichment4cells(self.rankings.head(SIGNATURE_SIZE), self.signature, AUC_THRESHOLD)
+
+    def time_enrichment4cells(self, *args):
+        enrichment4cells(self.rankings, self.signature, AUC_THRESHOLD)
+
+    def peakmem_enrichment4cells(self, *args):
+        enrichment4cells(self.rankings, self.signature, AUC_THRESHOLD)
+
+
+def _measure(func):
+    """
+    Measure the wall time and the peak memory allocated by a function.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / float(1 << 20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the throughput of the recovery and AUC kernels.')
+    parser.add_argument('--n_features', nargs='+', type=int, default=N_FEATURES)
+    parser.add_argument('--rank_thresholds', nargs='+', type=int, default=RANK_THRESHOLDS)
+    parser.add_argument('--dtypes', nargs='+', choices=DTYPES, default=DTYPES)
+    parser.add_argument('--kernels', nargs='+', choices=list(KERNELS.keys()) + ['enrichment4cells'],
+                        default=list(KERNELS.keys()) + ['enrichment4cells'])
+    args = parser.parse_args()
+
+    print("{:<18s}{:>10s}{:>8s}{:>8s}{:>10s}{:>16s}{:>12s}".format(
+        'kernel', 'features', 'rank', 'dtype', 'weighted', 'features/s', 'peak (MB)'))
+    for n_features, rank_threshold, dtype, weighted in product(args.n_features, args.rank_thresholds, args.dtypes,
+                                                               WEIGHTED):
+        inputs = Inputs(n_features, rank_threshold, dtype, weighted)
+        warm_up = Inputs(10, rank_threshold, dtype, weighted)
+        for name in args.kernels:
+            if name == 'enrichment4cells':
+                # The rankings of cells do not depend on the rank threshold or the weights.
+                if rank_threshold != args.rank_thresholds[0] or weighted:
+                    continue
+                rankings = cell_rankings(n_features, dtype)
+                enrichment4cells(rankings.head(SIGNATURE_SIZE), inputs.signature, AUC_THRESHOLD)
+                _, elapsed, peak = _measure(lambda: enrichment4cells(rankings, inputs.signature, AUC_THRESHOLD))
+                n_processed = n_features
+            else:
+                KERNELS[name](warm_up)
+                (_, n_processed), elapsed, peak = _measure(lambda: KERNELS[name](inputs))
+            print("{:<18s}{:>10d}{:>8d}{:>8s}{:>10s}{:>16.0f}{:>12.1f}".format(
+                name, n_features, rank_threshold, dtype, str(weighted), n_processed / elapsed, peak))
+
+
+if __name__ == "__main__":
+    main()
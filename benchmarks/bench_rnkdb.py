@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the ranking database backends on synthetic databases.
+
+These benchmarks can be run via airspeed velocity or directly as a script:
+
+    python -m benchmarks.bench_rnkdb --shapes 1000x5000 5000x20000 --size_range 20 500
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+from pyscenic.rnkdb import SQLiteRankingDatabase, FeatherRankingDatabase, InvertedRankingDatabase, MemoryDecorator, \
+    DataFrameRankingDatabase
+
+from . import synthetic
+
+
+BACKENDS = ['sqlite', 'feather', 'memory', 'dataframe', 'inverted']
+SHAPES = ['1000x5000', '5000x20000']
+SIZE_RANGES = {'small': (20, 100), 'large': (200, 1000)}
+N_SIGNATURES = 10
+
+# The rankings of the dataframe backend are generated once per process so that opening this backend only measures
+# wrapping the dataframe.
+_RANKINGS = dict()
+
+
+def parse_shape(shape: str):
+    n_features, n_genes = map(int, shape.split('x'))
+    return n_features, n_genes
+
+
+def create_databases(folder: str, shapes=SHAPES) -> None:
+    """
+    Write the synthetic databases for all file based backends and generate the rankings for the dataframe backend.
+    """
+    for shape in shapes:
+        n_features, n_genes = parse_shape(shape)
+        name = "synthetic{}".format(shape)
+        _RANKINGS[shape] = synthetic.rankings(n_features, n_genes)
+        synthetic.sqlite_database(folder, n_features, n_genes, name)
+        synthetic.feather_database(folder, n_features, n_genes, name)
+        synthetic.inverted_database(folder, n_features, n_genes, name)
+
+
+def open_database(folder: str, backend: str, shape: str):
+    n_features, n_genes = parse_shape(shape)
+    name = "synthetic{}".format(shape)
+    if backend == 'sqlite':
+        return SQLiteRankingDatabase(os.path.join(folder, "{}.db".format(name)), name)
+    elif backend == 'feather':
+        return FeatherRankingDatabase(os.path.join(folder, "{}.feather".format(name)), name)
+    elif backend == 'memory':
+        return MemoryDecorator(FeatherRankingDatabase(os.path.join(folder, "{}.feather".format(name)), name))
+    elif backend == 'dataframe':
+        if shape not in _RANKINGS:
+            _RANKINGS[shape] = synthetic.rankings(n_features, n_genes)
+        return DataFrameRankingDatabase(_RANKINGS[shape], name)
+    elif backend == 'inverted':
+        return InvertedRankingDatabase(os.path.join(folder, "{}.inverted.feather".format(name)), name)
+    raise ValueError("Unknown backend \"{}\".".format(backend))
+
+
+class RankingDatabaseBackends:
+    params = (BACKENDS, SHAPES, list(SIZE_RANGES.keys()))
+    param_names = ['backend', 'shape', 'signature_sizes']
+    timeout = 600
+
+    def setup_cache(self):
+        # The databases are created once and shared by all benchmarks. asv removes the cache afterwards.
+        folder = os.path.abspath("rnkdb")
+        os.makedirs(folder, exist_ok=True)
+        create_databases(folder)
+        return folder
+
+    def setup(self, folder, backend, shape, signature_sizes):
+        self.db = open_database(folder, backend, shape)
+        self.signatures = synthetic.signatures(parse_shape(shape)[1], N_SIGNATURES, SIZE_RANGES[signature_sizes])
+
+    def time_open(self, folder, backend, shape, signature_sizes):
+        open_database(folder, backend, shape)
+
+    def time_genes(self, folder, backend, shape, signature_sizes):
+        # The genes are memoized on the instance, so a fresh instance is used.
+        open_database(folder, backend, shape).genes
+
+    def time_load(self, folder, backend, shape, signature_sizes):
+        for gs in self.signatures:
+            self.db.load(gs)
+
+    def peakmem_load(self, folder, backend, shape, signature_sizes):
+        for gs in self.signatures:
+            self.db.load(gs)
+
+    def peakmem_open(self, folder, backend, shape, signature_sizes):
+        open_database(folder, backend, shape)
+
+
+class LoadFull:
+    # Loading the full database is not possible for inverted databases.
+    params = ([backend for backend in BACKENDS if backend != 'inverted'], SHAPES)
+    param_names = ['backend', 'shape']
+    timeout = 600
+
+    setup_cache = RankingDatabaseBackends.setup_cache
+
+    def setup(self, folder, backend, shape):
+        self.db = open_database(folder, backend, shape)
+
+    def time_load_full(self, folder, backend, shape):
+        self.db.load_full()
+
+    def peakmem_load_full(self, folder, backend, shape):
+        self.db.load_full()
+
+
+def _measure(func):
+    """
+    Measure the wall time and the peak memory allocated by a function.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / float(1 << 20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the ranking database backends on synthetic databases.')
+    parser.add_argument('--shapes', nargs='+', default=SHAPES, metavar='FEATURESxGENES')
+    parser.add_argument('--size_range', nargs=2, type=int, default=SIZE_RANGES['small'], metavar=('MIN', 'MAX'))
+    parser.add_argument('--n_signatures', type=int, default=N_SIGNATURES)
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        create_databases(folder, args.shapes)
+        print("{:<12s}{:<14s}{:>10s}{:>10s}{:>10s}{:>12s}{:>12s}{:>12s}".format(
+            'backend', 'shape', 'open', 'genes', 'load', 'load_full', 'load (MB)', 'full (MB)'))
+        for shape in args.shapes:
+            signatures = synthetic.signatures(parse_shape(shape)[1], args.n_signatures, tuple(args.size_range))
+            for backend in args.backends:
+                db, t_open, _ = _measure(lambda: open_database(folder, backend, shape))
+                _, t_genes, _ = _measure(lambda: db.genes)
+                _, t_load, m_load = _measure(lambda: [db.load(gs) for gs in signatures])
+                if backend != 'inverted':
+                    _, t_full, m_full = _measure(db.load_full)
+                else:
+                    t_full, m_full = float('nan'), float('nan')
+                print("{:<12s}{:<14s}{:>9.3f}s{:>9.3f}s{:>9.3f}s{:>11.3f}s{:>12.1f}{:>12.1f}".format(
+                    backend, shape, t_open, t_genes, t_load, t_full, m_load, m_full))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the startup time of the command line interface and of worker processes, i.e. importing the modules and
+loading (or compiling) the numba kernels. Each command is run in a fresh interpreter and the best wall time of a number
+of repeats is reported. The first repeat of the kernels benchmark populates the on-disk cache of the numba kernels.
+
+These benchmarks can be run via airspeed velocity or directly as a script, which compares the wall times with the
+startup budget:
+
+    python -m benchmarks.bench_startup --repeats 5
+"""
+
+import sys
+import time
+import argparse
+import subprocess
+
+
+# Calculating the recovery curves and AUCs for a tiny database, as done by a worker process for its first module.
+KERNELS_CODE = """
+import numpy as np
+from pyscenic.recovery import rcc2d, auc2d
+rankings = np.arange(100, dtype=np.int16).reshape(10, 10)
+rcc2d(rankings, np.ones(10), 50)
+auc2d(rankings, np.ones(10), 5, 1.0)
+"""
+
+# The arguments of the interpreter for each command.
+COMMANDS = {
+    'help': ['-m', 'pyscenic.cli.pyscenic', '--help'],
+    'grn_help': ['-m', 'pyscenic.cli.pyscenic', 'grn', '--help'],
+    'ctx_help': ['-m', 'pyscenic.cli.pyscenic', 'ctx', '--help'],
+    'aucell_help': ['-m', 'pyscenic.cli.pyscenic', 'aucell', '--help'],
+    'import_pyscenic': ['-c', 'import pyscenic'],
+    'import_aucell': ['-c', 'import pyscenic.aucell'],
+    'import_prune': ['-c', 'import pyscenic.prune'],
+    'kernels': ['-c', KERNELS_CODE],
+}
+
+# The startup budget in seconds for each command.
+BUDGET = {
+    'help': 1.0,
+    'grn_help': 1.0,
+    'ctx_help': 1.0,
+    'aucell_help': 1.0,
+    'import_pyscenic': 0.1,
+    'import_aucell': 1.5,
+    'import_prune': 2.5,
+    'kernels': 2.0,
+}
+
+
+def startup_time(command: str, repeats: int = 3) -> float:
+    """
+    The best wall time in seconds of running a command in a fresh interpreter.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + COMMANDS[command], stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+class Startup:
+    params = list(COMMANDS.keys())
+    param_names = ['command']
+    timeout = 300
+
+    def setup(self, command):
+        # Populate the on-disk caches (bytecode and numba kernels).
+        startup_time(command, repeats=1)
+
+    def track_startup_time(self, command):
+        return startup_time(command)
+    track_startup_time.unit = 'seconds'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time of the command line interface.')
+    parser.add_argument('--commands', nargs='+', choices=list(COMMANDS.keys()), default=list(COMMANDS.keys()))
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    print("{:<18s}{:>12s}{:>12s}{:>12s}{:>8s}".format('command', 'first (s)', 'best (s)', 'budget (s)', ''))
+    for command in args.commands:
+        first = startup_time(command, repeats=1)
+        best = startup_time(command, repeats=args.repeats)
+        print("{:<18s}{:>12.3f}{:>12.3f}{:>12.3f}{:>8s}".format(
+            command, first, best, BUDGET[command], 'ok' if best <= BUDGET[command] else 'OVER'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic data for benchmarks, i.e. benchmarks can be run without downloading databases.
+"""
+
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+from typing import Sequence, Tuple, List, Optional
+
+from pyscenic.rnkdb import DataFrameRankingDatabase, InvertedRankingDatabase
+from pyscenic.genesig import Regulon, GeneSignature
+from pyscenic.utils import COLUMN_NAME_TF, COLUMN_NAME_TARGET, COLUMN_NAME_WEIGHT
+
+
+def genes(n_genes: int) -> np.ndarray:
+    return np.array(["G{}".format(idx) for idx in range(n_genes)])
+
+
+def features(n_features: int) -> np.ndarray:
+    return np.array(["M{}".format(idx) for idx in range(n_features)])
+
+
+def rankings(n_features: int, n_genes: int, dtype=np.int16, seed: int = 42) -> pd.DataFrame:
+    """
+    Random whole genome rankings in which the first 100 genes are ranked at the top for the first 10% of the features.
+    """
+    rs = np.random.RandomState(seed=seed)
+    values = np.array([rs.permutation(n_genes) for _ in range(n_features)], dtype=dtype)
+    for idx in range(n_features // 10):
+        values[idx, :] = np.concatenate([rs.permutation(100), 100 + rs.permutation(n_genes - 100)])
+    return pd.DataFrame(data=values, index=features(n_features), columns=genes(n_genes))
+
+
+def database(n_features: int, n_genes: int, name: str = "synthetic", dtype=np.int16) -> DataFrameRankingDatabase:
+    return DataFrameRankingDatabase(rankings(n_features, n_genes, dtype), name=name)
+
+
+def modules(n_genes: int, n_modules: int, sizes: Sequence[int] = (50, 100, 200, 400), seed: int = 7):
+    """
+    Modules for a number of TFs with the given sizes. The genes of a module are a random mix of the top ranked genes
+    and the remainder of the genome.
+    """
+    rs = np.random.RandomState(seed=seed)
+    names = genes(n_genes)
+    result = []
+    for idx in range(n_modules):
+        tf = "TF{}".format(idx // len(sizes))
+        size = sizes[idx % len(sizes)]
+        gene_idx = np.concatenate([rs.choice(100, 25, replace=False), 100 + rs.choice(n_genes - 100, size - 25,
+                                                                                       replace=False)])
+        result.append(Regulon(name="Regulon for {}".format(tf), context=frozenset(["top{}".format(size)]),
+                              transcription_factor=tf,
+                              gene2weight=list(zip(names[gene_idx].tolist(), rs.uniform(size=size)))))
+    return result
+
+
+def signatures(n_genes: int, n_signatures: int, size_range: Tuple[int, int] = (20, 500),
+               seed: int = 11) -> List[GeneSignature]:
+    """
+    Gene signatures of random genes with log-uniformly distributed sizes, i.e. small signatures are more frequent.
+    """
+    rs = np.random.RandomState(seed=seed)
+    names = genes(n_genes)
+    sizes = np.exp(rs.uniform(np.log(size_range[0]), np.log(size_range[1]), size=n_signatures)).astype(np.int64)
+    return [GeneSignature(name="S{}".format(idx), gene2weight=names[rs.choice(n_genes, size, replace=False)].tolist())
+            for idx, size in enumerate(sizes)]
+
+
+def motif_annotations(fname: str, n_features: int, n_tfs: int, tfs: Optional[Sequence[str]] = None) -> str:
+    """
+    Write a motif2TF snapshot in which every feature is annotated for every TF.
+    """
+    motif_ids = features(n_features)
+    tfs = list(tfs) if tfs is not None else ["TF{}".format(idx) for idx in range(n_tfs)]
+    pd.DataFrame(data={'#motif_id': np.repeat(motif_ids, len(tfs)), 'gene_name': np.tile(tfs, len(motif_ids)),
+                       'motif_similarity_qvalue': 0.0, 'orthologous_identity': 1.0,
+                       'description': 'gene is directly annotated'}).to_csv(fname, sep='\t', index=False)
+    return fname
+
+
+def feather_database(folder: str, n_features: int, n_genes: int, name: str = "synthetic", dtype=np.int16) -> str:
+    """
+    Write a synthetic database in the feather format.
+    """
+    fname = os.path.join(folder, "{}.feather".format(name))
+    if not os.path.exists(fname):
+        database(n_features, n_genes, name, dtype).save(fname)
+    return fname
+
+
+def sqlite_database(folder: str, n_features: int, n_genes: int, name: str = "synthetic") -> str:
+    """
+    Write a synthetic database in the legacy SQLite format, i.e. the rankings of all features stored per gene.
+    """
+    fname = os.path.join(folder, "{}.db".format(name))
+    if not os.path.exists(fname):
+        df = rankings(n_features, n_genes, np.int16 if n_genes <= 2**15 else np.int32)
+        with sqlite3.connect(fname) as db:
+            db.execute("CREATE TABLE motifs (idx INTEGER PRIMARY KEY, motifName TEXT);")
+            db.execute("CREATE TABLE rankings (geneID TEXT PRIMARY KEY, ranking BLOB);")
+            db.executemany("INSERT INTO motifs VALUES (?, ?);", enumerate(df.index))
+            db.executemany("INSERT INTO rankings VALUES (?, ?);",
+                           ((gene, np.ascontiguousarray(df[gene].values).tobytes()) for gene in df.columns))
+    return fname
+
+
+def inverted_database(folder: str, n_features: int, n_genes: int, name: str = "synthetic",
+                      top_n_identifiers: int = 1000) -> str:
+    """
+    Write a synthetic inverted database, i.e. only the identifiers of the top ranked genes for each feature.
+    """
+    fname = os.path.join(folder, "{}.inverted.feather".format(name))
+    if not os.path.exists(fname):
+        InvertedRankingDatabase.invert(database(n_features, n_genes, name), fname, min(top_n_identifiers, n_genes))
+    return fname
+
+
+def expression_and_adjacencies(n_cells: int, n_genes: int, n_tfs: int, n_targets: int = 100,
+                               seed: int = 13) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    A synthetic single cell experiment in which the last genes are TFs. The expression of the targets of a TF follows
+    the activity of that TF. Most of these targets are among the top 100 genes of the synthetic rankings, i.e. the
+    modules derived from the adjacencies are enriched for the first features of a synthetic database.
+
+    :return: A tuple with the expression matrix (n_cells x n_genes) and the adjacencies (as inferred by GRNBoost2).
+    """
+    assert n_genes >= 100 + n_tfs + n_targets
+    rs = np.random.RandomState(seed=seed)
+    names = genes(n_genes)
+    tf_idx = np.arange(n_genes - n_tfs, n_genes)
+    activity = rs.gamma(shape=2.0, size=(n_cells, n_tfs))
+    lam = np.full((n_cells, n_genes), 0.5)
+    lam[:, tf_idx] += activity
+    adjacencies = []
+    for idx, tf in enumerate(names[tf_idx].tolist()):
+        n_top = (3 * n_targets) // 5
+        targets = np.concatenate([rs.choice(100, n_top, replace=False),
+                                  100 + rs.choice(n_genes - 100 - n_tfs, n_targets - n_top, replace=False)])
+        lam[:, targets] += activity[:, [idx]]
+        others = np.setdiff1d(rs.choice(n_genes - n_tfs, n_targets, replace=False), targets)
+        adjacencies.append(pd.DataFrame(data={COLUMN_NAME_TF: tf,
+                                              COLUMN_NAME_TARGET: names[np.concatenate([targets, others])].tolist(),
+                                              COLUMN_NAME_WEIGHT: np.concatenate([rs.uniform(5.0, 10.0, len(targets)),
+                                                                                  rs.uniform(0.0, 5.0, len(others))])}))
+    ex_mtx = pd.DataFrame(data=rs.poisson(lam).astype(np.float64), columns=names,
+                          index=["C{}".format(idx) for idx in range(n_cells)])
+    return ex_mtx, pd.concat(adjacencies, ignore_index=True)
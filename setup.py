@@ -83,6 +83,7 @@ setuptools.setup(
                             'db2feather = pyscenic.cli.db2feather:main',
                             'csv2loom = pyscenic.cli.csv2loom:main',
                             'invertdb = pyscenic.cli.invertdb:main',
-                            'gmt2regions = pyscenic.cli.gmt2regions:main'],
+                            'gmt2regions = pyscenic.cli.gmt2regions:main',
+                            'indexdb = pyscenic.cli.indexdb:main'],
     }
 )
\ No newline at end of file
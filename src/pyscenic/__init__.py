@@ -1,4 +1,18 @@
 
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+import sys
+
+
+def __getattr__(name):
+    # The version is only derived when it is requested (PEP 562). In a source checkout versioneer runs git to derive the
+    # version, which would otherwise happen in every process that imports pyscenic (e.g. the workers).
+    if name == '__version__':
+        from ._version import get_versions
+        global __version__
+        __version__ = get_versions()['version']
+        return __version__
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+# Module level attributes cannot be derived lazily before Python 3.7.
+if sys.version_info < (3, 7):
+    __version__ = __getattr__('__version__')
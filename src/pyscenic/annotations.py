@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import os
+import attr
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from typing import Sequence, Union, Optional, Iterable
+
+from .utils import load_motif_annotations, COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID
+
+
+__all__ = ['MotifAnnotations', 'annotate_features', 'filter_motif_annotations', 'load_filtered_motif_annotations']
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+@attr.s
+class MotifAnnotations:
+    """
+    Motif annotations compiled into a compact lookup structure.
+
+    Each distinct TF, motif ID and value of a text column (e.g. the description of the annotation) is stored only once;
+    the rows refer to these values via integer codes. The rows are sorted on a single integer key derived from the codes
+    of the TF and motif ID so that the annotations of a set of enriched features are found via a binary search instead
+    of a join of dataframes. This structure is also much cheaper to pickle when shipped to workers.
+    """
+    tfs = attr.ib()  # pd.Index with the distinct TFs.
+    motif_ids = attr.ib()  # pd.Index with the distinct motif IDs.
+    keys = attr.ib()  # np.ndarray (n_rows) of sorted keys: TF code * number of motif IDs + motif ID code.
+    columns = attr.ib()  # Sequence of column names.
+    values = attr.ib()  # Sequence of np.ndarrays (n_rows), for text columns the codes.
+    categories = attr.ib()  # Sequence of np.ndarrays with the distinct values of a text column or None.
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> 'MotifAnnotations':
+        """
+        Compile motif annotations.
+
+        :param df: The dataframe with motif annotations (as returned by load_motif_annotations).
+        :return: The compiled motif annotations.
+        """
+        tf_codes, tfs = pd.factorize(df.index.get_level_values(COLUMN_NAME_TF))
+        motif_codes, motif_ids = pd.factorize(df.index.get_level_values(COLUMN_NAME_MOTIF_ID))
+        keys = tf_codes.astype(np.int64) * max(1, len(motif_ids)) + motif_codes
+        order = np.argsort(keys, kind='mergesort')
+        values, categories = [], []
+        for column in df.columns:
+            if df[column].dtype == np.object:
+                codes, uniques = pd.factorize(df[column].values[order])
+                values.append(codes.astype(np.int32))
+                categories.append(np.asarray(uniques, dtype=np.object))
+            else:
+                values.append(df[column].values[order])
+                categories.append(None)
+        return MotifAnnotations(tfs=pd.Index(tfs), motif_ids=pd.Index(motif_ids), keys=keys[order],
+                                columns=list(df.columns), values=values, categories=categories)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, tfs: Sequence[str], motif_ids: Sequence[str]):
+        """
+        Find the annotations for pairs of TFs and motif IDs.
+
+        :return: A tuple with for each annotation the index of the pair it belongs to and its row. Pairs without
+            annotation get a single entry with row -1. This mimics the result of a left join.
+        """
+        tf_codes = self.tfs.get_indexer(tfs)
+        motif_codes = self.motif_ids.get_indexer(motif_ids)
+        queries = tf_codes.astype(np.int64) * max(1, len(self.motif_ids)) + motif_codes
+        starts = np.searchsorted(self.keys, queries, side='left')
+        counts = np.searchsorted(self.keys, queries, side='right') - starts
+        counts[(tf_codes < 0) | (motif_codes < 0)] = 0
+        n_entries = np.maximum(counts, 1)
+        pair_idx = np.repeat(np.arange(len(queries)), n_entries)
+        # The offset of each entry within the annotations of its pair.
+        offsets = np.arange(len(pair_idx)) - np.repeat(np.cumsum(n_entries) - n_entries, n_entries)
+        rows = np.where(np.repeat(counts, n_entries) > 0, np.repeat(starts, n_entries) + offsets, -1)
+        return pair_idx, rows
+
+    def column(self, idx: int, rows: np.ndarray) -> np.ndarray:
+        """
+        The values of a column for the supplied rows. Missing rows (-1) get NaN.
+        """
+        found = rows >= 0
+        values, categories = self.values[idx], self.categories[idx]
+        if categories is not None:
+            result = np.full(len(rows), np.nan, dtype=np.object)
+            result[found] = categories[values[rows[found]]]
+        else:
+            result = np.full(len(rows), np.nan, dtype=np.float64 if values.dtype.kind in 'iub' else values.dtype)
+            result[found] = values[rows[found]]
+        return result
+
+
+def annotate_features(enriched_features: pd.DataFrame,
+                      motif_annotations: Union[pd.DataFrame, MotifAnnotations]) -> pd.DataFrame:
+    """
+    Add the motif annotations to enriched features, i.e. a left join on TF and motif ID.
+
+    :param enriched_features: A dataframe of enriched features indexed on TF and motif ID.
+    :param motif_annotations: The motif annotations, either as dataframe or compiled.
+    :return: A dataframe with the enriched features and their annotations.
+    """
+    if isinstance(motif_annotations, pd.DataFrame):
+        return pd.merge(enriched_features, motif_annotations, how="left", left_index=True, right_index=True)
+    pair_idx, rows = motif_annotations.lookup(enriched_features.index.get_level_values(0),
+                                              enriched_features.index.get_level_values(1))
+    df = pd.DataFrame(index=enriched_features.index[pair_idx],
+                      data={column: enriched_features[column].values[pair_idx] for column in enriched_features.columns})
+    for idx, column in enumerate(motif_annotations.columns):
+        df[column] = motif_annotations.column(idx, rows)
+    return df
+
+
+# Filtered and compiled motif annotations of previous runs within the same process (e.g. an interactive session),
+# keyed by the content of the annotations file, the thresholds, the TFs and the features.
+_CACHE = OrderedDict()
+_CACHE_SIZE = 4
+
+# The digest of the content of annotations files, keyed by (absolute path, size, modification time).
+_DIGESTS = dict()
+
+
+def _digest(fname: str) -> str:
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+    if key not in _DIGESTS:
+        h = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        _DIGESTS[key] = h.hexdigest()
+    return _DIGESTS[key]
+
+
+def _digest_of_names(names: Optional[Iterable[str]]) -> Optional[str]:
+    return hashlib.sha1('\n'.join(sorted(set(names))).encode('utf-8')).hexdigest() if names is not None else None
+
+
+def filter_motif_annotations(df: pd.DataFrame, tfs: Optional[Iterable[str]] = None,
+                             features: Optional[Iterable[str]] = None) -> pd.DataFrame:
+    """
+    Only keep the motif annotations that can be used, i.e. for the supplied TFs and features.
+
+    :param df: The dataframe with motif annotations (as returned by load_motif_annotations).
+    :param tfs: The TFs of the modules or None to keep the annotations of all TFs.
+    :param features: The features of the databases or None to keep the annotations of all features.
+    :return: The filtered dataframe.
+    """
+    idx = np.full(len(df), True)
+    if tfs is not None:
+        idx &= df.index.get_level_values(COLUMN_NAME_TF).isin(list(tfs))
+    if features is not None:
+        idx &= df.index.get_level_values(COLUMN_NAME_MOTIF_ID).isin(list(features))
+    return df[idx]
+
+
+def load_filtered_motif_annotations(fname: str, tfs: Optional[Iterable[str]] = None,
+                                    features: Optional[Iterable[str]] = None,
+                                    motif_similarity_fdr: float = 0.001,
+                                    orthologous_identity_threshold: float = 0.0,
+                                    cache: bool = False) -> MotifAnnotations:
+    """
+    Load the motif annotations for the supplied TFs and features and compile them.
+
+    The result is cached so that subsequent runs in the same process with the same annotations file (based on its
+    content), thresholds, TFs and features do not need to parse the file again.
+
+    :param fname: the snapshot taken from motif2TF.
+    :param tfs: The TFs of the modules or None to keep the annotations of all TFs.
+    :param features: The features of the databases or None to keep the annotations of all features.
+    :param motif_similarity_fdr: The maximum False Discovery Rate to find factor annotations for enriched motifs.
+    :param orthologous_identity_threshold: The minimum orthologuous identity to find factor annotations
+        for enriched motifs.
+    :param cache: Use a binary cache of the annotations next to the snapshot (cf. load_motif_annotations).
+    :return: The compiled motif annotations.
+    """
+    key = (_digest(fname), motif_similarity_fdr, orthologous_identity_threshold,
+           _digest_of_names(tfs), _digest_of_names(features))
+    if key in _CACHE:
+        _CACHE.move_to_end(key)
+        return _CACHE[key]
+
+    df = load_motif_annotations(fname, motif_similarity_fdr=motif_similarity_fdr,
+                                orthologous_identity_threshold=orthologous_identity_threshold, cache=cache)
+    n_rows = len(df)
+    df = filter_motif_annotations(df, tfs, features)
+    LOGGER.info("Keeping {} of {} motif annotations.".format(len(df), n_rows))
+    motif_annotations = MotifAnnotations.from_dataframe(df)
+
+    _CACHE[key] = motif_annotations
+    if len(_CACHE) > _CACHE_SIZE:
+        _CACHE.popitem(last=False)
+    return motif_annotations
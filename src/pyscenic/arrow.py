@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from itertools import chain, repeat
+from typing import Sequence, Tuple
+
+from .utils import COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID, REPRESSING_MODULE, ACTIVATING_MODULE
+from .genesig import Regulon
+from .transform import df2regulons, COLUMN_NAME_CONTEXT, COLUMN_NAME_TARGET_GENES, COLUMN_NAME_TYPE
+
+
+__all__ = ['enriched_motifs2table', 'table2enriched_motifs', 'table2regulons']
+
+
+# Enriched motifs are stored as a flat table: one column per enrichment metric and annotation, the context as a list of
+# strings and the target genes as two aligned lists of genes and weights. A list of (gene, weight) structs would be the
+# more natural type but nested structs cannot be written to Parquet by all supported versions of pyarrow.
+COLUMN_NAME_TARGET_WEIGHTS = "TargetWeights"
+
+
+def _to_array(values: np.ndarray, is_index: bool) -> pa.Array:
+    # The type is derived from the dtype instead of the content so that all tables created from chunks of a result
+    # share the same schema, even when a column of a chunk only contains missing values. The levels of an empty index
+    # do not have a meaningful dtype.
+    return pa.array(values, type=pa.string(), from_pandas=True) if is_index or values.dtype == np.object \
+        else pa.array(values, from_pandas=True)
+
+
+def enriched_motifs2table(df: pd.DataFrame) -> pa.Table:
+    """
+    Convert a dataframe of enriched motifs to a columnar Arrow table.
+
+    :param df: The dataframe with enriched motifs (as returned by prune2df).
+    :return: The table.
+    """
+    if df.columns.nlevels == 2:
+        df = df['Enrichment']
+    df = df.reset_index()
+
+    targets = df[COLUMN_NAME_TARGET_GENES].values
+    offsets = np.zeros(len(targets) + 1, dtype=np.int32)
+    np.cumsum([len(t) for t in targets], out=offsets[1:])
+    genes, weights = zip(*chain.from_iterable(targets)) if offsets[-1] > 0 else ((), ())
+
+    columns = [column for column in df.columns if column not in {COLUMN_NAME_CONTEXT, COLUMN_NAME_TARGET_GENES}]
+    arrays = [_to_array(df[column].values, column in {COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID}) for column in columns]
+    arrays.append(pa.array([sorted(ctx) for ctx in df[COLUMN_NAME_CONTEXT]], type=pa.list_(pa.string())))
+    arrays.append(pa.ListArray.from_arrays(pa.array(offsets), pa.array(genes, type=pa.string())))
+    arrays.append(pa.ListArray.from_arrays(pa.array(offsets), pa.array(weights, type=pa.float64())))
+    return pa.Table.from_arrays(arrays,
+                                names=columns + [COLUMN_NAME_CONTEXT, COLUMN_NAME_TARGET_GENES, COLUMN_NAME_TARGET_WEIGHTS])
+
+
+def _flatten(column: pa.ChunkedArray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Flatten a list column.
+
+    :return: A tuple with the number of values in each row and all values as a single array.
+    """
+    lengths, values = [], []
+    for chunk in column.chunks:
+        # The offsets are not adjusted when a chunk is a slice of a larger array, the flattened values are.
+        lengths.append(np.diff(np.asarray(chunk.offsets)))
+        flattened = chunk.flatten()
+        values.append(np.asarray(flattened.to_pandas()) if pa.types.is_string(flattened.type)
+                      else np.asarray(flattened))
+    if not lengths:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.object)
+    return np.concatenate(lengths), np.concatenate(values)
+
+
+def _split(lengths: np.ndarray, values: np.ndarray) -> Sequence[np.ndarray]:
+    return np.split(values, np.cumsum(lengths)[:-1]) if len(lengths) else []
+
+
+def table2enriched_motifs(table: pa.Table) -> pd.DataFrame:
+    """
+    Convert a columnar Arrow table of enriched motifs to a dataframe in the format returned by prune2df.
+
+    :param table: The table.
+    :return: The dataframe with enriched motifs.
+    """
+    df = table.drop([COLUMN_NAME_CONTEXT, COLUMN_NAME_TARGET_GENES, COLUMN_NAME_TARGET_WEIGHTS]).to_pandas()
+    df[COLUMN_NAME_CONTEXT] = [frozenset(ctx) for ctx in _split(*_flatten(table.column(COLUMN_NAME_CONTEXT)))]
+    lengths, genes = _flatten(table.column(COLUMN_NAME_TARGET_GENES))
+    _, weights = _flatten(table.column(COLUMN_NAME_TARGET_WEIGHTS))
+    df[COLUMN_NAME_TARGET_GENES] = [list(zip(g, w)) for g, w in zip(_split(lengths, genes.tolist()),
+                                                                    _split(lengths, weights.tolist()))]
+    df = df.set_index([COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID])
+    df.columns = pd.MultiIndex.from_tuples(list(zip(repeat('Enrichment'), df.columns)))
+    return df
+
+
+def table2regulons(table: pa.Table) -> Sequence[Regulon]:
+    """
+    Create regulons from a columnar Arrow table of enriched motifs.
+
+    The target genes are fed directly from the flattened columns into df2regulons, i.e. without creating the list of
+    (gene, weight) tuples for each enriched motif.
+
+    :param table: The table.
+    :return: A sequence of regulons.
+    """
+    df = table.drop([COLUMN_NAME_CONTEXT, COLUMN_NAME_TARGET_GENES, COLUMN_NAME_TARGET_WEIGHTS]).to_pandas()
+    lengths, context = _flatten(table.column(COLUMN_NAME_CONTEXT))
+    rows = np.repeat(np.arange(len(df)), lengths)
+    repressing = np.zeros(len(df), dtype=np.bool_)
+    repressing[rows[context == REPRESSING_MODULE]] = True
+    df[COLUMN_NAME_TYPE] = np.where(repressing, REPRESSING_MODULE, ACTIVATING_MODULE)
+
+    lengths, genes = _flatten(table.column(COLUMN_NAME_TARGET_GENES))
+    _, weights = _flatten(table.column(COLUMN_NAME_TARGET_WEIGHTS))
+    targets = pd.DataFrame(data={'Row': np.repeat(np.arange(len(df)), lengths), 'Gene': genes, 'Weight': weights})
+    return df2regulons(df, targets=targets)
@@ -2,9 +2,10 @@
 
 import pandas as pd
 from .recovery import enrichment4cells
+from .rnkdb import derive_rank_dtype
 from tqdm import tqdm
 from typing import Sequence, Type
-from .genesig import GeneSignature
+from .genesig import GeneSignature, union_batches
 from multiprocessing import cpu_count, Process, Array
 from boltons.iterutils import chunked
 from multiprocessing.sharedctypes import RawArray
@@ -12,15 +13,13 @@ from operator import mul
 import numpy as np
 import logging
 from math import ceil
-from ctypes import c_uint32
 from operator import attrgetter
 
 
 LOGGER = logging.getLogger(__name__)
-# To reduce the memory footprint of a ranking matrix we use unsigned 32bit integers which provides a range from 0
-# through 4,294,967,295. This should be sufficient even for region-based approaches.
-DTYPE = 'uint32'
-DTYPE_C = c_uint32
+# To reduce the memory footprint of a ranking matrix the smallest datatype for the number of genes is used, i.e. the
+# same datatype as the rankings in the databases (cf. derive_rank_dtype): 16bit integers up to 32,768 genes and 32bit
+# integers otherwise, which should be sufficient even for region-based approaches.
 
 
 def create_rankings(ex_mtx: pd.DataFrame) -> pd.DataFrame:
@@ -36,7 +35,7 @@ def create_rankings(ex_mtx: pd.DataFrame) -> pd.DataFrame:
     # 2. In case of a tie the 'first' method is used, i.e. we keep the order in the original array. The remove any
     #    bias we shuffle the dataframe before ranking it. This introduces a performance penalty!
     # 3. Genes are ranked according to gene expression in descending order, i.e. from highly expressed (0) to low expression (n).
-    # 3. NAs should be given the highest rank numbers. Documentation is bad, so tested implementation via code snippet:
+    # 4. NAs should be given the highest rank numbers. Documentation is bad, so tested implementation via code snippet:
     #
     #    import pandas as pd
     #    import numpy as np
@@ -44,7 +43,10 @@ def create_rankings(ex_mtx: pd.DataFrame) -> pd.DataFrame:
     #    # Run below statement multiple times to see effect of shuffling in case of a tie.
     #    df.sample(frac=1.0, replace=False).rank(ascending=False, method='first', na_option='bottom').sort_index() - 1
     #
-    return ex_mtx.sample(frac=1.0, replace=False, axis=1).rank(axis=1, ascending=False, method='first', na_option='bottom').astype(DTYPE) - 1
+    # 5. One is subtracted before the conversion to the rank datatype, which cannot represent the rank number n itself
+    #    when n = 2^15.
+    return (ex_mtx.sample(frac=1.0, replace=False, axis=1).rank(axis=1, ascending=False, method='first', na_option='bottom') - 1)\
+        .astype(derive_rank_dtype(len(ex_mtx.columns)))
 
 
 def derive_auc_threshold(ex_mtx: pd.DataFrame) -> pd.DataFrame:
@@ -69,20 +71,38 @@ def derive_auc_threshold(ex_mtx: pd.DataFrame) -> pd.DataFrame:
 enrichment = enrichment4cells
 
 
-def _enrichment(shared_ro_memory_array, modules, genes, cells, auc_threshold, auc_mtx, offset):
+def _enrichment4batches(df_rnk: pd.DataFrame, modules: Sequence[Type[GeneSignature]], auc_threshold: float,
+                        batch_genes: int = 0):
+    """
+    Calculate the enrichment of the modules in order. When batching, the rankings of the union of the genes of a batch of
+    modules are selected once and the rankings of the individual modules are selected from this smaller block.
+    """
+    if batch_genes <= 0:
+        for module in modules:
+            yield enrichment4cells(df_rnk, module, auc_threshold)
+        return
+    total_genes = len(df_rnk.columns)
+    for union, batch in union_batches(modules, batch_genes):
+        block = df_rnk.iloc[:, df_rnk.columns.isin(union.genes)]
+        for module in batch:
+            yield enrichment4cells(block, module, auc_threshold, total_genes)
+
+
+def _enrichment(shared_ro_memory_array, modules, genes, cells, auc_threshold, auc_mtx, offset, batch_genes=0,
+                dtype=np.int32):
     # The rankings dataframe is properly reconstructed (checked this).
-    df_rnk = pd.DataFrame(data=np.frombuffer(shared_ro_memory_array, dtype=DTYPE).reshape(len(cells), len(genes)),
+    df_rnk = pd.DataFrame(data=np.frombuffer(shared_ro_memory_array, dtype=dtype).reshape(len(cells), len(genes)),
                           columns=genes, index=cells)
     # To avoid additional memory burden de resulting AUCs are immediately stored in the output sync. array.
     result_mtx = np.frombuffer(auc_mtx.get_obj(), dtype='d')
     inc = len(cells)
-    for idx, module in enumerate(modules):
-        result_mtx[offset+(idx*inc):offset+((idx+1)*inc)] = enrichment4cells(df_rnk, module, auc_threshold).values.flatten(order="C")
+    for idx, aucs in enumerate(_enrichment4batches(df_rnk, modules, auc_threshold, batch_genes)):
+        result_mtx[offset+(idx*inc):offset+((idx+1)*inc)] = aucs.values.flatten(order="C")
 
 
 def aucell4r(df_rnk: pd.DataFrame, signatures: Sequence[Type[GeneSignature]],
              auc_threshold: float = 0.05, noweights: bool = False, normalize: bool = False,
-             num_workers: int = cpu_count()) -> pd.DataFrame:
+             num_workers: int = cpu_count(), batch_genes: int = 0) -> pd.DataFrame:
     """
     Calculate enrichment of gene signatures for single cells.
 
@@ -93,13 +113,16 @@ def aucell4r(df_rnk: pd.DataFrame, signatures: Sequence[Type[GeneSignature]],
     :param noweights: Should the weights of the genes part of a signature be used in calculation of enrichment?
     :param normalize: Normalize the AUC values to a maximum of 1.0 per regulon.
     :param num_workers: The number of cores to use.
+    :param batch_genes: Select the rankings for batches of consecutive signatures at once, i.e. the union of their genes
+        with at most this number of genes. Zero disables batching.
     :return: A dataframe with the AUCs (n_cells x n_modules).
     """
     if num_workers == 1:
         # Show progress bar ...
-        aucs = pd.concat([enrichment4cells(df_rnk,
-                                     module.noweights() if noweights else module,
-                                     auc_threshold=auc_threshold) for module in tqdm(signatures)]).unstack("Regulon")
+        aucs = pd.concat(list(_enrichment4batches(df_rnk,
+                                                  [module.noweights() if noweights else module
+                                                   for module in tqdm(signatures)],
+                                                  auc_threshold, batch_genes))).unstack("Regulon")
         aucs.columns = aucs.columns.droplevel(0)
     else:
         # Decompose the rankings dataframe: the index and columns are shared with the child processes via pickling.
@@ -107,11 +130,12 @@ def aucell4r(df_rnk: pd.DataFrame, signatures: Sequence[Type[GeneSignature]],
         cells = df_rnk.index.values
         # The actual rankings are shared directly. This is possible because during a fork from a parent process the child
         # process inherits the memory of the parent process. A RawArray is used instead of a synchronize Array because
-        # these rankings are read-only.
-        shared_ro_memory_array = RawArray(DTYPE_C, mul(*df_rnk.shape))
-        array = np.frombuffer(shared_ro_memory_array, dtype=DTYPE)
+        # these rankings are read-only. The rankings are stored in the smallest datatype for the number of genes.
+        dtype = np.dtype(derive_rank_dtype(len(genes)))
+        shared_ro_memory_array = RawArray(np.ctypeslib.as_ctypes_type(dtype), mul(*df_rnk.shape))
+        array = np.frombuffer(shared_ro_memory_array, dtype=dtype).reshape(df_rnk.shape)
         # Copy the contents of df_rank into this shared memory block using row-major ordering.
-        array[:] = df_rnk.values.flatten(order='C')
+        array[:] = df_rnk.values
 
         # The resulting AUCs are returned via a synchronize array.
         auc_mtx = Array('d', len(cells) * len(signatures))  # Double precision floats.
@@ -124,7 +148,7 @@ def aucell4r(df_rnk: pd.DataFrame, signatures: Sequence[Type[GeneSignature]],
         chunk_size = ceil(float(len(signatures)) / num_workers)
         processes = [Process(target=_enrichment, args=(shared_ro_memory_array, chunk,
                                                        genes, cells, auc_threshold,
-                                                       auc_mtx, (chunk_size*len(cells))*idx))
+                                                       auc_mtx, (chunk_size*len(cells))*idx, batch_genes, dtype))
                      for idx, chunk in enumerate(chunked(signatures, chunk_size))]
         for p in processes:
             p.start()
@@ -140,7 +164,7 @@ def aucell4r(df_rnk: pd.DataFrame, signatures: Sequence[Type[GeneSignature]],
 
 def aucell(exp_mtx: pd.DataFrame, signatures: Sequence[Type[GeneSignature]],
            auc_threshold: float = 0.05, noweights: bool = False, normalize: bool = False,
-           num_workers: int = cpu_count()) -> pd.DataFrame:
+           num_workers: int = cpu_count(), batch_genes: int = 0) -> pd.DataFrame:
     """
     Calculate enrichment of gene signatures for single cells.
 
@@ -151,7 +175,9 @@ def aucell(exp_mtx: pd.DataFrame, signatures: Sequence[Type[GeneSignature]],
     :param noweights: Should the weights of the genes part of a signature be used in calculation of enrichment?
     :param normalize: Normalize the AUC values to a maximum of 1.0 per regulon.
     :param num_workers: The number of cores to use.
+    :param batch_genes: Select the rankings for batches of consecutive signatures at once, i.e. the union of their genes
+        with at most this number of genes. Zero disables batching.
     :return: A dataframe with the AUCs (n_cells x n_modules).
     """
-    return aucell4r(create_rankings(exp_mtx), signatures, auc_threshold, noweights, normalize, num_workers)
+    return aucell4r(create_rankings(exp_mtx), signatures, auc_threshold, noweights, normalize, num_workers, batch_genes)
 
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import pickle
+import hashlib
+import logging
+from typing import Type, Sequence, Mapping, Iterator, Optional
+
+from .genesig import GeneSignature
+
+
+__all__ = ['CheckpointDirectory']
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+MANIFEST_FNAME = "manifest.json"
+
+
+def _write_atomically(fname: str, write) -> None:
+    # Writing to a temporary file and renaming it makes sure a preempted process never leaves a truncated file.
+    tmp_fname = "{}.tmp".format(fname)
+    with open(tmp_fname, 'wb') as f:
+        write(f)
+    os.replace(tmp_fname, fname)
+
+
+class CheckpointDirectory:
+    """
+    A directory in which the results of completed tasks, i.e. a chunk of modules processed for a single database, are
+    persisted together with a manifest of these tasks. This allows a long running calculation to be resumed after a
+    crash or preemption by skipping the tasks that were already completed.
+
+    The manifest also records the parameters of the calculation so that results of runs with different parameters are
+    never mixed.
+    """
+
+    @staticmethod
+    def derive_key(db_name: str, modules: Sequence[Type[GeneSignature]]) -> str:
+        """
+        Derive the identifier of a task from the name of the database and the content of the chunk of modules.
+        """
+        h = hashlib.sha1()
+        for module in modules:
+            h.update(repr((module.name, sorted(module.context), module.genes)).encode('utf-8'))
+        return "{}.{}".format(db_name, h.hexdigest())
+
+    def __init__(self, path: str, parameters: Mapping[str, object], resume: bool = False):
+        """
+        Open a checkpoint directory.
+
+        :param path: The directory (created if it does not exist).
+        :param parameters: The parameters of the calculation (JSON serializable).
+        :param resume: Keep the results of completed tasks of a previous run. When False, all previous results are
+            discarded.
+        :raises: ValueError when resuming a run that was started with other parameters.
+        """
+        self.path = path
+        self.parameters = json.loads(json.dumps(parameters))
+        os.makedirs(path, exist_ok=True)
+
+        manifest_fname = os.path.join(path, MANIFEST_FNAME)
+        if resume and os.path.isfile(manifest_fname):
+            with open(manifest_fname, 'r') as f:
+                manifest = json.load(f)
+            if manifest['parameters'] != self.parameters:
+                raise ValueError("Checkpoint directory \"{}\" was created with other parameters: {}.".format(
+                    path, manifest['parameters']))
+            self.tasks = manifest['tasks']
+            LOGGER.info("Resuming from {} completed tasks.".format(len(self.tasks)))
+        else:
+            self.tasks = dict()
+            self._write_manifest()
+
+    def _write_manifest(self) -> None:
+        manifest = {'parameters': self.parameters, 'tasks': self.tasks}
+        _write_atomically(os.path.join(self.path, MANIFEST_FNAME),
+                          lambda f: f.write(json.dumps(manifest, indent=1).encode('utf-8')))
+
+    def is_completed(self, key: str) -> bool:
+        return key in self.tasks
+
+    def save(self, key: str, result: object) -> None:
+        """
+        Persist the result of a completed task and add it to the manifest.
+        """
+        fname = "{}.pickle".format(key)
+        _write_atomically(os.path.join(self.path, fname), lambda f: pickle.dump(result, f, pickle.HIGHEST_PROTOCOL))
+        self.tasks[key] = fname
+        self._write_manifest()
+
+    def load(self, key: str) -> object:
+        with open(os.path.join(self.path, self.tasks[key]), 'rb') as f:
+            return pickle.load(f)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.tasks.keys()))
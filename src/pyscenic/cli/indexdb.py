@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import os
+import argparse
+from pyscenic.rnkdb import opendb
+from pyscenic.rnkidx import AUCNullIndex, TopRankIndex
+
+
+def derive_db_name(fname:str) -> str:
+    return os.path.basename(fname).split(".")[0]
+
+
+def create_argument_parser():
+    parser = argparse.ArgumentParser(prog=os.path.basename(__file__).split('.')[0],
+                                     description="Create indexes alongside rankings databases to accelerate the "
+                                                 "calculation of enrichment.",
+                                     fromfile_prefix_chars='@', add_help=True)
+    parser.add_argument('db_fnames', nargs='+',
+                        type=argparse.FileType('rb'),
+                        help='The name of the databases in legacy SQL or feather format.')
+    parser.add_argument('--auc_threshold',
+                        type=float, default=0.05,
+                        help='The threshold used for calculating the AUC of a feature as fraction of ranked genes (default: 0.05).')
+    parser.add_argument('-n', '--n_samples',
+                        type=int, default=20,
+                        help='The number of random signatures per size used to calibrate the AUC null index (default: 20).')
+    parser.add_argument('-t', '--types', nargs='+',
+                        choices=['aucnull', 'toprank'], default=['aucnull'],
+                        help='The types of indexes to create (default: aucnull).')
+    parser.add_argument('-d', '--depth',
+                        type=int, default=5000,
+                        help='The number of top ranked genes/regions to keep per feature in the top rank index. Should'
+                             ' not be smaller than the rank threshold to avoid loading the database (default: 5000).')
+    return parser
+
+
+def create_indexes(in_fnames, types, auc_threshold, n_samples, depth):
+    for fname in in_fnames:
+        print("Indexing {}".format(fname.name))
+        db = opendb(fname=fname.name, name=derive_db_name(fname.name))
+        if 'aucnull' in types:
+            AUCNullIndex.create(db, auc_threshold=auc_threshold, n_samples=n_samples).save(
+                AUCNullIndex.derive_fname(fname.name))
+        if 'toprank' in types:
+            TopRankIndex.create(db, depth=depth).save(TopRankIndex.derive_fname(fname.name))
+
+
+def main():
+    parser = create_argument_parser()
+    args = parser.parse_args()
+    if len(args.db_fnames) == 0:
+        parser.print_help()
+    else:
+        create_indexes(args.db_fnames, args.types, args.auc_threshold, args.n_samples, args.depth)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,36 +8,39 @@ os.environ["OPENBLAS_NUM_THREADS"] = "1"
 # Set number of threads to use for MKL.
 os.environ["MKL_NUM_THREADS"] = "1"
 
+import time
 import argparse
 import logging
+from contextlib import nullcontext
 from shutil import copyfile
-from dask.diagnostics import ProgressBar
 from multiprocessing import cpu_count
-from arboreto.algo import grnboost2, genie3
-from arboreto.utils import load_tf_names
 
-from pyscenic.utils import modules_from_adjacencies
-from pyscenic.rnkdb import opendb, RankingDatabase
-from pyscenic.prune import prune2df, find_features, _prepare_client
-from pyscenic.aucell import aucell
+# The modules that depend on arboreto, dask, numba or psutil are imported by the commands that need them, so that a
+# command (or its help) does not pay for importing the dependencies of the other commands.
 from pyscenic.log import create_logging_handler
 import sys
-from typing import Type, Sequence
+from typing import Type, Sequence, Mapping, Optional
 from .utils import load_exp_matrix, load_signatures, save_matrix, save_enriched_motifs, load_adjacencies, load_modules, append_auc_mtx, ATTRIBUTE_NAME_CELL_IDENTIFIER, ATTRIBUTE_NAME_GENE
 
-try:
-    from pyscenic._version import get_versions
-    VERSION = get_versions()['version']
-except:
-    VERSION = "?.?.?"
-
 LOGGER = logging.getLogger(__name__)
 
 
+def _version() -> str:
+    try:
+        from pyscenic import __version__
+        return __version__
+    except:
+        return "?.?.?"
+
+
 def find_adjacencies_command(args):
     """
     Infer co-expression modules.
     """
+    from arboreto.algo import grnboost2, genie3
+    from arboreto.utils import load_tf_names
+    from pyscenic.prune import _prepare_client
+
     LOGGER.info("Loading expression matrix.")
     try:
         ex_mtx = load_exp_matrix(args.expression_mtx_fname.name,
@@ -72,36 +75,77 @@ def find_adjacencies_command(args):
     network.to_csv(args.output, index=False, sep='\t')
 
 
-def adjacencies2modules(args):
-    try:
-        adjacencies = load_adjacencies(args.module_fname.name)
-    except ValueError as e:
-        LOGGER.error(e)
-        sys.exit(1)
+def _create_profiler(args) -> Optional['Profiler']:
+    if not args.profile:
+        return None
+    from pyscenic.profiling import Profiler
+    return Profiler()
+
+
+def _stage(profiler: Optional['Profiler'], name: str):
+    return profiler.stage(name) if profiler is not None else nullcontext()
+
+
+def adjacencies2modules(args, profiler: Optional['Profiler'] = None):
+    from pyscenic.utils import modules_from_adjacencies, add_correlation, _unique_float_exp_matrix, RHO_THRESHOLD
+
+    with _stage(profiler, 'load_adjacencies'):
+        try:
+            adjacencies = load_adjacencies(args.module_fname.name)
+        except ValueError as e:
+            LOGGER.error(e)
+            sys.exit(1)
 
     LOGGER.info("Loading expression matrix.")
-    try:
-        ex_mtx = load_exp_matrix(args.expression_mtx_fname.name,
-                                 (args.transpose == 'yes'),
-                                 args.cell_id_attribute,
-                                 args.gene_attribute)
-    except ValueError as e:
-        LOGGER.error(e)
-        sys.exit(1)
+    with _stage(profiler, 'load_expression_matrix'):
+        try:
+            ex_mtx = load_exp_matrix(args.expression_mtx_fname.name,
+                                     (args.transpose == 'yes'),
+                                     args.cell_id_attribute,
+                                     args.gene_attribute)
+        except ValueError as e:
+            LOGGER.error(e)
+            sys.exit(1)
+
+    # The correlation between regulators and targets is calculated upfront so that it is profiled as separate stage.
+    with _stage(profiler, 'correlation'):
+        adjacencies = add_correlation(adjacencies, _unique_float_exp_matrix(ex_mtx),
+                                      rho_threshold=RHO_THRESHOLD, mask_dropouts=True)
 
-    return modules_from_adjacencies(adjacencies,
-                                    ex_mtx,
-                                    thresholds=args.thresholds,
-                                    top_n_targets=args.top_n_targets,
-                                    top_n_regulators=args.top_n_regulators,
-                                    min_genes=args.min_genes,
-                                    keep_only_activating=(args.all_modules != "yes"))
+    with _stage(profiler, 'create_modules'):
+        return modules_from_adjacencies(adjacencies,
+                                        ex_mtx,
+                                        thresholds=args.thresholds,
+                                        top_n_targets=args.top_n_targets,
+                                        top_n_regulators=args.top_n_regulators,
+                                        min_genes=args.min_genes,
+                                        keep_only_activating=(args.all_modules != "yes"))
 
 
-def _load_dbs(fnames: Sequence[str]) -> Sequence[Type[RankingDatabase]]:
+def _load_dbs(fnames: Sequence[str], profiler: Optional['Profiler'] = None) -> Sequence[Type['RankingDatabase']]:
+    from pyscenic.rnkdb import opendb
+
     def get_name(fname):
         return os.path.basename(fname).split(".")[0]
-    return [opendb(fname=fname.name, name=get_name(fname.name)) for fname in fnames]
+
+    def load_db(fname):
+        start = time.perf_counter()
+        db = opendb(fname=fname.name, name=get_name(fname.name))
+        if profiler is not None:
+            profiler.observe_database(db.name, time.perf_counter() - start)
+        return db
+    return [load_db(fname) for fname in fnames]
+
+
+def _load_indices(fnames: Sequence[str], dbs: Sequence[Type['RankingDatabase']], index_cls) -> Mapping[str, object]:
+    name2index = dict()
+    for fname, db in zip(fnames, dbs):
+        index_fname = index_cls.derive_fname(fname.name)
+        if os.path.isfile(index_fname):
+            name2index[db.name] = index_cls.load(index_fname)
+        else:
+            LOGGER.warning("No {} available for {}.".format(index_cls.__name__, db.name))
+    return name2index
 
 
 class NoProgressBar:
@@ -120,88 +164,187 @@ def prune_targets_command(args):
     # Potential improvements are switching to JSON or to use a CLoader:
     # https://stackoverflow.com/questions/27743711/can-i-speedup-yaml
     # The alternative for which was opted in the end is binary pickling.
+    import pandas as pd
+    from dask.diagnostics import ProgressBar
+    from pyscenic.transform import df2regulons, DF_META_DATA
+    from pyscenic.rnkidx import AUCNullIndex, TopRankIndex
+    from pyscenic.prune import prune2df, find_features
+    from pyscenic.sink import open_sink
+    from pyscenic.schedule import CostModel
+
+    profiler = _create_profiler(args)
+
     extension = os.path.splitext(args.module_fname.name)[1].lower()
     if extension in {'.csv', '.tsv'}:
         if args.expression_mtx_fname is None:
             LOGGER.error("No expression matrix is supplied.")
             sys.exit(0)
         LOGGER.info("Creating modules.")
-        modules = adjacencies2modules(args)
+        modules = adjacencies2modules(args, profiler)
     else:
         LOGGER.info("Loading modules.")
-        try:
-            modules = load_modules(args.module_fname.name)
-        except ValueError as e:
-            LOGGER.error(e)
-            sys.exit(1)
+        with _stage(profiler, 'load_modules'):
+            try:
+                modules = load_modules(args.module_fname.name)
+            except ValueError as e:
+                LOGGER.error(e)
+                sys.exit(1)
 
     if len(modules) == 0:
         LOGGER.error("Not a single module loaded")
         sys.exit(1)
 
     LOGGER.info("Loading databases.")
-    dbs = _load_dbs(args.database_fname)
+    with _stage(profiler, 'open_databases'):
+        dbs = _load_dbs(args.database_fname, profiler)
+        null_indices = _load_indices(args.database_fname, dbs, AUCNullIndex) if args.auc_null_index == "yes" else None
+        rank_indices = _load_indices(args.database_fname, dbs, TopRankIndex) if args.top_rank_index == "yes" else None
+
+    if args.resume == "yes" and not args.checkpoint_dir:
+        LOGGER.error("A checkpoint directory is required for resuming a run.")
+        sys.exit(1)
 
     LOGGER.info("Calculating regulons.")
     motif_annotations_fname = args.annotations_fname.name
     calc_func = find_features if args.no_pruning == "yes" else prune2df
-    with ProgressBar() if args.mode == "dask_multiprocessing" else NoProgressBar():
-        df_motifs = calc_func(dbs, modules, motif_annotations_fname,
-                           rank_threshold=args.rank_threshold,
-                           auc_threshold=args.auc_threshold,
-                           nes_threshold=args.nes_threshold,
-                           client_or_address=args.mode,
-                           module_chunksize=args.chunk_size,
-                           num_workers=args.num_workers)
+    try:
+        db_replication = {name: int(n) for name, n in (item.split('=') for item in args.db_replication)}
+    except ValueError:
+        LOGGER.error("The replication of databases must be supplied as NAME=NUMBER.")
+        sys.exit(1)
+    try:
+        memory_budget = args.memory_budget if args.memory_budget in {None, 'auto'} \
+            else int(float(args.memory_budget) * (1 << 30))
+    except ValueError:
+        LOGGER.error("The memory budget must be supplied as a number of GB or 'auto'.")
+        sys.exit(1)
+    # The timings observed in previous runs are used to balance the chunks of modules across workers.
+    cost_model = None
+    if args.cost_model:
+        cost_model = CostModel.load(args.cost_model) if os.path.isfile(args.cost_model) else CostModel()
+
+    def calc(sink=None):
+        with ProgressBar() if args.mode == "dask_multiprocessing" else NoProgressBar():
+            return calc_func(dbs, modules, motif_annotations_fname,
+                             rank_threshold=args.rank_threshold,
+                             auc_threshold=args.auc_threshold,
+                             nes_threshold=args.nes_threshold,
+                             client_or_address=(args.client_or_address if args.mode == "dask_cluster"
+                                                else args.mode),
+                             module_chunksize=args.chunk_size,
+                             num_workers=args.num_workers,
+                             incremental=(args.incremental == "yes"),
+                             null_indices=null_indices,
+                             exact_nes=(args.exact_nes == "yes"),
+                             rank_indices=rank_indices,
+                             sink=sink,
+                             checkpoint_dir=args.checkpoint_dir,
+                             resume=(args.resume == "yes"),
+                             cost_model=cost_model,
+                             db_affinity=(args.db_affinity == "yes"),
+                             db_replication=db_replication,
+                             motif_similarity_fdr=args.max_similarity_fdr,
+                             orthologuous_identity_threshold=args.min_orthologous_identity,
+                             cache_motif_annotations=(args.cache_annotations == "yes"),
+                             prefetch=args.prefetch,
+                             batch_genes=args.batch_genes,
+                             task_observer=(profiler.observe if profiler is not None else None),
+                             phase_timings=(profiler.phases if profiler is not None else None),
+                             memory_budget=memory_budget)
+
+    # Tables of enriched motifs are written to disk chunk by chunk as soon as they are available. The file is only
+    # finalized when the calculation succeeds, otherwise the partially written file is removed.
+    extension = os.path.splitext(args.output.name)[1].lower()
+    if args.output.name != '<stdout>' and extension in {'.csv', '.tsv', '.parquet'}:
+        with _stage(profiler, 'enrichment'), open_sink(args.output.name) as sink:
+            calc(sink)
+        LOGGER.info("{} enriched motifs written to file.".format(sink.n_rows))
+        if cost_model is not None:
+            cost_model.save(args.cost_model)
+        if profiler is not None:
+            profiler.save(args.profile)
+        return
+
+    if profiler is not None:
+        # The results are collected chunk by chunk so that their aggregation is profiled as separate stage.
+        chunks = []
+        with _stage(profiler, 'enrichment'):
+            calc(chunks.append)
+        with _stage(profiler, 'aggregation'):
+            df_motifs = pd.concat([DF_META_DATA] + chunks)
+    else:
+        df_motifs = calc()
+
+    regulons = None
+    if args.output.name != '<stdout>' and extension in {'.json', '.dat', '.gmt', '.yaml', '.yml'}:
+        LOGGER.info("Deriving regulons.")
+        with _stage(profiler, 'derive_regulons'):
+            regulons = df2regulons(df_motifs)
 
     LOGGER.info("Writing results to file.")
-    if args.output.name == '<stdout>':
-        df_motifs.to_csv(args.output)
-    else:
-        save_enriched_motifs(df_motifs, args.output.name)
+    with _stage(profiler, 'write'):
+        if args.output.name == '<stdout>':
+            df_motifs.to_csv(args.output)
+        else:
+            save_enriched_motifs(df_motifs, args.output.name, regulons)
+    if profiler is not None:
+        profiler.save(args.profile)
 
 
 def aucell_command(args):
     """
     Calculate regulon enrichment (as AUC values) for cells.
     """
+    from pyscenic.aucell import aucell4r, create_rankings
+
+    profiler = _create_profiler(args)
+
     LOGGER.info("Loading expression matrix.")
-    try:
-        ex_mtx = load_exp_matrix(args.expression_mtx_fname.name,
-                                 (args.transpose == 'yes'),
-                                 args.cell_id_attribute,
-                                 args.gene_attribute)
-    except ValueError as e:
-        LOGGER.error(e)
-        sys.exit(1)
+    with _stage(profiler, 'load_expression_matrix'):
+        try:
+            ex_mtx = load_exp_matrix(args.expression_mtx_fname.name,
+                                     (args.transpose == 'yes'),
+                                     args.cell_id_attribute,
+                                     args.gene_attribute)
+        except ValueError as e:
+            LOGGER.error(e)
+            sys.exit(1)
 
     LOGGER.info("Loading gene signatures.")
-    try:
-        signatures = load_signatures(args.signatures_fname.name)
-    except ValueError as e:
-        LOGGER.error(e)
-        sys.exit(1)
+    with _stage(profiler, 'load_signatures'):
+        try:
+            signatures = load_signatures(args.signatures_fname.name)
+        except ValueError as e:
+            LOGGER.error(e)
+            sys.exit(1)
 
     LOGGER.info("Calculating cellular enrichment.")
-    auc_mtx = aucell(ex_mtx, signatures,
-                         auc_threshold=args.auc_threshold,
-                         noweights=(args.weights != 'yes'),
-                         num_workers=args.num_workers)
+    with _stage(profiler, 'rankings'):
+        df_rnk = create_rankings(ex_mtx)
+    with _stage(profiler, 'enrichment'):
+        auc_mtx = aucell4r(df_rnk, signatures,
+                           auc_threshold=args.auc_threshold,
+                           noweights=(args.weights != 'yes'),
+                           num_workers=args.num_workers,
+                           batch_genes=args.batch_genes)
 
     LOGGER.info("Writing results to file.")
     extension = os.path.splitext(args.output.name)[1].lower()
-    if extension == '.loom':
-        try:
-            copyfile(args.expression_mtx_fname.name, args.output.name)
-            append_auc_mtx(args.output.name, auc_mtx, signatures)
-        except OSError as e:
-            LOGGER.error("Expression matrix should be provided in the loom file format.")
-            sys.exit(1)
-    elif args.output.name == '<stdout>':
-        transpose = (args.transpose == 'yes')
-        (auc_mtx.T if transpose else auc_mtx).to_csv(args.output)
-    else:
-        save_matrix(auc_mtx, args.output.name, (args.transpose == 'yes'))
+    with _stage(profiler, 'write'):
+        if extension == '.loom':
+            try:
+                copyfile(args.expression_mtx_fname.name, args.output.name)
+                append_auc_mtx(args.output.name, auc_mtx, signatures)
+            except OSError as e:
+                LOGGER.error("Expression matrix should be provided in the loom file format.")
+                sys.exit(1)
+        elif args.output.name == '<stdout>':
+            transpose = (args.transpose == 'yes')
+            (auc_mtx.T if transpose else auc_mtx).to_csv(args.output)
+        else:
+            save_matrix(auc_mtx, args.output.name, (args.transpose == 'yes'))
+    if profiler is not None:
+        profiler.save(args.profile)
 
 
 
@@ -219,6 +362,21 @@ def add_recovery_parameters(parser):
     return parser
 
 
+def add_index_parameters(parser):
+    group = parser.add_argument_group('database index arguments')
+    group.add_argument('--auc_null_index', action='store_const', const='yes', default='no',
+                       help='Use the precomputed AUC null index stored alongside each database (created via indexdb) to'
+                            ' approximate the NES (default: no). The enriched features can differ from the exact'
+                            ' calculation.')
+    group.add_argument('--exact_nes', action='store_const', const='yes', default='no',
+                       help='Calculate the exact NES even if an AUC null index is used and log the deviation of the'
+                            ' approximation (default: no).')
+    group.add_argument('--top_rank_index', action='store_const', const='yes', default='no',
+                       help='Use the precomputed top rank index stored alongside each database (created via indexdb) to'
+                            ' calculate the AUCs (default: no).')
+    return parser
+
+
 def add_annotation_parameters(parser):
     group = parser.add_argument_group('motif annotation arguments')
     group.add_argument('--min_orthologous_identity',
@@ -230,6 +388,9 @@ def add_annotation_parameters(parser):
     group.add_argument('--annotations_fname',
                        type=argparse.FileType('r'),
                        help='The name of the file that contains the motif annotations to use.', required=True)
+    group.add_argument('--cache_annotations', action='store_const', const='yes', default='no',
+                       help='Store the motif annotations in a binary file next to the annotations file to speed up'
+                            ' subsequent runs (default: no).')
     return parser
 
 
@@ -281,7 +442,7 @@ def add_loom_parameters(parser):
 
 def create_argument_parser():
     parser = argparse.ArgumentParser(prog=os.path.basename(__file__).split('.')[0],
-                                     description='Single-CEll regulatory Network Inference and Clustering ({})'.format(VERSION),
+                                     description='Single-CEll regulatory Network Inference and Clustering ({})'.format(_version()),
                                      fromfile_prefix_chars='@', add_help=True,
                                      epilog="Arguments can be read from file using a @args.txt construct. "
                                             "For more information on loom file format see http://loompy.org . "
@@ -328,7 +489,7 @@ def create_argument_parser():
                                    'Two file formats are supported: feather or db (legacy).')
     parser_ctx.add_argument('-o', '--output',
                             type=argparse.FileType('w'), default=sys.stdout,
-                            help='Output file/stream, i.e. a table of enriched motifs and target genes (csv, tsv)'
+                            help='Output file/stream, i.e. a table of enriched motifs and target genes (csv, tsv, parquet)'
                                  ' or collection of regulons (yaml, gmt, dat, json).')
     parser_ctx.add_argument('-n', '--no_pruning', action='store_const', const = 'yes',
                               help='Do not perform pruning, i.e. find enriched motifs.')
@@ -336,14 +497,47 @@ def create_argument_parser():
                        type=int, default=100,
                        help='The size of the module chunks assigned to a node in the dask graph (default: 100).')
     parser_ctx.add_argument('--mode',
-                       choices=['custom_multiprocessing', 'dask_multiprocessing', 'dask_cluster'],
+                       choices=['custom_multiprocessing', 'dask_multiprocessing', 'threaded', 'dask_cluster'],
                        default='dask_multiprocessing',
                        help='The mode to be used for computing (default: dask_multiprocessing).')
+    parser_ctx.add_argument('--incremental', action='store_const', const='yes', default='no',
+                            help='Calculate the enrichment of nested modules of the same transcription factor incrementally'
+                                 ' (default: no). Cannot be combined with database indices.')
+    parser_ctx.add_argument('--checkpoint_dir', type=str, default=None,
+                            help='The directory in which the results of completed chunks of modules are persisted.')
+    parser_ctx.add_argument('--resume', action='store_const', const='yes', default='no',
+                            help='Skip the chunks of modules that were already completed by a previous run using the'
+                                 ' same checkpoint directory and parameters (default: no).')
+    parser_ctx.add_argument('--db_affinity', action='store_const', const='yes', default='no',
+                            help='Pin each worker of a dask cluster to a subset of the databases, which it keeps in'
+                                 ' memory (default: no). Only valid if dask_cluster is selected as mode.')
+    parser_ctx.add_argument('--db_replication', nargs='*', default=[], metavar='NAME=NUMBER',
+                            help='The number of workers assigned to a database when using database affinity'
+                                 ' (default: 1).')
+    parser_ctx.add_argument('--cost_model', type=str, default=None,
+                            help='A JSON file with the timings observed in previous runs, used to balance the chunks of'
+                                 ' modules across workers. The file is created or updated when the output is a table'
+                                 ' of enriched motifs (csv, tsv, parquet).')
+    parser_ctx.add_argument('--prefetch', type=int, default=0,
+                            help='The number of modules for which the rankings are loaded ahead in a background thread'
+                                 ' while the current module is scored (default: 0, i.e. no prefetching).')
+    parser_ctx.add_argument('--batch_genes', type=int, default=0,
+                            help='Load the rankings for batches of modules at once, i.e. the union of their genes with'
+                                 ' at most this number of genes (default: 0, i.e. one module at a time).')
+    parser_ctx.add_argument('--memory_budget', type=str, default=None, metavar='GB',
+                            help='The memory in GB the calculation may use or "auto" for the available memory. The'
+                                 ' number of workers, the chunk size and whether the databases are loaded in memory are'
+                                 ' adapted to this budget (default: no budget). Not used for dask.distributed clusters.')
+    parser_ctx.add_argument('--profile', type=str, default=None, metavar='FILE',
+                            help='Write the wall time, CPU time and peak memory of each stage together with statistics'
+                                 ' for each database, each chunk of modules and the phases of the calculation for a'
+                                 ' module to a JSON file.')
     parser_ctx.add_argument('-a', '--all_modules', action='store_const', const = 'yes', default='no',
                             help='Included positive and negative regulons in the analysis (default: no, i.e. only positive).')
     parser_ctx.add_argument('-t', '--transpose', action='store_const', const = 'yes',
                             help='Transpose the expression matrix (rows=genes x columns=cells).')
     add_recovery_parameters(parser_ctx)
+    add_index_parameters(parser_ctx)
     add_annotation_parameters(parser_ctx)
     add_computation_parameters(parser_ctx)
     add_module_parameters(parser_ctx)
@@ -380,6 +574,11 @@ def create_argument_parser():
     parser_aucell.add_argument('--num_workers',
                        type=int, default=cpu_count(),
                        help='The number of workers to use (default: {}).'.format(cpu_count()))
+    parser_aucell.add_argument('--batch_genes', type=int, default=0,
+                               help='Select the rankings for batches of signatures at once, i.e. the union of their'
+                                    ' genes with at most this number of genes (default: 0, i.e. one signature at a time).')
+    parser_aucell.add_argument('--profile', type=str, default=None, metavar='FILE',
+                               help='Write the wall time, CPU time and peak memory of each stage to a JSON file.')
     add_recovery_parameters(parser_aucell)
     add_loom_parameters(parser_aucell)
     parser_aucell.set_defaults(func=aucell_command)
@@ -7,17 +7,16 @@ import zlib
 import base64
 import numpy as np
 import pandas as pd
-import loompy as lp
 from operator import attrgetter
-from typing import Type, Sequence
-from pyscenic.genesig import GeneSignature
-from pyscenic.transform import df2regulons
-from pyscenic.utils import load_motifs, load_from_yaml, save_to_yaml
-from pyscenic.binarization import binarize
+from typing import Type, Sequence, Optional
+from pyscenic.genesig import GeneSignature, Regulon
 
+# The modules that depend on numba, dask, pyarrow, loompy or scikit-learn are imported by the functions that need them,
+# so that the command line interface does not import these for every command (cf. pyscenic.cli.pyscenic).
 
-__all__ = ['save_matrix', 'load_exp_matrix', 'load_signatures', 'save_enriched_motifs', 'load_adjacencies',
-           'load_modules', 'append_auc_mtx']
+
+__all__ = ['save_matrix', 'load_exp_matrix', 'load_signatures', 'save_enriched_motifs', 'load_enriched_motifs',
+           'load_adjacencies', 'load_modules', 'append_auc_mtx']
 
 
 ATTRIBUTE_NAME_CELL_IDENTIFIER = "CellID"
@@ -35,6 +34,7 @@ def save_df_as_loom(df: pd.DataFrame, fname: str) -> None:
     :param df: The 2-dimensional dataframe (rows = cells x columns = genes).
     :param fname: The name of the loom file to create.
     """
+    import loompy as lp
     assert df.ndim == 2
     # The orientation of the loom file is always:
     #   - Columns represent cells or aggregates of cells
@@ -56,6 +56,7 @@ def load_exp_matrix_as_loom(fname,
     :param fname: The name of the loom file to load.
     :return: A 2-dimensional dataframe (rows = cells x columns = genes).
     """
+    import loompy as lp
     with lp.connect(fname) as ds:
         # The orientation of the loom file is always:
         #   - Columns represent cells or aggregates of cells
@@ -126,19 +127,46 @@ def guess_separator(fname: str) -> str:
     raise ValueError("Unknown file format \"{}\".".format(fname))
 
 
+def load_enriched_motifs(fname: str) -> pd.DataFrame:
+    """
+    Load enriched motifs from disk.
+
+    Supported file formats are CSV, TSV and Parquet.
+
+    :param fname: The name of the file that contains the enriched motifs.
+    :return: The dataframe with enriched motifs.
+    """
+    extension = os.path.splitext(fname)[1].lower()
+    if extension in FILE_EXTENSION2SEPARATOR.keys():
+        from pyscenic.utils import load_motifs
+        return load_motifs(fname, sep=FILE_EXTENSION2SEPARATOR[extension])
+    elif extension == '.parquet':
+        import pyarrow.parquet as pq
+        from pyscenic.arrow import table2enriched_motifs
+        return table2enriched_motifs(pq.read_table(fname))
+    else:
+        raise ValueError("Unknown file format \"{}\".".format(fname))
+
+
 def load_signatures(fname: str) -> Sequence[Type[GeneSignature]]:
     """
     Load genes signatures from disk.
 
-    Supported file formats are GMT, DAT (pickled), YAML or CSV (enriched motifs).
+    Supported file formats are GMT, DAT (pickled), YAML, CSV or Parquet (enriched motifs).
 
     :param fname: The name of the file that contains the signatures.
     :return: A list of gene signatures.
     """
     extension = os.path.splitext(fname)[1].lower()
     if extension in FILE_EXTENSION2SEPARATOR.keys():
-        return df2regulons(load_motifs(fname, sep=FILE_EXTENSION2SEPARATOR[extension]))
+        from pyscenic.transform import df2regulons
+        return df2regulons(load_enriched_motifs(fname))
+    elif extension == '.parquet':
+        import pyarrow.parquet as pq
+        from pyscenic.arrow import table2regulons
+        return table2regulons(pq.read_table(fname))
     elif extension in {'.yaml', '.yml'}:
+        from pyscenic.utils import load_from_yaml
         return load_from_yaml(fname)
     elif extension.endswith('.gmt'):
         sep = guess_separator(fname)
@@ -152,21 +180,29 @@ def load_signatures(fname: str) -> Sequence[Type[GeneSignature]]:
         raise ValueError("Unknown file format \"{}\".".format(fname))
 
 
-def save_enriched_motifs(df, fname:str) -> None:
+def save_enriched_motifs(df, fname:str, regulons: Optional[Sequence[Regulon]] = None) -> None:
     """
     Save enriched motifs.
 
-    Supported file formats are CSV, TSV, GMT, DAT (pickle), JSON or YAML.
+    Supported file formats are CSV, TSV, Parquet, GMT, DAT (pickle), JSON or YAML.
 
     :param df:
     :param fname:
+    :param regulons: The regulons derived from the enriched motifs, if already available (only relevant for the
+        GMT, DAT, JSON and YAML file formats).
     :return:
     """
     extension = os.path.splitext(fname)[1].lower()
     if extension in FILE_EXTENSION2SEPARATOR.keys():
         df.to_csv(fname, sep=FILE_EXTENSION2SEPARATOR[extension])
+    elif extension == '.parquet':
+        import pyarrow.parquet as pq
+        from pyscenic.arrow import enriched_motifs2table
+        pq.write_table(enriched_motifs2table(df), fname)
     else:
-        regulons = df2regulons(df)
+        if regulons is None:
+            from pyscenic.transform import df2regulons
+            regulons = df2regulons(df)
         if extension == '.json':
             name2targets = {r.name: list(r.gene2weight.keys()) for r in regulons}
             with open(fname, 'w') as f:
@@ -176,6 +212,7 @@ def save_enriched_motifs(df, fname:str) -> None:
         elif extension == '.gmt':
             GeneSignature.to_gmt(fname, regulons)
         elif extension in {'.yaml', '.yml'}:
+            from pyscenic.utils import save_to_yaml
             save_to_yaml(regulons, fname)
         else:
             raise ValueError("Unknown file format \"{}\".".format(fname))
@@ -192,6 +229,7 @@ def load_modules(fname: str) -> Sequence[Type[GeneSignature]]:
     # https://stackoverflow.com/questions/27743711/can-i-speedup-yaml
     # The alternative for which was opted in the end is binary pickling.
     if fname.endswith('.yaml') or fname.endswith('.yml'):
+        from pyscenic.utils import load_from_yaml
         return load_from_yaml(fname)
     elif fname.endswith('.dat'):
         with open(fname, 'rb') as f:
@@ -226,6 +264,9 @@ def append_auc_mtx(fname: str, auc_mtx: pd.DataFrame, regulons: Sequence[Type[Ge
     :param auc_mtx: The matrix that contains the AUC values.
     :param regulons: Collection of regulons that were used for calculation of the AUC values.
     """
+    import loompy as lp
+    from pyscenic.binarization import binarize
+
     # Fetch sequence logo from regulon's context.
     def fetch_logo(context):
         for elem in context:
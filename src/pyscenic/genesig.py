@@ -4,7 +4,7 @@ import re
 import os
 from collections.abc import Iterable, Mapping
 from itertools import repeat
-from typing import Mapping, List, FrozenSet, Type
+from typing import Mapping, List, FrozenSet, Type, Sequence, Tuple
 
 import attr
 import yaml
@@ -378,3 +378,30 @@ class Regulon(GeneSignature, yaml.YAMLObject):
                         score=max(self.score, getattr(other, 'score', 0.0)))
 
 
+
+
+def union_batches(signatures: Sequence[Type[GeneSignature]],
+                  max_genes: int) -> List[Tuple[GeneSignature, List[Type[GeneSignature]]]]:
+    """
+    Split a sequence of gene signatures in batches of consecutive signatures for which the union of their genes does not
+    exceed a maximum number of genes. A single signature with more genes ends up in a batch on its own.
+
+    :param signatures: The gene signatures.
+    :param max_genes: The maximum number of genes in the union of the signatures of a batch.
+    :return: A list of tuples with the union of the genes of the batch (as gene signature) and the signatures of the
+        batch.
+    """
+    def union(batch, genes):
+        return GeneSignature(name="Union of {} signatures".format(len(batch)), gene2weight=sorted(genes)), batch
+
+    batches, batch, genes = [], [], set()
+    for gs in signatures:
+        extended_genes = genes.union(gs.genes)
+        if batch and len(extended_genes) > max_genes:
+            batches.append(union(batch, genes))
+            batch, extended_genes = [], set(gs.genes)
+        batch.append(gs)
+        genes = extended_genes
+    if batch:
+        batches.append(union(batch, genes))
+    return batches
@@ -5,7 +5,10 @@ import numpy as np
 from numba import *
 
 
-@njit(signature_or_function=float64(float64[:], float64[:], float64))
+# The kernels are compiled eagerly for their signatures when this module is imported. The compiled kernels are cached
+# on disk so that this only happens once instead of in every process.
+
+@njit(signature_or_function=float64(float64[:], float64[:], float64), cache=True)
 def masked_rho(x: np.ndarray, y: np.ndarray, mask: float = 0.0) -> float:
     """
     Calculates the masked correlation coefficient of two vectors.
@@ -30,7 +33,7 @@ def masked_rho(x: np.ndarray, y: np.ndarray, mask: float = 0.0) -> float:
     return cov_xy / (std_x * std_y)
 
 
-@njit(signature_or_function=float64[:, :](float64[:, :], float64[:, :], float64), parallel=True)
+@njit(signature_or_function=float64[:, :](float64[:, :], float64[:, :], float64), parallel=True, cache=True)
 def masked_rho_2d(x: np.ndarray, y: np.ndarray, mask: float = 0.0) -> np.ndarray:
     """
     Calculates the masked correlation coefficients of two arrays.
@@ -50,7 +53,7 @@ def masked_rho_2d(x: np.ndarray, y: np.ndarray, mask: float = 0.0) -> np.ndarray
     return rhos
 
 
-@njit(signature_or_function=float64[:](float64[:, :], int64[:, :], float64), parallel=True)
+@njit(signature_or_function=float64[:](float64[:, :], int64[:, :], float64), parallel=True, cache=True)
 def masked_rho4pairs(mtx: np.ndarray, col_idx_pairs: np.ndarray, mask: float = 0.0) -> np.ndarray:
     """
     Calculates the masked correlation of columns pairs in a matrix.
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import psutil
+import threading
+import pandas as pd
+from multiprocessing import cpu_count
+from typing import Type, Sequence, Dict, List, Optional
+
+from .genesig import GeneSignature
+from .timers import PhaseTimings
+
+
+__all__ = ['Profiler']
+
+
+class _Stage:
+    """
+    A stage of a calculation being profiled. The CPU time and memory of the child processes (e.g. workers) are included
+    by sampling the process tree in a background thread.
+    """
+    def __init__(self, profiler: 'Profiler', name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def _sample(self, cpu_times: Dict[int, float]) -> None:
+        process = self.profiler.process
+        rss = 0
+        for p in [process] + process.children(recursive=True):
+            try:
+                with p.oneshot():
+                    times = p.cpu_times()
+                    # Processes that stopped keep the CPU time of their last sample.
+                    cpu_times[p.pid] = times.user + times.system
+                    rss += p.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def _run(self) -> None:
+        while not self.stop.wait(self.profiler.interval):
+            self._sample(self.cpu_times)
+
+    def __enter__(self):
+        self.start_cpu_times, self.cpu_times, self.peak_rss = dict(), dict(), 0
+        self._sample(self.start_cpu_times)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.start = time.perf_counter()
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall_time = time.perf_counter() - self.start
+        self.stop.set()
+        self.thread.join()
+        self._sample(self.cpu_times)
+        cpu_time = sum(t - self.start_cpu_times.get(pid, 0.0) for pid, t in self.cpu_times.items())
+        self.profiler.stages.append({'stage': self.name, 'wall_time': wall_time, 'cpu_time': cpu_time,
+                                     'cpu_utilisation': cpu_time / (wall_time * cpu_count()) if wall_time > 0 else 0.0,
+                                     'peak_rss': self.peak_rss, 'completed': exc_type is None})
+
+
+class Profiler:
+    """
+    Collect the wall time, CPU time and peak resident memory of the stages of a calculation (e.g. a command of the
+    command line interface) together with statistics for each database, each chunk of modules and the phases of the
+    calculation for a module (cf. pyscenic.timers).
+    """
+    def __init__(self, interval: float = 0.1):
+        """
+        :param interval: The interval in seconds for sampling the CPU time and memory of the process tree.
+        """
+        self.interval = interval
+        self.process = psutil.Process()
+        self.stages = []  # type: List[Dict[str, object]]
+        self.databases = dict()  # type: Dict[str, Dict[str, object]]
+        self.chunks = []  # type: List[Dict[str, object]]
+        self.phases = PhaseTimings()
+
+    def stage(self, name: str) -> _Stage:
+        """
+        A context manager that profiles a stage.
+        """
+        return _Stage(self, name)
+
+    def observe_database(self, db_name: str, open_time: float) -> None:
+        self.databases.setdefault(db_name, {})['open_time'] = open_time
+
+    def observe(self, db_name: str, modules: Sequence[Type[GeneSignature]], seconds: float,
+                result: Optional[object] = None) -> None:
+        """
+        Record the statistics of a chunk of modules processed for a database (cf. task_observer of prune2df).
+        """
+        self.chunks.append({'database': db_name, 'n_modules': len(modules),
+                            'n_genes': int(sum(len(module) for module in modules)), 'seconds': seconds,
+                            'n_rows': len(result) if isinstance(result, pd.DataFrame) else None})
+
+    def report(self) -> Dict[str, object]:
+        """
+        The report with the statistics of all stages, databases, chunks of modules and phases.
+        """
+        databases = {name: dict(stats) for name, stats in self.databases.items()}
+        for chunk in self.chunks:
+            stats = databases.setdefault(chunk['database'], {})
+            stats['n_chunks'] = stats.get('n_chunks', 0) + 1
+            stats['n_modules'] = stats.get('n_modules', 0) + chunk['n_modules']
+            stats['seconds'] = stats.get('seconds', 0.0) + chunk['seconds']
+            if chunk['n_rows'] is not None:
+                stats['n_rows'] = stats.get('n_rows', 0) + chunk['n_rows']
+        return {'pid': os.getpid(), 'n_cpus': cpu_count(),
+                'stages': self.stages, 'databases': databases, 'chunks': self.chunks, 'phases': self.phases.report()}
+
+    def save(self, fname: str) -> None:
+        """
+        Write the report as JSON file.
+        """
+        with open(fname, 'w') as f:
+            json.dump(self.report(), f, indent=1)
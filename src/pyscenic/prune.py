@@ -5,31 +5,45 @@ import re
 from math import ceil
 from functools import partial
 from operator import concat
-from typing import Type, Sequence, TypeVar, Callable
+from itertools import chain
+from typing import Type, Sequence, TypeVar, Callable, Optional, Mapping, Set, Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait as wait_for_futures, FIRST_COMPLETED
 import tempfile
 import pickle
+import shutil
+import time
 import os
+import threading
+import traceback
 
 import pandas as pd
+import pyarrow as pa
 
-# Using multiprocessing using dill package for pickling to avoid strange bugs.
-from multiprocessing import cpu_count
-from multiprocessing_on_dill.connection import Pipe
-from multiprocessing_on_dill.context import Process
+# Workers are forked so that the transformation function and its data are inherited instead of pickled.
+from multiprocessing import cpu_count, Pipe
+from multiprocessing.connection import wait
+from multiprocessing.context import ForkProcess
 
 from boltons.iterutils import chunked_iter
 
 from dask import delayed
 from dask.dataframe import from_delayed
 
-from dask.distributed import LocalCluster, Client
+from dask.distributed import LocalCluster, Client, as_completed
 
 from .log import create_logging_handler
 from .genesig import Regulon, GeneSignature
-from .utils import load_motif_annotations
-from .rnkdb import RankingDatabase, MemoryDecorator
+from .annotations import MotifAnnotations, load_filtered_motif_annotations
+from .rnkdb import RankingDatabase, MemoryDecorator, SQLiteRankingDatabase, FeatherRankingDatabase, \
+    DataFrameRankingDatabase
+from .rnkidx import AUCNullIndex, TopRankIndex
+from .checkpoint import CheckpointDirectory
+from .arrow import enriched_motifs2table, table2enriched_motifs
+from .schedule import CostModel, balanced_chunks, assign_databases, plan_execution, LOCAL_MODES
+from .timers import PhaseTimings, collect_phases
 from .utils import add_motif_url
-from .transform import module2features_auc1st_impl, modules2regulons, modules2df, df2regulons, DF_META_DATA
+from .transform import module2features_auc1st_impl, module2features_incremental_impl, modules2regulons, modules2df, \
+    df2regulons, order_by_inclusion, DF_META_DATA
 
 
 __all__ = ['prune2df', 'find_features', 'df2regulons']
@@ -97,56 +111,163 @@ def _prepare_client(client_or_address, num_workers):
         raise ValueError("Invalid client specified {}".format(str(client_or_address)))
 
 
-class Worker(Process):
+def _write_result(output, fname: str) -> str:
+    """
+    Write the output of a worker to a file. Dataframes of enriched motifs are written in the Arrow IPC file format, other
+    outputs are pickled.
+
+    :return: The name of the file.
+    """
+    if isinstance(output, pd.DataFrame):
+        fname = "{}.arrow".format(fname)
+        table = enriched_motifs2table(output)
+        with pa.OSFile(fname, 'wb') as sink:
+            writer = pa.RecordBatchFileWriter(sink, table.schema)
+            writer.write_table(table)
+            writer.close()
+    else:
+        fname = "{}.pickle".format(fname)
+        with open(fname, 'wb') as f:
+            pickle.dump(output, f, pickle.HIGHEST_PROTOCOL)
+    return fname
+
+
+def _read_result(fname: str):
+    """
+    Read the output of a worker. An Arrow table is returned for dataframes of enriched motifs. The table refers to the
+    memory mapped file instead of a copy of its content.
+    """
+    if fname.endswith(".arrow"):
+        return pa.ipc.open_file(pa.memory_map(fname, 'r')).read_all()
+    with open(fname, 'rb') as f:
+        return pickle.load(f)
+
+
+def _to_output(result):
+    return table2enriched_motifs(result) if isinstance(result, pa.Table) else result
+
+
+class Worker(ForkProcess):
     def __init__(self, name: str, db: Type[RankingDatabase], modules: Sequence[Regulon],
-                 motif_annotations_fname: str, sender,
-                 motif_similarity_fdr: float, orthologuous_identity_threshold: float,
-                 transformation_func):
+                 motif_annotations: MotifAnnotations, sender, output_fname: str,
+                 transformation_func, transformation_kwargs: Optional[Mapping[str, object]] = None,
+                 phases=False, in_memory=True):
         super().__init__(name=name)
         self.database = db
         self.modules = modules
-        self.motif_annotations_fname = motif_annotations_fname
-        self.motif_similarity_fdr = motif_similarity_fdr
-        self.orthologuous_identity_threshold = orthologuous_identity_threshold
+        self.motif_annotations = motif_annotations
         self.transform_fnc = transformation_func
+        self.transform_kwargs = transformation_kwargs if transformation_kwargs else dict()
         self.sender = sender
+        self.output_fname = output_fname
+        self.phases = phases
+        self.in_memory = in_memory
 
     def run(self):
-        # Load ranking database in memory.
-        rnkdb = MemoryDecorator(self.database)
-        LOGGER.info("Worker {}: database loaded in memory.".format(self.name))
-
-        # Load motif annotations in memory.
-        motif_annotations = load_motif_annotations(self.motif_annotations_fname,
-                                                   motif_similarity_fdr=self.motif_similarity_fdr,
-                                                   orthologous_identity_threshold=self.orthologuous_identity_threshold)
-        LOGGER.info("Worker {}: motif annotations loaded in memory.".format(self.name))
-
-        # Apply transformation on all modules.
-        output = self.transform_fnc(rnkdb, self.modules, motif_annotations=motif_annotations)
-        LOGGER.info("Worker {}: All regulons derived.".format(self.name))
-
-        # Sending information back to parent process: to avoid overhead of pickling the data, the output is first written
-        # to disk in binary pickle format to a temporary file. The name of that file is shared with the parent process.
-        output_fname = tempfile.mktemp()
-        with open(output_fname, 'wb') as f:
-            pickle.dump(output, f)
-        del output
-        self.sender.send(output_fname)
-        self.sender.close()
+        # Failures are reported to the parent process instead of leaving it waiting for a result.
+        try:
+            # Load ranking database in memory, unless the rankings of each module are streamed from storage.
+            if self.in_memory:
+                rnkdb = MemoryDecorator(self.database)
+                LOGGER.info("Worker {}: database loaded in memory.".format(self.name))
+            else:
+                rnkdb = self.database
+
+            # Apply transformation on all modules. The motif annotations are loaded by the parent process and inherited.
+            start = time.perf_counter()
+            with collect_phases(self.phases) as timings:
+                output = self.transform_fnc(rnkdb, self.modules, motif_annotations=self.motif_annotations,
+                                            **self.transform_kwargs)
+            elapsed = time.perf_counter() - start
+            LOGGER.info("Worker {}: All regulons derived.".format(self.name))
+
+            # Sending information back to parent process: to avoid the overhead of pickling the data, the output is
+            # written to a file in the Arrow IPC format which is memory mapped by the parent process. The name of that
+            # file is shared with the parent process together with the time needed for the transformation and the
+            # timings of its phases.
+            fname = _write_result(output, self.output_fname)
+            del output
+            self.sender.send((fname, elapsed, timings, None))
+        except Exception:
+            self.sender.send((None, None, None, traceback.format_exc()))
+        finally:
+            self.sender.close()
         LOGGER.info("Worker {}: Done.".format(self.name))
 
 
 T = TypeVar('T')
 
 
+# The data that is shared by all tasks executed by a worker process of a ProcessPoolExecutor.
+_WORKER_DATA = dict()
+
+
+def _init_worker(motif_annotations: MotifAnnotations, transform_kwargs: Mapping[str, object], phases=False) -> None:
+    _WORKER_DATA['motif_annotations'] = motif_annotations
+    _WORKER_DATA['transform_kwargs'] = transform_kwargs
+    _WORKER_DATA['phases'] = phases
+
+
+def _timed(transform_func, db: Type[RankingDatabase], modules: Sequence[Type[GeneSignature]], *args, phases=False,
+           **kwargs):
+    # Return the result of the transformation together with the time it took (cf. CostModel) and, if requested, the
+    # timings of its phases (cf. pyscenic.timers).
+    start = time.perf_counter()
+    with collect_phases(phases) as timings:
+        result = transform_func(db, modules, *args, **kwargs)
+    return result, time.perf_counter() - start, timings
+
+
+# The databases that are kept in memory by a worker process of a dask.distributed cluster (cf. database affinity).
+_RESIDENT_DBS = dict()
+_RESIDENT_DBS_LOCK = threading.Lock()
+
+
+def _transform_resident_db(transform_func, db: Type[RankingDatabase], modules: Sequence[Type[GeneSignature]],
+                           *args, **kwargs):
+    # The database is only loaded in memory by the first task that uses it on this worker. The lock prevents threads
+    # of the same worker from loading the same database twice.
+    with _RESIDENT_DBS_LOCK:
+        if db.name not in _RESIDENT_DBS:
+            _RESIDENT_DBS[db.name] = MemoryDecorator(db)
+        resident_db = _RESIDENT_DBS[db.name]
+    return transform_func(resident_db, modules, *args, **kwargs)
+
+
+def _transform_in_worker(transform_func, db: Type[RankingDatabase], modules: Sequence[Type[GeneSignature]]):
+    return _timed(transform_func, db, modules, _WORKER_DATA['motif_annotations'], phases=_WORKER_DATA['phases'],
+                  **_WORKER_DATA['transform_kwargs'])
+
+
+def _tfs_of(modules: Sequence[Type[GeneSignature]]) -> Optional[Set[str]]:
+    # Gene signatures that are not derived from a TF (cf. find_features) can be annotated with any TF.
+    tfs = {getattr(module, 'transcription_factor', None) for module in modules}
+    return tfs if None not in tfs else None
+
+
+def _features_of(rnkdbs: Sequence[Type[RankingDatabase]]) -> Optional[Set[str]]:
+    # Not all types of databases can list their features without loading the rankings.
+    if not all(isinstance(db, (SQLiteRankingDatabase, FeatherRankingDatabase, MemoryDecorator,
+                               DataFrameRankingDatabase)) for db in rnkdbs):
+        return None
+    return set(chain.from_iterable(db.features for db in rnkdbs))
+
+
 def _distributed_calc(rnkdbs: Sequence[Type[RankingDatabase]], modules: Sequence[Type[GeneSignature]],
                       motif_annotations_fname: str,
                       transform_func: Callable[[Type[RankingDatabase], Sequence[Type[GeneSignature]], str], T],
                       aggregate_func: Callable[[Sequence[T]], T],
                       motif_similarity_fdr: float = 0.001, orthologuous_identity_threshold: float = 0.0,
                       client_or_address='dask_multiprocessing',
-                      num_workers=None, module_chunksize=100) -> T:
+                      num_workers=None, module_chunksize=100,
+                      transform_kwargs: Optional[Mapping[str, object]] = None,
+                      sink: Optional[Callable[[T], None]] = None,
+                      checkpoint: Optional[CheckpointDirectory] = None,
+                      cost_model: Optional[CostModel] = None,
+                      db_affinity=False, db_replication: Optional[Mapping[str, int]] = None,
+                      cache_motif_annotations=False,
+                      task_observer: Optional[Callable[[str, Sequence[Type[GeneSignature]], float, T], None]] = None,
+                      phase_timings: Optional[PhaseTimings] = None, in_memory=True) -> Optional[T]:
     """
     Perform a parallelized or distributed calculation, either pruning targets or finding enriched motifs.
 
@@ -162,24 +283,49 @@ def _distributed_calc(rnkdbs: Sequence[Type[RankingDatabase]], modules: Sequence
     :param orthologuous_identity_threshold: The minimum orthologuous identity to find factor annotations
         for enriched motifs.
     :param client_or_address: The client of IP address of the scheduler when working with dask. For local multi-core
-        systems 'custom_multiprocessing' or 'dask_multiprocessing' can be supplied.
+        systems 'custom_multiprocessing', 'dask_multiprocessing' or 'threaded' can be supplied.
     :param num_workers: If not using a cluster, the number of workers to use for the calculation.
         None of all available CPUs need to be used.
     :param module_chunksize: The size of the chunk in signatures to use when using the dask framework with the
-        multiprocessing scheduler.
-    :return: A pandas dataframe or a sequence of regulons (depends on aggregate function supplied).
+        multiprocessing scheduler or the threaded mode.
+    :param transform_kwargs: Additional keyword arguments for the transform function. These are shipped to the workers
+        in the same way as the motif annotations, i.e. only once, instead of being pickled for every task.
+    :param sink: A callable to which the result of each task is passed as soon as it is available, instead of
+        aggregating all results in memory. The aggregate function is not used in that case.
+    :param checkpoint: A directory in which the result of each completed task is persisted. Tasks that were completed
+        in a previous run are not executed again, their results are passed to the sink instead. Requires a sink.
+    :param cost_model: A model of the cost of processing modules for each database. When supplied, the modules are
+        split in chunks with approximately the same estimated cost (instead of the same number of modules) and the most
+        expensive chunks are scheduled first. The model is updated with the observed timings of the tasks when a sink is
+        supplied.
+    :param db_affinity: Only for dask.distributed: pin each worker to a subset of the databases, i.e. tasks for a
+        database are only executed by the workers assigned to it and these workers keep the database in memory.
+    :param db_replication: A mapping from database name to the number of workers assigned to that database when using
+        database affinity (default: one worker per database).
+    :param cache_motif_annotations: Use a binary cache of the motif annotations next to the annotations file.
+    :param task_observer: A callable that is called with the name of the database, the chunk of modules, the time
+        needed and the result of each task when a sink is supplied (e.g. pyscenic.profiling.Profiler.observe).
+    :param phase_timings: The timings of the phases of the transform function (cf. pyscenic.timers) executed by the
+        workers are collected and merged into this object when a sink is supplied.
+    :param in_memory: Only for 'custom_multiprocessing' and 'threaded': load the databases in memory instead of
+        loading the rankings of each module from storage.
+    :return: A pandas dataframe or a sequence of regulons (depends on aggregate function supplied) or None if a sink
+        was supplied.
     """
     def is_valid(client_or_address):
         if isinstance(client_or_address, str) and ((client_or_address in
-                                                    {"custom_multiprocessing", "dask_multiprocessing", "local"})
+                                                    {"custom_multiprocessing", "dask_multiprocessing", "threaded",
+                                                     "local"})
                                                    or IP_PATTERN.fullmatch(client_or_address)):
             return True
         elif isinstance(client_or_address, Client):
             return True
         return False
     assert is_valid(client_or_address), "\"{}\"is not valid for parameter client_or_address.".format(client_or_address)
+    transform_kwargs = transform_kwargs if transform_kwargs else dict()
+    assert checkpoint is None or sink is not None, "Checkpointing requires a sink."
 
-    if client_or_address not in {'custom_multiprocessing', 'dask_multiprocessing'}:
+    if client_or_address not in {'custom_multiprocessing', 'dask_multiprocessing', 'threaded'}:
         module_chunksize = 1
 
     # Make sure warnings and info are being logged.
@@ -188,40 +334,132 @@ def _distributed_calc(rnkdbs: Sequence[Type[RankingDatabase]], modules: Sequence
         if LOGGER.getEffectiveLevel() > logging.INFO:
             LOGGER.setLevel(logging.INFO)
 
+    # Load the motif annotations that can be used for these modules and databases and compile them into a lookup
+    # structure that is shipped once to the workers.
+    motif_annotations = load_filtered_motif_annotations(motif_annotations_fname,
+                                                        tfs=_tfs_of(modules), features=_features_of(rnkdbs),
+                                                        motif_similarity_fdr=motif_similarity_fdr,
+                                                        orthologous_identity_threshold=orthologuous_identity_threshold,
+                                                        cache=cache_motif_annotations)
+
+    def chunks(db, chunksize):
+        if cost_model is None:
+            return chunked_iter(modules, chunksize)
+        gs_chunks, before, after = balanced_chunks(db, modules, int(ceil(len(modules) / float(chunksize))), cost_model)
+        LOGGER.info("Load imbalance (max/mean estimated cost of a chunk) for {}: {:.2f} before and {:.2f} after "
+                    "balancing.".format(db.name, before, after))
+        return gs_chunks
+
+    def pending(chunksize):
+        # Generate the tasks that still need to be executed together with their identifier. The results of tasks that
+        # were completed in a previous run are immediately passed to the sink.
+        for db in rnkdbs:
+            for gs_chunk in chunks(db, chunksize):
+                key = CheckpointDirectory.derive_key(db.name, gs_chunk) if checkpoint is not None else None
+                if checkpoint is not None and checkpoint.is_completed(key):
+                    sink(checkpoint.load(key))
+                else:
+                    yield key, db, gs_chunk
+
+    phases = phase_timings is not None
+
+    def consume(key, db, gs_chunk, result, elapsed, timings=None):
+        if phase_timings is not None:
+            phase_timings.merge(timings)
+        if cost_model is not None:
+            cost_model.observe(db.name, gs_chunk, elapsed)
+        if task_observer is not None:
+            task_observer(db.name, gs_chunk, elapsed, result)
+        if checkpoint is not None:
+            checkpoint.save(key, result)
+        sink(result)
+
     if client_or_address == 'custom_multiprocessing': # CUSTOM parallelized implementation.
         # This implementation overcomes the I/O-bounded performance. Each worker (subprocess) loads a dedicated ranking
-        # database and motif annotation table into its own memory space before consuming module. The implementation of
-        # each worker uses the AUC-first numba JIT based implementation of the algorithm.
+        # database into its own memory space before consuming module, the motif annotations are inherited from the
+        # parent process. The implementation of each worker uses the AUC-first numba JIT based implementation of the
+        # algorithm.
         assert len(rnkdbs) <= num_workers if num_workers else cpu_count(), "The number of databases is larger than the number of cores."
         amplifier = int((num_workers if num_workers else cpu_count())/len(rnkdbs))
         LOGGER.info("Using {} workers.".format(len(rnkdbs) * amplifier))
-        receivers = []
-        for db in rnkdbs:
-            for idx, chunk in enumerate(chunked_iter(modules, ceil(len(modules)/float(amplifier)))):
-                sender, receiver = Pipe()
-                receivers.append(receiver)
-                Worker("{}({})".format(db.name, idx+1), db, chunk, motif_annotations_fname, sender,
-                       motif_similarity_fdr, orthologuous_identity_threshold, transform_func).start()
-        # Retrieve the name of the temporary file to which the data is stored. This is a blocking operation.
-        fnames = [recv.recv() for recv in receivers]
-        # Load all data from disk and concatenate.
-        def load(fname):
-            with open(fname, 'rb') as f:
-                return pickle.load(f)
+        # The outputs of the workers are written to a temporary directory that is always removed, also on failure.
+        output_dir = tempfile.mkdtemp(prefix="pyscenic-")
+        workers, receivers, receiver2task = [], [], dict()
         try:
-            return aggregate_func(list(map(load, fnames)))
+            for idx, (key, db, chunk) in enumerate(pending(ceil(len(modules)/float(amplifier)))):
+                receiver, sender = Pipe(duplex=False)
+                receivers.append(receiver)
+                receiver2task[receiver] = (key, db, chunk)
+                worker = Worker("{}({})".format(db.name, idx+1), db, chunk, motif_annotations, sender,
+                                os.path.join(output_dir, str(idx)), transform_func, transform_kwargs, phases,
+                                in_memory)
+                worker.start()
+                # The parent process must not keep the sending end open, otherwise the death of a worker goes unnoticed.
+                sender.close()
+                workers.append(worker)
+
+            def receive(receiver):
+                try:
+                    fname, elapsed, timings, error = receiver.recv()
+                except EOFError:
+                    raise RuntimeError("Worker for {} died unexpectedly.".format(receiver2task[receiver][1].name))
+                if error is not None:
+                    raise RuntimeError("Worker for {} failed:\n{}".format(receiver2task[receiver][1].name, error))
+                return _read_result(fname), elapsed, timings
+
+            # Consume the output of the workers in order of completion.
+            receiver2result = dict()
+            remaining = list(receivers)
+            while remaining:
+                for receiver in wait(remaining):
+                    remaining.remove(receiver)
+                    result, elapsed, timings = receive(receiver)
+                    if sink is not None:
+                        # Only a single output is kept in memory.
+                        consume(*receiver2task[receiver], _to_output(result), elapsed, timings)
+                    else:
+                        receiver2result[receiver] = result
+            if sink is not None:
+                return None
+            results = [receiver2result[receiver] for receiver in receivers]
+            # Tables of enriched motifs are concatenated without copying and converted to a single dataframe.
+            if results and all(isinstance(result, pa.Table) for result in results):
+                return table2enriched_motifs(pa.concat_tables(results))
+            return aggregate_func(list(map(_to_output, results)))
         finally:
-            # Remove temporary files.
-            for fname in fnames:
-                os.remove(fname)
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+            shutil.rmtree(output_dir, ignore_errors=True)
+    elif client_or_address == 'threaded': # Multi-threaded implementation.
+        # All threads of a single process share the databases loaded in memory and the motif annotations, i.e. nothing
+        # is pickled and no process needs to be started. This scales with the number of threads because the numba
+        # kernels for the recovery curves, AUCs and leading edges release the GIL.
+        n_workers = num_workers if num_workers else cpu_count()
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            future2task, memory_db = dict(), None
+            for key, db, gs_chunk in pending(module_chunksize):
+                # The tasks are generated database by database. Only the database of the tasks that are submitted is
+                # kept in memory, the previous one is released when its last task finishes.
+                if memory_db is None or memory_db.name != db.name:
+                    memory_db = MemoryDecorator(db) if in_memory else db
+                future = executor.submit(_timed, transform_func, memory_db, gs_chunk, motif_annotations,
+                                         phases=phases, **transform_kwargs)
+                future2task[future] = (key, db, gs_chunk)
+                if sink is not None and len(future2task) >= 2 * n_workers:
+                    done, _ = wait_for_futures(future2task.keys(), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        consume(*future2task.pop(future), *future.result())
+            memory_db = None
+            if sink is None:
+                return aggregate_func([future.result()[0] for future in future2task.keys()])
+            for future in wait_for_futures(future2task.keys()).done:
+                consume(*future2task[future], *future.result())
+        return None
     else: # DASK framework.
-        # Load motif annotations.
-        motif_annotations = load_motif_annotations(motif_annotations_fname,
-                                                   motif_similarity_fdr=motif_similarity_fdr,
-                                                   orthologous_identity_threshold=orthologuous_identity_threshold)
-
         # Create dask graph.
-        def create_graph(client=None):
+        def create_graph(tasks, client=None):
             # NOTE ON CHUNKING SIGNATURES:
             # Chunking the gene signatures might not be necessary anymore because the overhead of the dask
             # scheduler is minimal (cf. blog http://matthewrocklin.com/blog/work/2016/05/05/performant-task-scheduling).
@@ -240,6 +478,8 @@ def _distributed_calc(rnkdbs: Sequence[Type[RankingDatabase]], modules: Sequence
             def wrap(data):
                 return client.scatter(data, broadcast=True) if client else delayed(data, pure=True)
             delayed_or_future_annotations = wrap(motif_annotations)
+            # The same holds for other large data structures the transform function depends on (e.g. database indices).
+            delayed_or_future_kwargs = {key: wrap(value) for key, value in transform_kwargs.items()}
             # 2. The databases: these database objects are typically proxies to the data on disk. They only have
             # the name and location on shared storage as fields. For consistency reason we do broadcast these database
             # objects to the workers. If we decide to have all information of a database loaded into memory we can still
@@ -248,7 +488,7 @@ def _distributed_calc(rnkdbs: Sequence[Type[RankingDatabase]], modules: Sequence
             #    return MemoryDecorator(db)
             #delayed_or_future_dbs = list(map(wrap, map(memoize, rnkdbs)))
             # Check also latest Stackoverflow message: https://stackoverflow.com/questions/50795901/dask-scatter-broadcast-a-list
-            delayed_or_future_dbs = list(map(wrap, rnkdbs))
+            delayed_or_future_dbs = {db.name: wrap(db) for db in rnkdbs}
             # 3. The gene signatures: these signatures become large when chunking them, therefore chunking is overruled
             # when using dask.distributed.
             # See earlier.
@@ -288,21 +528,62 @@ def _distributed_calc(rnkdbs: Sequence[Type[RankingDatabase]], modules: Sequence
             # again be unavoidable. TBI + See following stackoverflow question:
             # https://stackoverflow.com/questions/47776936/why-is-a-computation-much-slower-within-a-dask-distributed-worker
 
-            return aggregate_func(
-                        (delayed(transform_func)
-                            (db, gs_chunk, delayed_or_future_annotations)
-                                for db in delayed_or_future_dbs
-                                    for gs_chunk in chunked_iter(modules, module_chunksize)))
+            # When consuming results chunk by chunk, the time needed for each task is returned as well.
+            func = partial(_timed, transform_func, phases=phases) if sink is not None else transform_func
+            # With database affinity the workers keep the databases in memory across tasks.
+            func = partial(_transform_resident_db, func) if db_affinity else func
+            return [delayed(func)(delayed_or_future_dbs[db.name], gs_chunk, delayed_or_future_annotations,
+                                  **delayed_or_future_kwargs)
+                        for _, db, gs_chunk in tasks]
 
         # Compute dask graph ...
-        if client_or_address == "dask_multiprocessing":
+        n_workers = num_workers if num_workers else cpu_count()
+        if client_or_address == "dask_multiprocessing" and sink is None:
             # ... via multiprocessing.
-            return create_graph().compute(scheduler='processes', num_workers=num_workers if num_workers else cpu_count())
+            return aggregate_func(create_graph(pending(module_chunksize))).compute(scheduler='processes',
+                                                                                   num_workers=n_workers)
+        elif client_or_address == "dask_multiprocessing":
+            # ... via a single pool of processes when streaming. The multiprocessing scheduler of dask only returns
+            # results when the whole graph is computed. The motif annotations and additional keyword arguments are
+            # shipped once to each process and a bounded number of chunks is in flight so that only a few results are
+            # kept in memory. Results are consumed in order of completion.
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                     initargs=(motif_annotations, transform_kwargs, phases)) as executor:
+                future2task = dict()
+                for key, db, gs_chunk in pending(module_chunksize):
+                    future2task[executor.submit(_transform_in_worker, transform_func, db, gs_chunk)] = (key, db, gs_chunk)
+                    if len(future2task) >= 2 * n_workers:
+                        done, _ = wait_for_futures(future2task.keys(), return_when=FIRST_COMPLETED)
+                        for future in done:
+                            consume(*future2task.pop(future), *future.result())
+                for future in wait_for_futures(future2task.keys()).done:
+                    consume(*future2task[future], *future.result())
+            return None
         else:
             # ... via dask.distributed framework.
-            client, shutdown_callback = _prepare_client(client_or_address, num_workers=num_workers if num_workers else cpu_count())
+            client, shutdown_callback = _prepare_client(client_or_address, num_workers=n_workers)
             try:
-                return client.compute(create_graph(client), sync=True)
+                tasks = list(pending(module_chunksize))
+                graph = create_graph(tasks, client)
+                # NOTE ON DATABASE AFFINITY:
+                # Instead of having all workers access all databases, each worker is assigned to a subset of the
+                # databases and only receives the tasks for these databases. This removes the I/O contention on shared
+                # storage because a database is loaded only once by each of its workers and then kept in memory.
+                workers = None
+                if db_affinity:
+                    db2workers = assign_databases([db.name for db in rnkdbs],
+                                                  sorted(client.scheduler_info()['workers'].keys()), db_replication)
+                    for name, addresses in db2workers.items():
+                        LOGGER.info("Database {} is assigned to {} worker(s).".format(name, len(addresses)))
+                    workers = {delayed_task: db2workers[db.name] for delayed_task, (_, db, _) in zip(graph, tasks)}
+                if sink is None:
+                    return client.compute(aggregate_func(graph), workers=workers, sync=True)
+                futures = client.compute(graph, workers=workers)
+                future2task = {future.key: task for future, task in zip(futures, tasks)}
+                for future in as_completed(futures):
+                    consume(*future2task[future.key], *future.result())
+                    future.release()
+                return None
             finally:
                 shutdown_callback(False)
 
@@ -312,7 +593,17 @@ def prune2df(rnkdbs: Sequence[Type[RankingDatabase]], modules: Sequence[Regulon]
              rank_threshold: int = 1500, auc_threshold: float = 0.05, nes_threshold=3.0,
              motif_similarity_fdr: float = 0.001, orthologuous_identity_threshold: float = 0.0,
              weighted_recovery=False, client_or_address='dask_multiprocessing',
-             num_workers=None, module_chunksize=100, filter_for_annotation=True) -> pd.DataFrame:
+             num_workers=None, module_chunksize=100, filter_for_annotation=True, incremental=False,
+             null_indices: Optional[Mapping[str, AUCNullIndex]] = None, exact_nes=False,
+             rank_indices: Optional[Mapping[str, TopRankIndex]] = None,
+             sink: Optional[Callable[[pd.DataFrame], None]] = None,
+             checkpoint_dir: Optional[str] = None, resume=False,
+             cost_model: Optional[CostModel] = None,
+             db_affinity=False, db_replication: Optional[Mapping[str, int]] = None,
+             cache_motif_annotations=False, prefetch: int = 0, batch_genes: int = 0,
+             task_observer: Optional[Callable[[str, Sequence[Regulon], float, pd.DataFrame], None]] = None,
+             phase_timings: Optional[PhaseTimings] = None,
+             memory_budget: Optional[Union[int, str]] = None) -> Optional[pd.DataFrame]:
     """
     Calculate all regulons for a given sequence of ranking databases and a sequence of co-expression modules.
     The number of regulons derived from the supplied modules is usually much lower. In addition, the targets of the
@@ -333,22 +624,119 @@ def prune2df(rnkdbs: Sequence[Type[RankingDatabase]], modules: Sequence[Regulon]
         None of all available CPUs need to be used.
     :param module_chunksize: The size of the chunk to use when using the dask framework.
     :param client_or_address: The client of IP address of the scheduler when working with dask. For local multi-core
-        systems 'custom_multiprocessing' or 'dask_multiprocessing' can be supplied.
-    :return: A dataframe.
+        systems 'custom_multiprocessing', 'dask_multiprocessing' or 'threaded' (a pool of threads sharing the
+        databases loaded in memory) can be supplied.
+    :param incremental: Calculate enrichment incrementally for nested modules of the same TF. The modules are reordered
+        so that modules of the same TF end up in the same chunk. This has no effect when using a dask.distributed
+        cluster because chunking is overruled in that case. The incremental calculation always derives the exact NES
+        and cannot be combined with database indices.
+    :param null_indices: A mapping from database name to a precomputed AUC null index (cf. indexdb command line tool).
+        For these databases the NES is derived from the precomputed null distribution and AUCs are only calculated for
+        features that can reach the NES threshold.
+    :param exact_nes: Calculate the exact NES even if an AUC null index is available (validation mode). The NES derived
+        from an AUC null index is an approximation, i.e. the enriched features can differ from the exact calculation.
+    :param rank_indices: A mapping from database name to a precomputed top rank index (cf. indexdb command line tool).
+        For these databases the AUCs are calculated from the index instead of the rankings loaded from the database.
+    :param sink: A callable that consumes the dataframe of enriched features of each chunk of modules as soon as it
+        is available (e.g. pyscenic.sink.ParquetSink). This bounds the memory needed for aggregating the results.
+    :param checkpoint_dir: A directory in which the enriched features of each completed chunk of modules are persisted
+        (cf. pyscenic.checkpoint.CheckpointDirectory).
+    :param resume: Skip the chunks of modules that were completed by a previous run with the same checkpoint
+        directory and parameters.
+    :param cost_model: A model of the cost of processing modules for each database used to balance the chunks of
+        modules (cf. pyscenic.schedule.CostModel). It is updated with the observed timings when a sink or checkpoint
+        directory is supplied. This has no effect for incremental calculations because modules of the same TF must end
+        up in the same chunk.
+    :param db_affinity: Only for dask.distributed clusters: pin each worker to a subset of the databases which it keeps
+        in memory, i.e. a worker only receives the modules for its databases.
+    :param db_replication: A mapping from database name to the number of workers assigned to that database when using
+        database affinity. Databases that are used more frequently can be replicated across more workers.
+    :param cache_motif_annotations: Store the motif annotations in a binary file next to the annotations file and use
+        this file in subsequent runs with the same thresholds instead of parsing the annotations file again.
+    :param prefetch: The number of modules for which the rankings are loaded ahead in a background thread while the
+        enrichment of the current module is calculated. This hides the time spent waiting for databases on slow
+        (network) storage. Zero disables prefetching.
+    :param batch_genes: Load the rankings for batches of consecutive modules of a chunk at once, i.e. the union of their
+        genes with at most this number of genes. Zero disables batching.
+    :param task_observer: A callable that is called with the name of the database, the chunk of modules, the time
+        needed and the dataframe of enriched features of each chunk (e.g. pyscenic.profiling.Profiler.observe).
+    :param phase_timings: Collect the time spent in each phase of the calculation for a module (loading rankings, AUC,
+        NES, annotation, recovery curves, leading edge and assembly of the dataframe) across all workers into this
+        object (cf. pyscenic.timers.PhaseTimings). The statistics are logged when the calculation is finished.
+    :param memory_budget: The memory in bytes the calculation may use on the local machine or 'auto' for the available
+        memory. The number of workers, the chunk size and whether the databases are loaded in memory are adapted to fit
+        this budget and the calculation is refused upfront when it cannot fit (cf. pyscenic.schedule.plan_execution).
+        This has no effect for dask.distributed clusters.
+    :return: A dataframe or None if a sink was supplied.
     """
+    assert not (incremental and (null_indices or rank_indices)), \
+        "The incremental calculation of enrichment cannot be combined with database indices."
+    for name in set(null_indices if null_indices else []) & set(rank_indices if rank_indices else []):
+        LOGGER.warning("Both an AUC null index and a top rank index are available for {}. "
+                       "The AUC null index is ignored.".format(name))
+
     # Always use module2features_auc1st_impl not only because of speed impact but also because of reduced memory footprint.
-    module2features_func = partial(module2features_auc1st_impl,
-                                   rank_threshold=rank_threshold,
-                                   auc_threshold=auc_threshold,
-                                   nes_threshold=nes_threshold,
-                                   filter_for_annotation=filter_for_annotation)
+    if incremental:
+        module2features_func = partial(module2features_incremental_impl,
+                                       rank_threshold=rank_threshold,
+                                       auc_threshold=auc_threshold,
+                                       nes_threshold=nes_threshold,
+                                       filter_for_annotation=filter_for_annotation)
+    else:
+        module2features_func = partial(module2features_auc1st_impl,
+                                       rank_threshold=rank_threshold,
+                                       auc_threshold=auc_threshold,
+                                       nes_threshold=nes_threshold,
+                                       filter_for_annotation=filter_for_annotation,
+                                       exact_nes=exact_nes)
     transformation_func = partial(modules2df,
-                                  module2features_func=module2features_func, weighted_recovery=weighted_recovery)
+                                  module2features_func=module2features_func, weighted_recovery=weighted_recovery,
+                                  incremental=incremental, prefetch=prefetch, batch_genes=batch_genes)
+    if incremental:
+        modules = list(chain.from_iterable(order_by_inclusion(modules)))
+        cost_model = None
+    # The indices are shipped separately to the workers to avoid pickling them for every task.
+    transform_kwargs = {key: value for key, value in (('null_indices', null_indices), ('rank_indices', rank_indices))
+                        if value}
     # Create a distributed dataframe from individual delayed objects to avoid out of memory problems.
-    aggregation_func = partial(from_delayed, meta=DF_META_DATA) if client_or_address != 'custom_multiprocessing' else pd.concat
-    return _distributed_calc(rnkdbs, modules, motif_annotations_fname, transformation_func, aggregation_func,
-                             motif_similarity_fdr, orthologuous_identity_threshold, client_or_address,
-                             num_workers, module_chunksize)
+    aggregation_func = partial(from_delayed, meta=DF_META_DATA) \
+        if client_or_address not in {'custom_multiprocessing', 'threaded'} else pd.concat
+
+    in_memory = True
+    if memory_budget is not None and client_or_address in LOCAL_MODES:
+        plan = plan_execution(rnkdbs, modules, rank_threshold, memory_budget if memory_budget != 'auto' else None,
+                              client_or_address, num_workers, module_chunksize, prefetch, batch_genes, incremental)
+        LOGGER.info("Execution plan: {}.".format(plan))
+        num_workers, module_chunksize, in_memory = plan.num_workers, plan.module_chunksize, plan.in_memory
+    elif memory_budget is not None:
+        LOGGER.warning("A memory budget can only be planned for the execution on the local machine.")
+
+    checkpoint = None
+    if checkpoint_dir:
+        parameters = dict(databases=[db.name for db in rnkdbs],
+                          motif_annotations_fname=os.path.abspath(motif_annotations_fname),
+                          rank_threshold=rank_threshold, auc_threshold=auc_threshold, nes_threshold=nes_threshold,
+                          motif_similarity_fdr=motif_similarity_fdr,
+                          orthologuous_identity_threshold=orthologuous_identity_threshold,
+                          weighted_recovery=weighted_recovery, filter_for_annotation=filter_for_annotation,
+                          incremental=incremental, exact_nes=exact_nes,
+                          null_indices=sorted(null_indices.keys()) if null_indices else [],
+                          rank_indices=sorted(rank_indices.keys()) if rank_indices else [])
+        checkpoint = CheckpointDirectory(checkpoint_dir, parameters, resume)
+    chunks = None
+    if (checkpoint is not None or task_observer is not None or phase_timings is not None) and sink is None:
+        # Checkpointing, observing tasks and collecting the timings of phases require the results to be consumed chunk
+        # by chunk.
+        chunks = []
+        sink = chunks.append
+    result = _distributed_calc(rnkdbs, modules, motif_annotations_fname, transformation_func, aggregation_func,
+                               motif_similarity_fdr, orthologuous_identity_threshold, client_or_address,
+                               num_workers, module_chunksize, transform_kwargs, sink, checkpoint, cost_model,
+                               db_affinity, db_replication, cache_motif_annotations, task_observer, phase_timings,
+                               in_memory)
+    if phase_timings is not None and len(phase_timings):
+        LOGGER.info("Time spent per phase:\n{}".format(phase_timings.format()))
+    return pd.concat([DF_META_DATA] + chunks) if chunks is not None else result
 
 
 def find_features(rnkdbs: Sequence[Type[RankingDatabase]], signatures: Sequence[Type[GeneSignature]],
@@ -369,13 +757,20 @@ def find_features(rnkdbs: Sequence[Type[RankingDatabase]], signatures: Sequence[
         for enriched motifs.
     :param weighted_recovery: Use weights of a gene signature when calculating recovery curves?
     :param client_or_address: The client of IP address of the scheduler when working with dask. For local multi-core
-        systems 'custom_multiprocessing' or 'dask_multiprocessing' can be supplied.
+        systems 'custom_multiprocessing', 'dask_multiprocessing' or 'threaded' (a pool of threads sharing the
+        databases loaded in memory) can be supplied.
     :param num_workers:  If not using a cluster, the number of workers to use for the calculation.
         None of all available CPUs need to be used.
     :param module_chunksize: The size of the chunk to use when using the dask framework.
     :param motif_base_url:
-    :return: A dataframe with the enriched features.
+    :param sink: A callable that consumes the dataframe of enriched features of each chunk of modules as soon as it
+        is available.
+    :return: A dataframe with the enriched features or None if a sink was supplied.
     """
+    sink = kwargs.pop('sink', None)
+    if sink is not None:
+        return prune2df(rnkdbs, signatures, motif_annotations_fname, filter_for_annotation=False,
+                        sink=lambda df: sink(add_motif_url(df, base_url=motif_base_url)), **kwargs)
     return add_motif_url(prune2df(rnkdbs, signatures, motif_annotations_fname,
                                   filter_for_annotation=False, **kwargs), base_url=motif_base_url)
 
@@ -11,7 +11,7 @@ from .rnkdb import RankingDatabase
 from .genesig import GeneSignature, Regulon
 
 
-__all__ = ["recovery", "aucs", "enrichment4features", "enrichment4cells", "leading_edge4row"]
+__all__ = ["recovery", "aucs", "enrichment4features", "enrichment4cells", "leading_edge4row", "leading_edge2d"]
 
 
 LOGGER = logging.getLogger(__name__)
@@ -39,25 +39,59 @@ def derive_rank_cutoff(auc_threshold, total_genes, rank_threshold: Optional[int]
     return rank_cutoff
 
 
-# Do not use numba as it dwarfs the performance.
-def rcc2d(rankings: np.ndarray, weights: np.ndarray, rank_threshold: int) -> np.ndarray:
+# The kernels are compiled with nogil so that multiple threads can calculate recovery curves and AUCs in parallel
+# (cf. the threaded mode of prune2df). The compiled kernels are cached on disk so that worker processes and subsequent
+# runs do not compile them again.
+@jit(nopython=True, nogil=True, cache=True)
+def _rcc2d(rankings, weights, rank_threshold, rccs):
+    n_features, n_genes = rankings.shape
+    for row_idx in range(n_features):
+        for gene_idx in range(n_genes):
+            rank = rankings[row_idx, gene_idx]
+            if rank < rank_threshold:
+                rccs[row_idx, rank] += weights[gene_idx]
+        for col_idx in range(1, rank_threshold):
+            rccs[row_idx, col_idx] += rccs[row_idx, col_idx - 1]
+
+
+def derive_rcc_dtype(weights: np.ndarray, float32: bool = False) -> type:
+    """
+    Derive the smallest datatype that represents the recovery curves for the supplied weights exactly. For integer
+    weights (e.g. unweighted recovery) the curves are counts and unsigned integers suffice.
+
+    :param weights: The weights of the genes.
+    :param float32: Use single instead of double precision for non-integer weights. This halves the memory needed at the
+        expense of exactness.
+    """
+    weights = np.asarray(weights)
+    if weights.size == 0 or (weights.min() >= 0 and np.all(np.mod(weights, 1) == 0)):
+        total = weights.sum()
+        if total <= np.iinfo(np.uint16).max:
+            return np.uint16
+        elif total <= np.iinfo(np.uint32).max:
+            return np.uint32
+        return np.float64
+    return np.float32 if float32 else np.float64
+
+
+def rcc2d(rankings: np.ndarray, weights: np.ndarray, rank_threshold: int, dtype: Optional[type] = None) -> np.ndarray:
     """
     Calculate recovery curves.
 
     :param rankings: The features rankings for a gene signature (n_features, n_genes).
     :param weights: The weights of these genes.
+    :param dtype: The datatype of the recovery curves. The default is derived from the weights (cf. derive_rcc_dtype).
     :return: Recovery curves (n_features, rank_threshold).
     """
-    n_features = rankings.shape[0]
-    rccs = np.empty(shape=(n_features, rank_threshold)) # Pre-allocation.
-    for row_idx in range(n_features):
-        curranking = rankings[row_idx, :]
-        rccs[row_idx, :] = np.cumsum(np.bincount(curranking, weights=weights)[:rank_threshold])
+    dtype = derive_rcc_dtype(weights) if dtype is None else dtype
+    # An explicit loop instead of numpy.bincount avoids the allocation of a temporary array for each feature.
+    rccs = np.zeros((rankings.shape[0], rank_threshold), dtype=dtype)
+    _rcc2d(rankings, np.asarray(weights).astype(dtype), rank_threshold, rccs)
     return rccs
 
 
 def recovery(rnk: pd.DataFrame, total_genes: int, weights: np.ndarray, rank_threshold: int, auc_threshold: float,
-             no_auc=False) -> (np.ndarray, np.ndarray):
+             no_auc=False, dtype: Optional[type] = None) -> (np.ndarray, np.ndarray):
     """
     Calculate recovery curves and AUCs. This is the workhorse of the recovery algorithm.
 
@@ -67,17 +101,17 @@ def recovery(rnk: pd.DataFrame, total_genes: int, weights: np.ndarray, rank_thre
     :param rank_threshold: The total number of ranked genes to take into account when creating a recovery curve.
     :param auc_threshold: The fraction of the ranked genome to take into account for the calculation of the
         Area Under the recovery Curve.
+    :param dtype: The datatype of the recovery curves. The default is derived from the weights (cf. derive_rcc_dtype).
     :return: A tuple of numpy arrays. The first array contains the recovery curves (n_features/n_cells x rank_threshold),
         the second array the AUC values (n_features/n_cells).
     """
     rank_cutoff = derive_rank_cutoff(auc_threshold, total_genes, rank_threshold)
-    features, genes, rankings = rnk.index.values, rnk.columns.values, rnk.values
-    weights = np.insert(weights, len(weights), 0.0)
-    n_features = len(features)
-    rankings = np.append(rankings, np.full(shape=(n_features, 1), fill_value=total_genes), axis=1)
+    # The rankings are used in the datatype of the database: genes ranked at or beyond the rank threshold do not
+    # contribute to the recovery curves.
+    rankings = rnk.values
 
     # Calculate recovery curves.
-    rccs = rcc2d(rankings, weights, rank_threshold)
+    rccs = rcc2d(rankings, weights, rank_threshold, dtype)
     if no_auc:
         return rccs, np.array([])
 
@@ -88,12 +122,13 @@ def recovery(rnk: pd.DataFrame, total_genes: int, weights: np.ndarray, rank_thre
     assert maxauc > 0
     # The rankings are 0-based. The position at the rank threshold is included in the calculation.
     # The maximum AUC takes this into account.
-    aucs = rccs[:, :rank_cutoff].sum(axis=1) / maxauc
+    aucs = rccs[:, :rank_cutoff].sum(axis=1, dtype=np.float64) / maxauc
 
     return rccs, aucs
 
 
-def enrichment4cells(rnk_mtx: pd.DataFrame, regulon: Type[GeneSignature], auc_threshold: float = 0.05) -> pd.DataFrame:
+def enrichment4cells(rnk_mtx: pd.DataFrame, regulon: Type[GeneSignature], auc_threshold: float = 0.05,
+                     total_genes: Optional[int] = None) -> pd.DataFrame:
     """
     Calculate the enrichment of the regulon for the cells in the ranking dataframe.
 
@@ -101,9 +136,11 @@ def enrichment4cells(rnk_mtx: pd.DataFrame, regulon: Type[GeneSignature], auc_th
     :param regulon: The regulon the assess for enrichment
     :param auc_threshold: The fraction of the ranked genome to take into account for the calculation of the
         Area Under the recovery Curve.
+    :param total_genes: The total number of ranked genes when the supplied matrix is only a block of columns of the
+        ranked expression matrix.
     :return:
     """
-    total_genes = len(rnk_mtx.columns)
+    total_genes = total_genes if total_genes is not None else len(rnk_mtx.columns)
     index = pd.MultiIndex.from_tuples(list(zip(rnk_mtx.index.values, repeat(regulon.name))),
                                       names=["Cell", "Regulon"])
 
@@ -180,7 +217,7 @@ def leading_edge(rcc: np.ndarray, avg2stdrcc: np.ndarray,
         # but is inline with the RcisTarget implementation.
         filtered_idx = sranking <= rank_at_max
         filtered_gene_ids = gene_ids[filtered_idx]
-        return list(zip(filtered_gene_ids, weights[filtered_idx] if weights is not None else sranking[filtered_idx]))
+        return list(zip(filtered_gene_ids, weights[sorted_idx][filtered_idx] if weights is not None else sranking[filtered_idx]))
 
     rank_at_max, n_recovered_genes = critical_point()
     # noinspection PyTypeChecker
@@ -203,10 +240,59 @@ def leading_edge4row(row: pd.Series, avg2stdrcc: np.ndarray, genes: np.ndarray,
     return pd.Series(data=leading_edge(row['Recovery'].values, avg2stdrcc, row['Ranking'].values, genes, weights))
 
 
+@jit(nopython=True, nogil=True, cache=True)
+def _leading_edge2d(rccs, avg2stdrcc, rankings):
+    n_features, rank_threshold = rccs.shape
+    n_genes = rankings.shape[1]
+
+    # First pass: find the critical point of each recovery curve and count the genes in its leading edge.
+    rank_at_max = np.empty(n_features, dtype=np.int64)
+    indptr = np.zeros(n_features + 1, dtype=np.int64)
+    for row_idx in range(n_features):
+        max_idx = 0
+        max_diff = rccs[row_idx, 0] - avg2stdrcc[0]
+        for col_idx in range(1, rank_threshold):
+            diff = rccs[row_idx, col_idx] - avg2stdrcc[col_idx]
+            if diff > max_diff:
+                max_idx, max_diff = col_idx, diff
+        rank_at_max[row_idx] = max_idx
+        n_targets = 0
+        for gene_idx in range(n_genes):
+            if rankings[row_idx, gene_idx] <= max_idx:
+                n_targets += 1
+        indptr[row_idx + 1] = indptr[row_idx] + n_targets
+
+    # Second pass: fill in the genes of each leading edge, ordered by rank.
+    indices = np.empty(indptr[-1], dtype=np.int64)
+    for row_idx in range(n_features):
+        edge_idx = np.nonzero(rankings[row_idx, :] <= rank_at_max[row_idx])[0]
+        order = np.argsort(rankings[row_idx, :][edge_idx], kind='mergesort')
+        indices[indptr[row_idx]:indptr[row_idx + 1]] = edge_idx[order]
+    return rank_at_max, indptr, indices
+
+
+def leading_edge2d(rccs: np.ndarray, avg2stdrcc: np.ndarray,
+                   rankings: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Calculate the leading edges for multiple recovery curves at once.
+
+    :param rccs: The recovery curves (n_features, rank_threshold).
+    :param avg2stdrcc: The average + 2 standard deviation recovery curve.
+    :param rankings: The rank numbers of the genes of the signature for these features (n_features, n_genes).
+    :return: A tuple of numpy arrays. The first array contains the rank at maximum difference for each feature. The
+        second and third array encode the genes of the leading edges in compressed sparse row format: the leading edge
+        of the i-th feature consists of the column indices indices[indptr[i]:indptr[i+1]] into the rankings, ordered
+        by rank.
+    """
+    assert rccs.shape[0] == rankings.shape[0]
+    assert rccs.shape[1] == len(avg2stdrcc)
+    return _leading_edge2d(rccs, avg2stdrcc, rankings)
+
+
 # Giving numba a signature makes the code marginally faster but with losing flexibility (only being able to use one
 # type of integers used in rankings).
 #@jit(signature_or_function=float64(int16[:], int_, float64), nopython=True)
-@jit(nopython=True)
+@jit(nopython=True, nogil=True, cache=True)
 def auc1d(ranking, rank_cutoff, max_auc):
     """
     Calculate the AUC of the recovery curve of a single ranking. [DEPRECATED]
@@ -223,7 +309,7 @@ def auc1d(ranking, rank_cutoff, max_auc):
     return np.sum(np.diff(x)*y)/max_auc
 
 
-@jit(nopython=True)
+@jit(nopython=True, nogil=True, cache=True)
 def weighted_auc1d(ranking, weights, rank_cutoff, max_auc):
     """
     Calculate the AUC of the weighted recovery curve of a single ranking.
@@ -245,6 +331,7 @@ def weighted_auc1d(ranking, weights, rank_cutoff, max_auc):
     return np.sum(np.diff(x)*y)/max_auc
 
 
+@jit(nopython=True, nogil=True, cache=True)
 def auc2d(rankings, weights, rank_cutoff, max_auc):
     """
     Calculate the AUCs of multiple rankings.
@@ -255,6 +342,7 @@ def auc2d(rankings, weights, rank_cutoff, max_auc):
     :param max_auc: The maximum AUC.
     :return: The normalized AUCs.
     """
+    # The loop over the features is compiled as well so that the GIL is released for the whole calculation.
     n_features = rankings.shape[0]
     aucs = np.empty(shape=(n_features,), dtype=np.float64) # Pre-allocation.
     for row_idx in range(n_features):
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
+import queue
+import threading
+import logging
 import pandas as pd
 import numpy as np
-from typing import Tuple, Set, Type
+from typing import Tuple, Set, Type, Sequence
 from abc import ABCMeta, abstractmethod
 import sqlite3
 from operator import itemgetter
@@ -13,6 +17,30 @@ from pyarrow.feather import write_feather, FeatherReader
 from tqdm import tqdm
 
 
+LOGGER = logging.getLogger(__name__)
+
+
+def derive_rank_dtype(n: int) -> type:
+    """
+    Derive the datatype for storing 0-based rankings for a given set length. All types of databases and the rankings of
+    cells (cf. pyscenic.aucell.create_rankings) use this datatype. Because of problems on some architectures use of
+    unsigned integers is avoided.
+    """
+    # Range int16: -2^15 (= -32768) to 2^15 - 1 (= 32767).
+    # Range int32: -2^31 (= -2147483648) to 2^31 - 1 (= 2147483647).
+    return np.int16 if n <= 2**15 else np.int32
+
+
+def _as_rank_dtype(df: pd.DataFrame, n: int) -> pd.DataFrame:
+    """
+    Convert rankings that are stored in a wider integer datatype than needed (e.g. int64).
+    """
+    dtype = derive_rank_dtype(n)
+    if len(df.columns) and all(t.kind in 'iu' and t.itemsize > np.dtype(dtype).itemsize for t in df.dtypes):
+        return df.astype(dtype)
+    return df
+
+
 class RankingDatabase(metaclass=ABCMeta):
     """
     A class of a database of whole genome rankings. The whole genome is ranked for regulatory features of interest, e.g.
@@ -134,17 +162,7 @@ class SQLiteRankingDatabase(RankingDatabase):
             count = cursor.execute(GENE_ID_COUNT_QUERY).fetchone()
             cursor.close()
         self._gene_count = count[0]
-
-        # Because of problems on same architectures use of unsigned integers is avoided.
-        def derive_dtype(n):
-            """ Derive datatype for storing 0-based rankings for a given set length. """
-            if n <= 2**15:
-                # Range int16: -2^15 (= -32768) to 2^15 - 1 (= 32767).
-                return np.int16
-            else:
-                # Range int32: -2^31 (= -2147483648) to 2^31 - 1 (= 2147483647).
-                return np.int32
-        self._dtype = derive_dtype(self._gene_count)
+        self._dtype = derive_rank_dtype(self._gene_count)
 
     @property
     def total_genes(self) -> int:
@@ -252,6 +270,14 @@ class FeatherRankingDatabase(RankingDatabase):
         reader = FeatherReader(self._fname)
         return tuple(reader.get_column_name(idx) for idx in range(self.total_genes) if reader.get_column_name(idx) != INDEX_NAME)
 
+    @property
+    @memoize
+    def features(self) -> Tuple[str]:
+        """
+        List of regulatory features for which whole genome rankings are available in this database.
+        """
+        return tuple(FeatherReader(self._fname).read_pandas(columns=(INDEX_NAME,))[INDEX_NAME])
+
     def load_full(self) -> pd.DataFrame:
         return FeatherReader(self._fname).read_pandas().set_index(INDEX_NAME)
 
@@ -261,12 +287,13 @@ class FeatherRankingDatabase(RankingDatabase):
 
 class MemoryDecorator(RankingDatabase):
     """
-    A decorator for a ranking database which loads the entire database in memory.
+    A decorator for a ranking database which loads the entire database in memory. Rankings that are stored in a wider
+    integer datatype than needed are converted (cf. derive_rank_dtype).
     """
     def __init__(self, db: Type[RankingDatabase]):
         assert db, "Database should be supplied."
         self._db = db
-        self._df = db.load_full()
+        self._df = _as_rank_dtype(db.load_full(), db.total_genes)
         super().__init__(db.name)
 
     @property
@@ -277,6 +304,10 @@ class MemoryDecorator(RankingDatabase):
     def genes(self) -> Tuple[str]:
         return self._db.genes
 
+    @property
+    def features(self) -> Tuple[str]:
+        return tuple(self._df.index)
+
     def load_full(self) -> pd.DataFrame:
         return self._df
 
@@ -284,6 +315,144 @@ class MemoryDecorator(RankingDatabase):
         return self._df.loc[:, self._df.columns.isin(gs.genes)]
 
 
+class ColumnBlockDecorator(RankingDatabase):
+    """
+    A decorator for a ranking database which loads the rankings of a block of genes, typically the union of the genes of
+    a batch of gene signatures, in memory at once. The rankings for the individual signatures are selected from this
+    block instead of being read from the database one signature at a time.
+    """
+    def __init__(self, db: Type[RankingDatabase], gs: Type[GeneSignature]):
+        """
+        Load the block of rankings.
+
+        :param db: The ranking database.
+        :param gs: The gene signature with all genes of the block.
+        """
+        assert db, "Database should be supplied."
+        self._db = db
+        self._genes = frozenset(gs.genes)
+        self._df = db.load(gs)
+        super().__init__(db.name)
+
+    @property
+    def total_genes(self) -> int:
+        return self._db.total_genes
+
+    @property
+    def genes(self) -> Tuple[str]:
+        return self._db.genes
+
+    @property
+    def features(self) -> Tuple[str]:
+        return tuple(self._df.index)
+
+    def load_full(self) -> pd.DataFrame:
+        return self._db.load_full()
+
+    def load(self, gs: Type[GeneSignature]) -> pd.DataFrame:
+        # Signatures with genes outside of the block are loaded from the database.
+        if not self._genes.issuperset(gs.genes):
+            return self._db.load(gs)
+        return self._df.loc[:, self._df.columns.isin(gs.genes)]
+
+
+class PrefetchDecorator(RankingDatabase):
+    """
+    A decorator for a ranking database that loads the rankings for a sequence of gene signatures in a background thread,
+    so that reading from (network) storage overlaps with the calculations for the previous signatures.
+
+    The signatures must be requested in the same order as supplied. Signatures for which the rankings are not
+    requested are skipped, signatures that were not supplied are loaded from the database directly.
+    """
+    def __init__(self, db: Type[RankingDatabase], signatures: Sequence[Type[GeneSignature]], depth: int = 2):
+        """
+        Start prefetching.
+
+        :param db: The ranking database.
+        :param signatures: The gene signatures in order of use.
+        :param depth: The maximum number of signatures for which the rankings are loaded ahead.
+        """
+        assert db, "Database should be supplied."
+        assert depth > 0
+        super().__init__(db.name)
+        self._db = db
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._exhausted = False
+        # The time spent loading rankings in the background and the time the consumer waited for these rankings.
+        self.load_time, self.wait_time = 0.0, 0.0
+        self.n_hits, self.n_misses = 0, 0
+        self._thread = threading.Thread(target=self._prefetch, args=(list(signatures),), daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> None:
+        # Waiting with a timeout allows the thread to stop when the consumer is no longer interested.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _prefetch(self, signatures) -> None:
+        for gs in signatures:
+            if self._stop.is_set():
+                return
+            start = time.perf_counter()
+            try:
+                item = (gs, self._db.load(gs), None)
+            except Exception as e:
+                item = (gs, None, e)
+            self.load_time += time.perf_counter() - start
+            self._put(item)
+        self._put((None, None, None))
+
+    @property
+    def total_genes(self) -> int:
+        return self._db.total_genes
+
+    @property
+    def genes(self) -> Tuple[str]:
+        return self._db.genes
+
+    @property
+    def features(self) -> Tuple[str]:
+        return self._db.features
+
+    def load_full(self) -> pd.DataFrame:
+        return self._db.load_full()
+
+    def load(self, gs: Type[GeneSignature]) -> pd.DataFrame:
+        while not self._exhausted:
+            start = time.perf_counter()
+            prefetched_gs, df, error = self._queue.get()
+            self.wait_time += time.perf_counter() - start
+            if prefetched_gs is None:
+                self._exhausted = True
+            elif prefetched_gs is gs:
+                self.n_hits += 1
+                if error is not None:
+                    raise error
+                return df
+        self.n_misses += 1
+        return self._db.load(gs)
+
+    def close(self) -> None:
+        """
+        Stop prefetching and log the time spent waiting for rankings.
+        """
+        self._stop.set()
+        self._thread.join()
+        LOGGER.debug("Prefetching rankings from {}: {} hits and {} misses, {:.2f}s loading and {:.2f}s waiting.".format(
+            self.name, self.n_hits, self.n_misses, self.load_time, self.wait_time))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class DataFrameRankingDatabase(RankingDatabase):
     """
     A ranking database from a dataframe.
@@ -300,6 +469,10 @@ class DataFrameRankingDatabase(RankingDatabase):
     def genes(self) -> Tuple[str]:
         return tuple(self._df.columns)
 
+    @property
+    def features(self) -> Tuple[str]:
+        return tuple(self._df.index)
+
     def load_full(self) -> pd.DataFrame:
         return self._df
 
@@ -313,13 +486,15 @@ class DataFrameRankingDatabase(RankingDatabase):
         :param fname: The name of the file to create.
         """
         assert not os.path.exists(fname)
-        df = self._df.copy()
+        df = _as_rank_dtype(self._df, self.total_genes).copy()
         df.index.name = INDEX_NAME
         df.reset_index(inplace=True) # Index is not stored in feather format. https://github.com/wesm/feather/issues/200
         write_feather(df, fname)
 
 
 IDENTIFIERS_FNAME_EXTENSION = "identifiers.txt"
+# The datatype of the identifiers of the genes/regions stored in an inverted database. The rankings loaded from an
+# inverted database use the same datatype as the other databases (cf. derive_rank_dtype).
 INVERTED_DB_DTYPE = np.uint32
 
 
@@ -371,7 +546,7 @@ class InvertedRankingDatabase(RankingDatabase):
         """
         # TODO: The memory requirement of this method might be prohibitively large!
         n = len(db.genes) - db.max_rank
-        rank_unknown = np.iinfo(INVERTED_DB_DTYPE).max
+        rank_unknown = db.rank_unknown
         df = db.load(GeneSignature(name="all", gene2weight=db.genes))
         for ridx, row in df.iterrows():
             df[ridx, row == rank_unknown] = np.random.randint(low=0, high=n, size=n)
@@ -396,7 +571,7 @@ class InvertedRankingDatabase(RankingDatabase):
         self.idx2identifier = {idx: identifier for identifier, idx in self.identifier2idx.items()}
 
         # Load dataframe into memory in a format most suited for fast loading of gene signatures.
-        df = FeatherReader(fname).read().set_index(INDEX_NAME)
+        df = FeatherReader(fname).read_pandas().set_index(INDEX_NAME)
         self.max_rank = len(df.columns)
         self.features = [pd.Series(index=row.values, data=row.index, name=name) for name, row in df.iterrows()]
 
@@ -408,6 +583,14 @@ class InvertedRankingDatabase(RankingDatabase):
     def total_genes(self) -> int:
         return len(self.identifier2idx)
 
+    @property
+    def rank_unknown(self) -> int:
+        """
+        The rank number of the genes/regions that are not in the top of a feature, i.e. beyond the whole genome. These
+        never contribute to recovery curves or AUCs.
+        """
+        return self.total_genes
+
     @property
     @memoize
     def genes(self) -> Tuple[str]:
@@ -424,10 +607,10 @@ class InvertedRankingDatabase(RankingDatabase):
         raise NotImplemented
 
     def load(self, gs: Type[GeneSignature]) -> pd.DataFrame:
-        rank_unknown = np.iinfo(INVERTED_DB_DTYPE).max
         reference_identifiers = np.array([self.identifier2idx[identifier] for identifier in gs.genes])
-        return pd.concat([col.reindex(index=reference_identifiers, fill_value=rank_unknown) for col in self.features],
-                         axis=1).T.astype(INVERTED_DB_DTYPE).rename(columns=self.idx2identifier)
+        return pd.concat([col.reindex(index=reference_identifiers, fill_value=self.rank_unknown)
+                          for col in self.features], axis=1).T\
+            .astype(derive_rank_dtype(self.total_genes + 1)).rename(columns=self.idx2identifier)
 
 
 def convert2feather(fname: str, out_folder: str, name: str, extension: str="feather") -> str:
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+from typing import Type, Sequence, Tuple
+from boltons.iterutils import chunked
+from .rnkdb import RankingDatabase, derive_rank_dtype
+from .genesig import GeneSignature
+from .recovery import derive_rank_cutoff, auc2d
+
+
+__all__ = ["AUCNullIndex", "TopRankIndex"]
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+AUC_NULL_INDEX_FNAME_EXTENSION = "aucnull.npz"
+TOP_RANK_INDEX_FNAME_EXTENSION = "toprank.npz"
+
+# The signature sizes for which the ratio between the actual standard deviation of the AUCs and the one derived under
+# the assumption of independent genes is estimated.
+CALIBRATION_SIZES = (10, 20, 50, 100, 200, 500, 1000, 2000)
+
+
+def _contributions(rankings: np.ndarray, rank_cutoff: int) -> np.ndarray:
+    """
+    The contribution of each gene to the unnormalized AUC of a feature: (rank_cutoff - rank) if the gene is ranked
+    below the cutoff, zero otherwise.
+    """
+    return np.maximum(rank_cutoff - rankings.astype(np.int64), 0).astype(np.float64)
+
+
+class AUCNullIndex:
+    """
+    Per-gene statistics of the contribution to the AUC across all features of a ranking database.
+
+    The unnormalized AUC of a feature is the weighted sum over the genes of a signature of (rank_cutoff - rank) for the
+    genes that are ranked below the cutoff. Therefore the mean AUC over all features can be calculated exactly from the
+    mean contribution of each gene. The standard deviation is approximated by assuming independence between genes and
+    correcting this estimate with a factor that depends on the size of the signature (estimated on random signatures
+    when creating the index).
+
+    Using this index is an approximation: the NES of a feature is derived from the exact mean and the estimated
+    standard deviation so the set of enriched features can differ from the one obtained by calculating the AUCs of all
+    features. The rankings of the signature still need to be loaded for all features, therefore the speedup is limited
+    to skipping the calculation of the AUCs of features that cannot reach the NES threshold. Use TopRankIndex for an
+    exact and I/O-efficient alternative.
+    """
+
+    @classmethod
+    def derive_fname(cls, db_fname: str) -> str:
+        """
+        The name of the index file stored alongside the database.
+        """
+        return '{}.{}'.format(os.path.splitext(db_fname)[0], AUC_NULL_INDEX_FNAME_EXTENSION)
+
+    @classmethod
+    def create(cls, db: Type[RankingDatabase], auc_threshold: float = 0.05,
+               n_samples: int = 20, block_size: int = 1000, seed: int = 42) -> 'AUCNullIndex':
+        """
+        Create an index for a ranking database.
+
+        :param db: The ranking database.
+        :param auc_threshold: The fraction of the ranked genome to take into account for the calculation of the
+            Area Under the recovery Curve.
+        :param n_samples: The number of random signatures per size used to calibrate the standard deviation.
+        :param block_size: The number of genes loaded from the database at once.
+        :param seed: The seed of the random number generator.
+        :return: The index.
+        """
+        rank_cutoff = derive_rank_cutoff(auc_threshold, db.total_genes)
+
+        genes, means, variances = [], [], []
+        for idx, block in enumerate(chunked(db.genes, block_size)):
+            df = db.load(GeneSignature(name="block{}".format(idx), gene2weight=block))
+            contributions = _contributions(df.values, rank_cutoff)
+            genes.extend(df.columns.values)
+            means.append(contributions.mean(axis=0))
+            variances.append(contributions.var(axis=0))
+        genes = np.asarray(genes)
+        means, variances = np.concatenate(means), np.concatenate(variances)
+        gene2idx = {gene: idx for idx, gene in enumerate(genes)}
+
+        rs = np.random.RandomState(seed=seed)
+        sizes = np.array([size for size in CALIBRATION_SIZES if size < len(genes)])
+        ratios = np.empty(shape=(len(sizes),), dtype=np.float64)
+        for size_idx, size in enumerate(sizes):
+            estimates = []
+            for sample_idx in range(n_samples):
+                sample = rs.choice(genes, size=size, replace=False)
+                df = db.load(GeneSignature(name="sample{}".format(sample_idx), gene2weight=list(map(str, sample))))
+                actual_std = auc2d(df.values, np.ones(len(df.columns)), rank_cutoff, 1.0).std()
+                idx = np.array([gene2idx[gene] for gene in df.columns.values])
+                estimated_std = np.sqrt(variances[idx].sum())
+                if estimated_std > 0:
+                    estimates.append(actual_std / estimated_std)
+            ratios[size_idx] = np.mean(estimates) if estimates else 1.0
+
+        return AUCNullIndex(db.name, rank_cutoff, genes, means, variances, sizes, ratios)
+
+    @classmethod
+    def load(cls, fname: str) -> 'AUCNullIndex':
+        """
+        Load an index from disk.
+
+        :param fname: The name of the index file.
+        :return: The index.
+        """
+        assert os.path.isfile(fname), "Index {0:s} doesn't exist.".format(fname)
+        with np.load(fname) as data:
+            return AUCNullIndex(str(data['name']), int(data['rank_cutoff']), data['genes'],
+                                data['means'], data['variances'], data['sizes'], data['ratios'])
+
+    def __init__(self, name: str, rank_cutoff: int, genes: np.ndarray, means: np.ndarray, variances: np.ndarray,
+                 sizes: np.ndarray, ratios: np.ndarray):
+        """
+        Create a new index.
+
+        :param name: The name of the database.
+        :param rank_cutoff: The rank cutoff used for the calculation of the AUC.
+        :param genes: The genes of the database.
+        :param means: The mean contribution of each gene to the unnormalized AUC across all features.
+        :param variances: The variance of the contribution of each gene.
+        :param sizes: The signature sizes for which a correction ratio for the standard deviation is available.
+        :param ratios: The correction ratios.
+        """
+        self.name = name
+        self.rank_cutoff = rank_cutoff
+        self.genes = genes
+        self.means = means
+        self.variances = variances
+        self.sizes = sizes
+        self.ratios = ratios
+        self.gene2idx = {gene: idx for idx, gene in enumerate(genes)}
+
+    def save(self, fname: str) -> None:
+        """
+        Save index to disk.
+
+        :param fname: The name of the file to create.
+        """
+        assert not os.path.exists(fname), "{} already exists.".format(fname)
+        with open(fname, 'wb') as f:
+            np.savez(f, name=self.name, rank_cutoff=self.rank_cutoff, genes=self.genes,
+                     means=self.means, variances=self.variances, sizes=self.sizes, ratios=self.ratios)
+
+    def null_distribution(self, genes: Sequence[str], weights: np.ndarray) -> Tuple[float, float]:
+        """
+        The mean and (approximated) standard deviation of the unnormalized AUCs over all features.
+
+        :param genes: The genes of the signature.
+        :param weights: The weights of these genes.
+        :return: A tuple with mean and standard deviation.
+        """
+        idx = np.array([self.gene2idx[gene] for gene in genes])
+        mean = float(np.dot(weights, self.means[idx]))
+        ratio = float(np.interp(len(genes), self.sizes, self.ratios)) if len(self.sizes) else 1.0
+        std = ratio * float(np.sqrt(np.dot(weights ** 2, self.variances[idx])))
+        return mean, std
+
+    def enrichment(self, rnk: pd.DataFrame, weights: np.ndarray, nes_threshold: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Calculate AUCs and NESs for the features in the supplied rankings dataframe using the precomputed null
+        distribution. Exact AUCs are only calculated for features whose maximum achievable AUC reaches the NES threshold.
+        The AUC and NES of the other features are set to NaN and minus infinity respectively. The NESs are approximations
+        because the standard deviation of the null distribution is estimated (cf. null_distribution).
+
+        :param rnk: A dataframe containing the rank number of genes of interest. Columns correspond to genes.
+        :param weights: The weights associated with the selected genes.
+        :param nes_threshold: The Normalized Enrichment Score (NES) threshold to select enriched features.
+        :return: A tuple with the AUCs and NESs.
+        """
+        genes, rankings = rnk.columns.values, rnk.values
+        maxauc = float((self.rank_cutoff + 1) * weights.sum())
+        assert maxauc > 0
+        mean, std = self.null_distribution(genes, weights)
+        threshold = mean + nes_threshold * std
+
+        # The maximum AUC for a feature with n genes ranked below the cutoff is reached when these are the genes with
+        # the highest weights and all are ranked at the top.
+        n_recovered = (rankings < self.rank_cutoff).sum(axis=1)
+        max_aucs = self.rank_cutoff * np.concatenate([[0.0], np.cumsum(np.sort(weights)[::-1])])[n_recovered]
+        candidates = max_aucs >= threshold
+
+        aucs = np.full(shape=(len(rankings),), fill_value=np.nan)
+        ness = np.full(shape=(len(rankings),), fill_value=-np.inf)
+        if candidates.any():
+            raw_aucs = auc2d(rankings[candidates, :], weights, self.rank_cutoff, 1.0)
+            aucs[candidates] = raw_aucs / maxauc
+            ness[candidates] = (raw_aucs - mean) / std if std > 0 else 0.0
+        return aucs, ness
+
+
+def _derive_index_dtype(n):
+    """ Derive datatype for storing indexes in a set of a given length. """
+    return np.uint16 if n <= 2**16 else np.uint32
+
+
+class TopRankIndex:
+    """
+    An index of the genes that are ranked at the top of each feature in a ranking database.
+
+    The AUC of a feature only depends on the genes that are ranked below the rank cutoff (typically 5% of the genome).
+    For each gene this index stores the features for which the gene is ranked below a certain depth together with that
+    rank (posting lists). The AUCs of all features for a signature are calculated by only visiting the postings of the
+    genes in the signature, i.e. only the ranks of the genes that intersect with the top of a feature are touched.
+    When the depth of the index is not smaller than the rank threshold used for recovery curves, the index can also
+    replace the database for loading rankings.
+    """
+
+    @classmethod
+    def derive_fname(cls, db_fname: str) -> str:
+        """
+        The name of the index file stored alongside the database.
+        """
+        return '{}.{}'.format(os.path.splitext(db_fname)[0], TOP_RANK_INDEX_FNAME_EXTENSION)
+
+    @classmethod
+    def create(cls, db: Type[RankingDatabase], depth: int = 5000, block_size: int = 1000) -> 'TopRankIndex':
+        """
+        Create an index for a ranking database.
+
+        :param db: The ranking database.
+        :param depth: The number of top ranked genes to keep for each feature.
+        :param block_size: The number of genes loaded from the database at once.
+        :return: The index.
+        """
+        assert 0 < depth < db.total_genes, "Depth must be an integer between 1 and {0:d}".format(db.total_genes)
+
+        features, genes, counts, feature_idx, ranks = None, [], [], [], []
+        for idx, block in enumerate(chunked(db.genes, block_size)):
+            df = db.load(GeneSignature(name="block{}".format(idx), gene2weight=block))
+            features = df.index.values.astype(str)
+            # Transposing makes sure the postings are sorted by gene.
+            rankings = df.values.T
+            mask = rankings < depth
+            genes.extend(df.columns.values)
+            counts.append(mask.sum(axis=1))
+            feature_idx.append(np.nonzero(mask)[1].astype(_derive_index_dtype(len(features))))
+            ranks.append(rankings[mask].astype(derive_rank_dtype(depth)))
+        indptr = np.concatenate([[0], np.cumsum(np.concatenate(counts))]).astype(np.int64)
+
+        return TopRankIndex(db.name, db.total_genes, depth, features, np.asarray(genes), indptr,
+                            np.concatenate(feature_idx), np.concatenate(ranks))
+
+    @classmethod
+    def load(cls, fname: str) -> 'TopRankIndex':
+        """
+        Load an index from disk.
+
+        :param fname: The name of the index file.
+        :return: The index.
+        """
+        assert os.path.isfile(fname), "Index {0:s} doesn't exist.".format(fname)
+        with np.load(fname) as data:
+            return TopRankIndex(str(data['name']), int(data['total_genes']), int(data['depth']),
+                                data['features'], data['genes'], data['indptr'], data['feature_idx'], data['ranks'])
+
+    def __init__(self, name: str, total_genes: int, depth: int, features: np.ndarray, genes: np.ndarray,
+                 indptr: np.ndarray, feature_idx: np.ndarray, ranks: np.ndarray):
+        """
+        Create a new index.
+
+        :param name: The name of the database.
+        :param total_genes: The total number of genes ranked in the database.
+        :param depth: The number of top ranked genes kept for each feature.
+        :param features: The features of the database.
+        :param genes: The genes of the database.
+        :param indptr: The offsets of the postings of each gene (n_genes + 1).
+        :param feature_idx: The feature of each posting.
+        :param ranks: The rank of the gene for the feature of each posting.
+        """
+        self.name = name
+        self.total_genes = total_genes
+        self.depth = depth
+        self.features = features
+        self.genes = genes
+        self.indptr = indptr
+        self.feature_idx = feature_idx
+        self.ranks = ranks
+        self.gene2idx = {gene: idx for idx, gene in enumerate(genes)}
+
+    def save(self, fname: str) -> None:
+        """
+        Save index to disk.
+
+        :param fname: The name of the file to create.
+        """
+        assert not os.path.exists(fname), "{} already exists.".format(fname)
+        with open(fname, 'wb') as f:
+            np.savez(f, name=self.name, total_genes=self.total_genes, depth=self.depth, features=self.features,
+                     genes=self.genes, indptr=self.indptr, feature_idx=self.feature_idx, ranks=self.ranks)
+
+    def genes_of(self, gs: Type[GeneSignature]) -> np.ndarray:
+        """
+        The genes of a signature that are ranked in the database.
+        """
+        return np.array([gene for gene in gs.genes if gene in self.gene2idx])
+
+    def _postings(self, genes: Sequence[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Gather the postings for the supplied genes.
+
+        :return: A tuple with the position of the gene in the supplied sequence, the feature index and the rank.
+        """
+        idx = np.array([self.gene2idx[gene] for gene in genes], dtype=np.int64)
+        starts, lengths = self.indptr[idx], self.indptr[idx + 1] - self.indptr[idx]
+        gene_pos = np.repeat(np.arange(len(idx)), lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        positions = np.repeat(starts, lengths) + offsets
+        return gene_pos, self.feature_idx[positions], self.ranks[positions]
+
+    def aucs(self, genes: Sequence[str], weights: np.ndarray, auc_threshold: float) -> np.ndarray:
+        """
+        Calculate AUCs for all features.
+
+        :param genes: The genes of the signature (must be ranked in the database).
+        :param weights: The weights associated with these genes.
+        :param auc_threshold: The fraction of the ranked genome to take into account for the calculation of the
+            Area Under the recovery Curve.
+        :return: An array with the AUCs.
+        """
+        rank_cutoff = derive_rank_cutoff(auc_threshold, self.total_genes)
+        assert rank_cutoff <= self.depth, "The depth of the index is too small for an AUC threshold of {0:f}.".format(auc_threshold)
+        # For reason of generating the same results as in R we introduce an error by adding one to the rank_cutoff
+        # for calculationg the maximum AUC (cf. pyscenic.recovery.aucs).
+        maxauc = float((rank_cutoff+1) * weights.sum())
+        assert maxauc > 0
+        gene_pos, feature_idx, ranks = self._postings(genes)
+        contributions = weights[gene_pos] * np.maximum(rank_cutoff - ranks.astype(np.int64), 0)
+        return np.bincount(feature_idx, weights=contributions, minlength=len(self.features)) / maxauc
+
+    def rankings(self, gs: Type[GeneSignature]) -> pd.DataFrame:
+        """
+        Load the ranking of the genes in the supplied signature for all features in the database. Genes that are not
+        part of the top of a feature get a rank equal to the depth of this index.
+
+        :param gs: The gene signature.
+        :return: A dataframe.
+        """
+        genes = self.genes_of(gs)
+        rankings = np.full(shape=(len(self.features), len(genes)), fill_value=self.depth,
+                           dtype=derive_rank_dtype(self.depth + 1))
+        gene_pos, feature_idx, ranks = self._postings(genes)
+        rankings[feature_idx, gene_pos] = ranks
+        return pd.DataFrame(index=self.features, columns=genes, data=rankings)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+import json
+import attr
+import heapq
+import psutil
+import logging
+import numpy as np
+from math import ceil
+from multiprocessing import cpu_count
+from typing import Type, Sequence, Tuple, List, Mapping, Optional, Dict
+
+from .rnkdb import RankingDatabase
+from .genesig import GeneSignature
+
+
+__all__ = ['CostModel', 'lpt_partition', 'load_imbalance', 'balanced_chunks', 'assign_databases', 'ExecutionPlan',
+           'plan_execution']
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+# The fixed cost of processing a module (e.g. deriving the leading edge and annotating the enriched features) expressed
+# as the equivalent number of genes that are loaded from a database.
+FIXED_COST_IN_GENES = 50
+
+# The memory reserved for each worker process or thread, i.e. for the interpreter, the motif annotations and the enriched
+# features of a chunk of modules.
+WORKER_OVERHEAD = 256 * (1 << 20)
+
+# The modes of execution for which the memory needed can be planned, i.e. on the local machine.
+LOCAL_MODES = frozenset(['custom_multiprocessing', 'dask_multiprocessing', 'threaded'])
+
+
+class CostModel:
+    """
+    A model of the cost of processing modules for a ranking database.
+
+    The cost of a module is proportional to the number of rankings loaded from the database, i.e. the number of genes of
+    the module (plus a fixed overhead) times the number of features of the database. Because the number of features is
+    not known for all types of databases, the factor of each database is estimated from observed timings and defaults
+    to one for databases that were not observed yet.
+    """
+
+    @classmethod
+    def load(cls, fname: str) -> 'CostModel':
+        """
+        Load a cost model from a JSON file.
+        """
+        with open(fname, 'r') as f:
+            data = json.load(f)
+        return CostModel(data['seconds'], data['units'])
+
+    def __init__(self, seconds: Optional[Mapping[str, float]] = None, units: Optional[Mapping[str, float]] = None):
+        """
+        Create a new cost model.
+
+        :param seconds: A mapping from database name to the total time observed for processing modules.
+        :param units: A mapping from database name to the total number of cost units (cf. cost_units) of these modules.
+        """
+        self.seconds = dict(seconds) if seconds else dict()
+        self.units = dict(units) if units else dict()
+
+    def save(self, fname: str) -> None:
+        with open(fname, 'w') as f:
+            json.dump({'seconds': self.seconds, 'units': self.units}, f, indent=1)
+
+    @staticmethod
+    def cost_units(modules: Sequence[Type[GeneSignature]]) -> float:
+        """
+        The number of cost units of a sequence of modules, independent of the database.
+        """
+        return float(sum(FIXED_COST_IN_GENES + len(module) for module in modules))
+
+    def factor(self, db_name: str) -> float:
+        """
+        The estimated time needed for a single cost unit for a database.
+        """
+        # Databases for which no timings are available get the average factor of the other databases.
+        if db_name in self.units and self.units[db_name] > 0:
+            return self.seconds[db_name] / self.units[db_name]
+        factors = [self.seconds[name] / self.units[name] for name in self.units if self.units[name] > 0]
+        return float(np.mean(factors)) if factors else 1.0
+
+    def cost(self, db: Type[RankingDatabase], modules: Sequence[Type[GeneSignature]]) -> float:
+        """
+        The estimated cost of processing a sequence of modules for a database.
+        """
+        return self.factor(db.name) * self.cost_units(modules)
+
+    def observe(self, db_name: str, modules: Sequence[Type[GeneSignature]], seconds: float) -> None:
+        """
+        Update the model with the observed time for processing a sequence of modules for a database.
+        """
+        self.seconds[db_name] = self.seconds.get(db_name, 0.0) + seconds
+        self.units[db_name] = self.units.get(db_name, 0.0) + self.cost_units(modules)
+
+
+def lpt_partition(costs: Sequence[float], n_bins: int) -> List[List[int]]:
+    """
+    Partition items in a number of bins with approximately the same total cost using the Longest-Processing-Time-first
+    rule: items are assigned in order of decreasing cost to the bin with the lowest total cost so far.
+
+    :param costs: The cost of each item.
+    :param n_bins: The number of bins.
+    :return: The indices of the items for each non-empty bin.
+    """
+    assert n_bins > 0
+    bins = [[] for _ in range(n_bins)]
+    heap = [(0.0, idx) for idx in range(n_bins)]
+    for item_idx in np.argsort(-np.asarray(costs, dtype=np.float64), kind='mergesort'):
+        load, bin_idx = heapq.heappop(heap)
+        bins[bin_idx].append(int(item_idx))
+        heapq.heappush(heap, (load + costs[item_idx], bin_idx))
+    return [b for b in bins if b]
+
+
+def load_imbalance(loads: Sequence[float]) -> float:
+    """
+    The load imbalance of a set of bins: the ratio between the maximum and the mean load (1.0 is perfectly balanced).
+    """
+    loads = np.asarray(loads, dtype=np.float64)
+    return float(loads.max() / loads.mean()) if len(loads) and loads.mean() > 0 else 1.0
+
+
+def balanced_chunks(db: Type[RankingDatabase], modules: Sequence[Type[GeneSignature]], n_chunks: int,
+                    cost_model: CostModel) -> Tuple[List[List[Type[GeneSignature]]], float, float]:
+    """
+    Split modules in chunks with approximately the same estimated cost for a database.
+
+    :param db: The ranking database.
+    :param modules: The modules.
+    :param n_chunks: The number of chunks.
+    :param cost_model: The cost model.
+    :return: A tuple with the chunks (in order of decreasing cost), the load imbalance of chunks of equal size and the
+        load imbalance of the balanced chunks.
+    """
+    n_chunks = max(1, min(n_chunks, len(modules)))
+    costs = [cost_model.cost(db, [module]) for module in modules]
+    chunksize = int(ceil(len(modules) / float(n_chunks)))
+    before = load_imbalance([sum(costs[idx:idx + chunksize]) for idx in range(0, len(modules), chunksize)])
+    partition = lpt_partition(costs, n_chunks)
+    loads = [sum(costs[idx] for idx in b) for b in partition]
+    # Processing the most expensive chunks first reduces the makespan when there are more chunks than workers.
+    partition = [partition[idx] for idx in np.argsort(-np.asarray(loads), kind='mergesort')]
+    return [[modules[idx] for idx in b] for b in partition], before, load_imbalance(loads)
+
+
+def assign_databases(db_names: Sequence[str], workers: Sequence[str],
+                     replication: Optional[Mapping[str, int]] = None) -> Dict[str, List[str]]:
+    """
+    Assign the workers of a cluster to databases so that each worker only needs a few databases in memory.
+
+    Each database is assigned to a number of workers (its replication factor, one by default) with the least number of
+    databases assigned so far, starting with the databases with the highest replication factor. Workers that end up
+    without a database are added as extra replicas to the databases in that same order.
+
+    :param db_names: The names of the databases.
+    :param workers: The addresses of the workers.
+    :param replication: A mapping from database name to the number of workers for that database. Frequently used
+        databases can be replicated across more workers.
+    :return: A mapping from database name to the addresses of the workers assigned to that database.
+    """
+    assert workers, "No workers available."
+    replication = replication if replication else dict()
+    n_replicas = {name: max(1, min(len(workers), replication.get(name, 1))) for name in db_names}
+    order = sorted(db_names, key=lambda name: -n_replicas[name])
+    worker2dbs = {worker: [] for worker in workers}
+    db2workers = {name: [] for name in db_names}
+    for name in order:
+        # Python's sort is stable so ties are broken by the order of the workers.
+        for worker in sorted(workers, key=lambda w: len(worker2dbs[w]))[:n_replicas[name]]:
+            worker2dbs[worker].append(name)
+            db2workers[name].append(worker)
+    idle_workers = [worker for worker in workers if not worker2dbs[worker]]
+    for idx, worker in enumerate(idle_workers):
+        db2workers[order[idx % len(order)]].append(worker)
+    return db2workers
+
+
+def database_shape(db: Type[RankingDatabase]) -> Tuple[int, int, int]:
+    """
+    The shape of a ranking database without loading all its rankings.
+
+    :return: A tuple with the number of features, the number of genes and the size in bytes of a single rank.
+    """
+    df = db.load(GeneSignature(name="shape", gene2weight=[db.genes[0]]))
+    return len(df), db.total_genes, df.values.dtype.itemsize
+
+
+def module_memory(n_features: int, n_genes: int, itemsize: int, rank_threshold: int,
+                  prefetch: int = 0, batch_genes: int = 0, incremental=False) -> int:
+    """
+    The estimated peak memory in bytes needed for finding the enriched features of a single module.
+
+    The rankings of the genes of the module are loaded from the database and copied when converted to an array. The
+    recovery curves of all features are float64 arrays, a temporary array of the same size is needed for deriving their
+    standard deviation.
+
+    :param n_features: The number of features of the database.
+    :param n_genes: The number of genes of the module.
+    :param itemsize: The size in bytes of a single rank.
+    :param rank_threshold: The total number of ranked genes to take into account when creating a recovery curve.
+    :param prefetch: The number of modules (or batches) for which the rankings are loaded ahead (cf. modules2df).
+    :param batch_genes: The maximum number of genes loaded at once for a batch of modules (cf. modules2df).
+    :param incremental: The rankings and recovery curves of the previous module are kept (cf. modules2df).
+    """
+    rankings = n_features * n_genes * itemsize
+    rccs = n_features * rank_threshold * 8
+    memory = 2 * rankings + 2 * rccs
+    if batch_genes > 0:
+        memory += n_features * batch_genes * itemsize
+    memory += prefetch * n_features * max(n_genes, batch_genes) * itemsize
+    if incremental:
+        memory += rankings + rccs
+    return memory
+
+
+def available_memory() -> int:
+    """
+    The memory in bytes that is available for starting new processes without swapping.
+    """
+    return psutil.virtual_memory().available
+
+
+@attr.s
+class ExecutionPlan:
+    """
+    The execution of a calculation on the local machine that fits in a memory budget (cf. plan_execution).
+    """
+    num_workers = attr.ib()  # int
+    module_chunksize = attr.ib()  # int
+    in_memory = attr.ib()  # bool: the workers load the databases in memory instead of streaming the rankings.
+    memory = attr.ib()  # int: the estimated peak memory in bytes.
+    memory_budget = attr.ib()  # int
+
+    def __str__(self):
+        return "{} workers, chunks of {} modules and {} databases (estimated peak memory of {:.1f} GB for a budget " \
+               "of {:.1f} GB)".format(self.num_workers, self.module_chunksize,
+                                      "in-memory" if self.in_memory else "streamed",
+                                      self.memory / float(1 << 30), self.memory_budget / float(1 << 30))
+
+
+def plan_execution(rnkdbs: Sequence[Type[RankingDatabase]], modules: Sequence[Type[GeneSignature]],
+                   rank_threshold: int, memory_budget: Optional[int] = None,
+                   client_or_address='dask_multiprocessing', num_workers: Optional[int] = None,
+                   module_chunksize: int = 100, prefetch: int = 0, batch_genes: int = 0,
+                   incremental=False) -> ExecutionPlan:
+    """
+    Choose the number of workers, the size of the chunks of modules and whether the databases are loaded in memory so
+    that the calculation fits in a memory budget.
+
+    The custom multiprocessing mode loads a copy of the database in memory for each worker process and the threaded mode
+    shares a single copy between its threads, whereas the dask multiprocessing mode streams the rankings of each module
+    from storage. When the requested number of workers does not fit the budget, the plan with the most workers is
+    chosen: either fewer workers with the databases in memory or, when that allows for more workers, streaming the
+    rankings. The chunk size is capped so that each worker gets at least one chunk of modules for every database.
+
+    :param rnkdbs: The ranking databases.
+    :param modules: The modules.
+    :param rank_threshold: The total number of ranked genes to take into account when creating a recovery curve.
+    :param memory_budget: The memory budget in bytes (default: the available memory of the machine).
+    :param client_or_address: The mode of execution, i.e. 'custom_multiprocessing', 'dask_multiprocessing' or
+        'threaded'.
+    :param num_workers: The requested number of workers (default: the number of CPUs).
+    :param module_chunksize: The requested number of modules per chunk.
+    :param prefetch: The number of modules for which the rankings are loaded ahead (cf. modules2df).
+    :param batch_genes: The maximum number of genes loaded at once for a batch of modules (cf. modules2df).
+    :param incremental: The enrichment is calculated incrementally for nested modules (cf. modules2df).
+    :return: The plan.
+    :raises ValueError: When a single worker streaming the rankings does not fit the budget.
+    """
+    assert client_or_address in LOCAL_MODES, "Only the execution on the local machine can be planned."
+    assert rnkdbs and modules
+    memory_budget = int(memory_budget) if memory_budget is not None else available_memory()
+    num_workers = num_workers if num_workers else cpu_count()
+    n_genes = max(map(len, modules))
+    shapes = {db.name: database_shape(db) for db in rnkdbs}
+    db_memory = {name: n_features * n_total_genes * itemsize
+                 for name, (n_features, n_total_genes, itemsize) in shapes.items()}
+    worker_memory = {name: WORKER_OVERHEAD + module_memory(n_features, n_genes, itemsize, rank_threshold,
+                                                           prefetch, batch_genes, incremental)
+                     for name, (n_features, _, itemsize) in shapes.items()}
+
+    def memory(n_workers: int, in_memory: bool) -> int:
+        if client_or_address == 'custom_multiprocessing':
+            # Each worker process is dedicated to a single database.
+            n_workers_per_db = n_workers // len(rnkdbs)
+            return n_workers_per_db * sum(worker_memory[name] + (db_memory[name] if in_memory else 0)
+                                          for name in shapes.keys())
+        # The databases are processed one at a time.
+        shared_memory = max(db_memory.values()) if in_memory else 0
+        return n_workers * max(worker_memory.values()) + shared_memory
+
+    if client_or_address == 'custom_multiprocessing':
+        # The number of workers is a multiple of the number of databases.
+        candidates = [n * len(rnkdbs) for n in range(max(1, num_workers // len(rnkdbs)), 0, -1)]
+    else:
+        candidates = list(range(num_workers, 0, -1))
+    plans = []
+    for in_memory in ([True, False] if client_or_address != 'dask_multiprocessing' else [False]):
+        n_workers = next((n for n in candidates if memory(n, in_memory) <= memory_budget), None)
+        if n_workers is not None:
+            plans.append(ExecutionPlan(num_workers=n_workers,
+                                       module_chunksize=max(1, min(module_chunksize,
+                                                                   int(ceil(len(modules) / float(n_workers))))),
+                                       in_memory=in_memory, memory=memory(n_workers, in_memory),
+                                       memory_budget=memory_budget))
+    if not plans:
+        raise ValueError("A single worker needs an estimated {:.1f} GB which exceeds the memory budget of {:.1f} GB. "
+                         "Reduce the rank threshold, the size of the modules or the databases.".format(
+                            memory(candidates[-1], False) / float(1 << 30), memory_budget / float(1 << 30)))
+    # Plans with the databases in memory come first and are preferred for the same number of workers.
+    plan = max(plans, key=lambda p: p.num_workers)
+    if plan.num_workers < num_workers or (not plan.in_memory and client_or_address != 'dask_multiprocessing'):
+        LOGGER.warning("The requested execution does not fit the memory budget, using {}.".format(plan))
+    return plan
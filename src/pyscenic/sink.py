@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pandas as pd
+import pyarrow.parquet as pq
+from typing import Iterator, Optional, Sequence
+
+from .arrow import enriched_motifs2table, table2enriched_motifs
+from .transform import DF_META_DATA
+
+
+__all__ = ['iter_enriched_motifs', 'CSVSink', 'ParquetSink', 'open_sink']
+
+
+def iter_enriched_motifs(fname: str) -> Iterator[pd.DataFrame]:
+    """
+    Iterate over the row groups of a Parquet file with enriched motifs.
+
+    :param fname: The name of the Parquet file.
+    :return: An iterator of dataframes with enriched motifs.
+    """
+    f = pq.ParquetFile(fname)
+    for idx in range(f.num_row_groups):
+        yield table2enriched_motifs(f.read_row_group(idx))
+
+
+class Sink:
+    """
+    A sink consumes the enriched motifs of each chunk of modules as soon as they are available.
+
+    When used as a context manager, the sink is closed when no exception occurred. Otherwise the partially written file
+    is discarded.
+    """
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.columns = None  # type: Optional[Sequence]
+        self.n_rows = 0
+
+    def __call__(self, df: pd.DataFrame) -> None:
+        if len(df) == 0:
+            return
+        # The layout is derived from the first chunk. All other chunks must have the same layout.
+        if self.columns is None:
+            self.columns = df.columns
+            self._write_first(df)
+        else:
+            self._append(df[self.columns])
+        self.n_rows += len(df)
+
+    def _write_first(self, df: pd.DataFrame) -> None:
+        raise NotImplementedError
+
+    def _append(self, df: pd.DataFrame) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """
+        Finalize the file. An empty table is written when no enriched motifs were consumed.
+        """
+        raise NotImplementedError
+
+    def discard(self) -> None:
+        """
+        Stop writing and remove the partially written file.
+        """
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class CSVSink(Sink):
+    """
+    A sink that appends the enriched motifs of each chunk to a CSV or TSV file.
+    """
+    def __init__(self, fname: str, sep: str = ','):
+        super().__init__(fname)
+        self.sep = sep
+
+    def _write_first(self, df: pd.DataFrame) -> None:
+        df.to_csv(self.fname, sep=self.sep, mode='w')
+
+    def _append(self, df: pd.DataFrame) -> None:
+        df.to_csv(self.fname, sep=self.sep, mode='a', header=False)
+
+    def close(self) -> None:
+        if self.columns is None:
+            DF_META_DATA.to_csv(self.fname, sep=self.sep)
+
+
+class ParquetSink(Sink):
+    """
+    A sink that writes the enriched motifs of each chunk as a separate row group to a Parquet file.
+    """
+    def __init__(self, fname: str):
+        super().__init__(fname)
+        self.writer = None  # type: Optional[pq.ParquetWriter]
+
+    def _write_first(self, df: pd.DataFrame) -> None:
+        table = enriched_motifs2table(df)
+        self.writer = pq.ParquetWriter(self.fname, table.schema)
+        self.writer.write_table(table)
+
+    def _append(self, df: pd.DataFrame) -> None:
+        self.writer.write_table(enriched_motifs2table(df))
+
+    def close(self) -> None:
+        if self.writer is None:
+            pq.write_table(enriched_motifs2table(DF_META_DATA), self.fname)
+        else:
+            self.writer.close()
+            self.writer = None
+
+    def discard(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        super().discard()
+
+
+def open_sink(fname: str) -> Sink:
+    """
+    Create a sink for streaming enriched motifs to disk.
+
+    Supported file formats are CSV, TSV and Parquet.
+
+    :param fname: The name of the file to write to.
+    :return: The sink.
+    """
+    extension = os.path.splitext(fname)[1].lower()
+    if extension == '.csv':
+        return CSVSink(fname, sep=',')
+    elif extension == '.tsv':
+        return CSVSink(fname, sep='\t')
+    elif extension == '.parquet':
+        return ParquetSink(fname)
+    else:
+        raise ValueError("Unknown file format \"{}\".".format(fname))
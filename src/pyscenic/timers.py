@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import numpy as np
+from contextlib import contextmanager
+from typing import Dict, Optional, Mapping
+
+
+__all__ = ['PhaseTimings', 'phase', 'collect_phases']
+
+
+# The upper bounds in seconds of the bins of the histograms: four bins per decade from a microsecond to 1000 seconds.
+# Longer durations are counted in an additional last bin.
+BIN_EDGES = np.logspace(-6, 3, 37)
+
+
+class PhaseTimings:
+    """
+    Histograms of the time spent in the phases of a calculation (e.g. loading rankings, calculating AUCs), aggregated
+    over all occurrences of each phase. Timings collected by different workers are combined via merge.
+    """
+    def __init__(self):
+        self.counts = dict()  # type: Dict[str, int]
+        self.seconds = dict()  # type: Dict[str, float]
+        self.max_seconds = dict()  # type: Dict[str, float]
+        self.histograms = dict()  # type: Dict[str, np.ndarray]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, name: str, seconds: float) -> None:
+        """
+        Record a single occurrence of a phase.
+        """
+        if name not in self.counts:
+            self.counts[name], self.seconds[name], self.max_seconds[name] = 0, 0.0, 0.0
+            self.histograms[name] = np.zeros(len(BIN_EDGES) + 1, dtype=np.int64)
+        self.counts[name] += 1
+        self.seconds[name] += seconds
+        self.max_seconds[name] = max(self.max_seconds[name], seconds)
+        self.histograms[name][np.searchsorted(BIN_EDGES, seconds)] += 1
+
+    def merge(self, other: Optional['PhaseTimings']) -> 'PhaseTimings':
+        """
+        Add the timings of another instance (e.g. collected by a worker) to this one.
+        """
+        if other is None:
+            return self
+        for name in other.counts.keys():
+            if name not in self.counts:
+                self.counts[name], self.seconds[name], self.max_seconds[name] = 0, 0.0, 0.0
+                self.histograms[name] = np.zeros(len(BIN_EDGES) + 1, dtype=np.int64)
+            self.counts[name] += other.counts[name]
+            self.seconds[name] += other.seconds[name]
+            self.max_seconds[name] = max(self.max_seconds[name], other.max_seconds[name])
+            self.histograms[name] += other.histograms[name]
+        return self
+
+    def percentile(self, name: str, q: float) -> float:
+        """
+        The approximate percentile of the duration of a phase, i.e. the upper bound of the bin it falls in.
+        """
+        cumulative = np.cumsum(self.histograms[name])
+        idx = int(np.searchsorted(cumulative, q / 100.0 * cumulative[-1]))
+        return float(BIN_EDGES[idx]) if idx < len(BIN_EDGES) else self.max_seconds[name]
+
+    def report(self) -> Mapping[str, Mapping[str, object]]:
+        """
+        The statistics of each phase as a JSON serializable mapping.
+        """
+        return {name: {'count': self.counts[name], 'seconds': self.seconds[name],
+                       'mean': self.seconds[name] / self.counts[name], 'max': self.max_seconds[name],
+                       'p50': self.percentile(name, 50), 'p95': self.percentile(name, 95),
+                       'histogram': self.histograms[name].tolist()}
+                for name in self.counts.keys()}
+
+    def format(self) -> str:
+        """
+        A table with the statistics of each phase, ordered by decreasing total time.
+        """
+        lines = ["{:<24s}{:>10s}{:>12s}{:>12s}{:>12s}{:>12s}".format('phase', 'count', 'total (s)', 'mean (ms)',
+                                                                    'p95 (ms)', 'max (ms)')]
+        for name in sorted(self.counts.keys(), key=lambda name: -self.seconds[name]):
+            lines.append("{:<24s}{:>10d}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}".format(
+                name, self.counts[name], self.seconds[name], 1e3 * self.seconds[name] / self.counts[name],
+                1e3 * self.percentile(name, 95), 1e3 * self.max_seconds[name]))
+        return "\n".join(lines)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class _Timer:
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings: PhaseTimings, name: str):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.timings.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+# The timings are collected per thread so that the tasks executed by the threads of a worker do not interfere.
+_STATE = threading.local()
+
+
+def phase(name: str):
+    """
+    A context manager that records the time spent in a phase of the calculation when timings are being collected in the
+    current thread (cf. collect_phases). Otherwise a shared context manager that does nothing is returned.
+    """
+    timings = getattr(_STATE, 'timings', None)
+    return _NULL_TIMER if timings is None else _Timer(timings, name)
+
+
+@contextmanager
+def collect_phases(enabled: bool = True):
+    """
+    A context manager that collects the timings of the phases executed in the current thread.
+
+    :param enabled: Collect timings. When False, None is returned and instrumentation stays disabled.
+    :return: The timings (cf. PhaseTimings) or None.
+    """
+    if not enabled:
+        yield None
+        return
+    previous = getattr(_STATE, 'timings', None)
+    _STATE.timings = PhaseTimings()
+    try:
+        yield _STATE.timings
+    finally:
+        _STATE.timings = previous
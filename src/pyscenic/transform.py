@@ -1,19 +1,20 @@
 # -*- coding: utf-8 -*-
 
-from .recovery import recovery, aucs as calc_aucs
+from .recovery import recovery, aucs as calc_aucs, auc2d, derive_rank_cutoff, derive_rcc_dtype
 import logging
-import traceback
 import pandas as pd
 import numpy as np
 from .utils import COLUMN_NAME_MOTIF_SIMILARITY_QVALUE, COLUMN_NAME_ORTHOLOGOUS_IDENTITY, \
     COLUMN_NAME_MOTIF_ID, COLUMN_NAME_TF, COLUMN_NAME_ANNOTATION, ACTIVATING_MODULE, REPRESSING_MODULE
 from itertools import repeat
-from .rnkdb import RankingDatabase
-from functools import reduce
-from typing import Type, Sequence, Optional
-from .genesig import Regulon
-from .recovery import leading_edge4row
-import math
+from .rnkdb import RankingDatabase, PrefetchDecorator, ColumnBlockDecorator
+from .rnkidx import AUCNullIndex, TopRankIndex
+from typing import Type, Sequence, Optional, Mapping, Iterable, Tuple, Union
+from .genesig import Regulon, GeneSignature, union_batches
+from .recovery import leading_edge2d
+from .annotations import MotifAnnotations, annotate_features
+from .timers import phase
+import attr
 from itertools import chain
 from functools import partial
 from cytoolz import first
@@ -39,13 +40,15 @@ DF_META_DATA = make_meta({('Enrichment', COLUMN_NAME_AUC): np.float64,
                          index=pd.MultiIndex.from_arrays([[],[]], names=(COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID)))
 
 
-__all__ = ["module2features", "module2df", "modules2df", "df2regulons", "module2regulon", "modules2regulons"]
+__all__ = ["module2features", "module2df", "modules2df", "df2regulons", "chunks2regulons", "module2regulon",
+           "modules2regulons", "order_by_inclusion"]
 
 
 LOGGER = logging.getLogger(__name__)
 
 
-def module2features_rcc4all_impl(db: Type[RankingDatabase], module: Regulon, motif_annotations: pd.DataFrame,
+def module2features_rcc4all_impl(db: Type[RankingDatabase], module: Regulon,
+                                 motif_annotations: Union[pd.DataFrame, MotifAnnotations],
                                  rank_threshold: int = 1500, auc_threshold: float = 0.05, nes_threshold=3.0,
                                  weighted_recovery=False,
                                  filter_for_annotation=True):
@@ -76,13 +79,13 @@ def module2features_rcc4all_impl(db: Type[RankingDatabase], module: Regulon, mot
     enriched_features = pd.DataFrame(index=pd.MultiIndex.from_tuples(list(zip(repeat(module.transcription_factor),
                                                                               features[enriched_features_idx])),
                                                                      names=[COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID]),
-                                     data={COLUMN_NAME_NES: ness[enriched_features_idx],
-                                           COLUMN_NAME_AUC: aucs[enriched_features_idx]})
+                                     data={COLUMN_NAME_AUC: aucs[enriched_features_idx],
+                                           COLUMN_NAME_NES: ness[enriched_features_idx]})
     if len(enriched_features) == 0:
         return pd.DataFrame(), None, None, genes, None
 
     # Find motif annotations for enriched features.
-    annotated_features = pd.merge(enriched_features, motif_annotations, how="left", left_index=True, right_index=True)
+    annotated_features = annotate_features(enriched_features, motif_annotations)
     annotated_features_idx = pd.notnull(annotated_features[COLUMN_NAME_ANNOTATION]) if filter_for_annotation else np.full((len(enriched_features),), True)
     if len(annotated_features[annotated_features_idx]) == 0:
         return pd.DataFrame(), None, None, genes, None
@@ -102,46 +105,100 @@ def module2features_rcc4all_impl(db: Type[RankingDatabase], module: Regulon, mot
     return annotated_features, rccs, rankings, genes, avg2stdrcc
 
 
-def module2features_auc1st_impl(db: Type[RankingDatabase], module: Regulon, motif_annotations: pd.DataFrame,
+def module2features_auc1st_impl(db: Type[RankingDatabase], module: Regulon,
+                                motif_annotations: Union[pd.DataFrame, MotifAnnotations],
                                 rank_threshold: int = 1500, auc_threshold: float = 0.05, nes_threshold=3.0,
                                 weighted_recovery=False,
-                                filter_for_annotation=True):
+                                filter_for_annotation=True,
+                                null_indices: Optional[Mapping[str, AUCNullIndex]] = None,
+                                exact_nes=False,
+                                rank_indices: Optional[Mapping[str, TopRankIndex]] = None):
     """
     Create a dataframe of enriched and annotated features a given ranking database and a co-expression module.
 
     :param db: The ranking database.
     :param module: The co-expression module.
+    :param motif_annotations: The motif annotations. Compiled annotations (cf. MotifAnnotations) are looked up via
+        a binary search instead of being joined with the enriched features.
     :param rank_threshold: The total number of ranked genes to take into account when creating a recovery curve.
     :param auc_threshold: The fraction of the ranked genome to take into account for the calculation of the
         Area Under the recovery Curve.
     :param nes_threshold: The Normalized Enrichment Score (NES) threshold to select enriched features.
     :param weighted_recovery: Use weighted recovery in the analysis.
+    :param null_indices: A mapping from database name to a precomputed AUC null index. When an index is available for
+        the database, the NES is approximated from the precomputed null distribution and AUCs are only calculated for
+        features that can reach the NES threshold. Because the standard deviation of the null distribution is an
+        estimate, the set of enriched features can differ from the one obtained via the exact NES.
+    :param exact_nes: Always calculate the AUCs of all features and derive the NES from these (exactness mode). When
+        an index is available the deviation of the approximation is logged for validation purposes.
+    :param rank_indices: A mapping from database name to a precomputed top rank index. When an index is available for
+        the database, the exact AUCs are calculated from the index and the rankings are only loaded from the database
+        when enriched features are found and the index is not deep enough for the recovery curves. The top rank index
+        takes precedence over the AUC null index.
     :return: A dataframe with enriched and annotated features.
     """
-
-    # Load rank of genes from database.
-    df = db.load(module)
-    features, genes, rankings = df.index.values, df.columns.values, df.values
-    weights = np.asarray([module[gene] for gene in genes]) if weighted_recovery else np.ones(len(genes))
-
-    # Calculate recovery curves, AUC and NES values.
-    # For fast unweighted implementation so weights to None.
-    aucs = calc_aucs(df, db.total_genes, weights, auc_threshold)
-    ness = (aucs - aucs.mean()) / aucs.std()
+    def get_weights(genes):
+        return np.asarray([module[gene] for gene in genes]) if weighted_recovery else np.ones(len(genes))
+
+    rank_cutoff = derive_rank_cutoff(auc_threshold, db.total_genes)
+    rank_index = rank_indices.get(db.name) if rank_indices else None
+    if rank_index is not None:
+        assert rank_index.name == db.name and rank_index.total_genes == db.total_genes, \
+            "The top rank index {} does not match the database {}.".format(rank_index.name, db.name)
+    if rank_index is not None and rank_index.depth < rank_cutoff:
+        LOGGER.warning("The top rank index for {} is not deep enough for the AUC threshold.".format(db.name))
+        rank_index = None
+    null_index = null_indices.get(db.name) if null_indices else None
+    if null_index is not None and null_index.rank_cutoff != rank_cutoff:
+        LOGGER.warning("The AUC null index for {} was created for a different AUC threshold.".format(db.name))
+        null_index = None
+
+    if rank_index is not None:
+        # Calculate AUC and NES values from the index without loading the rankings.
+        df = None
+        features, genes = rank_index.features, rank_index.genes_of(module)
+        weights = get_weights(genes)
+        with phase('auc'):
+            aucs = rank_index.aucs(genes, weights, auc_threshold)
+        with phase('nes'):
+            ness = (aucs - aucs.mean()) / aucs.std()
+    else:
+        # Load rank of genes from database.
+        with phase('load_rankings'):
+            df = db.load(module)
+        features, genes, rankings = df.index.values, df.columns.values, df.values
+        weights = get_weights(genes)
+
+        # Calculate recovery curves, AUC and NES values.
+        # For fast unweighted implementation so weights to None.
+        if null_index is None or exact_nes:
+            with phase('auc'):
+                aucs = calc_aucs(df, db.total_genes, weights, auc_threshold)
+            with phase('nes'):
+                ness = (aucs - aucs.mean()) / aucs.std()
+            if null_index is not None:
+                _, approx_ness = null_index.enrichment(df, weights, nes_threshold)
+                LOGGER.info("AUC null index for {} on {}: {} enriched features (exact) vs {} (approximation).".format(
+                    module.name, db.name, (ness >= nes_threshold).sum(), (approx_ness >= nes_threshold).sum()))
+        else:
+            with phase('auc'):
+                aucs, ness = null_index.enrichment(df, weights, nes_threshold)
 
     # Keep only features that are enriched, i.e. NES sufficiently high.
-    enriched_features_idx = ness >= nes_threshold
-    enriched_features = pd.DataFrame(index=pd.MultiIndex.from_tuples(list(zip(repeat(module.transcription_factor),
-                                                                              features[enriched_features_idx])),
-                                                                     names=[COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID]),
-                                     data={COLUMN_NAME_NES: ness[enriched_features_idx],
-                                           COLUMN_NAME_AUC: aucs[enriched_features_idx]})
+    with phase('nes'):
+        enriched_features_idx = ness >= nes_threshold
+        enriched_features = pd.DataFrame(index=pd.MultiIndex.from_tuples(list(zip(repeat(module.transcription_factor),
+                                                                                  features[enriched_features_idx])),
+                                                                         names=[COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID]),
+                                         data={COLUMN_NAME_AUC: aucs[enriched_features_idx],
+                                               COLUMN_NAME_NES: ness[enriched_features_idx]})
     if len(enriched_features) == 0:
         return pd.DataFrame(), None, None, genes, None
 
     # Find motif annotations for enriched features.
-    annotated_features = pd.merge(enriched_features, motif_annotations, how="left", left_index=True, right_index=True)
-    annotated_features_idx = pd.notnull(annotated_features[COLUMN_NAME_ANNOTATION]) if filter_for_annotation else np.full((len(enriched_features),), True)
+    with phase('annotation'):
+        annotated_features = annotate_features(enriched_features, motif_annotations)
+        annotated_features_idx = pd.notnull(annotated_features[COLUMN_NAME_ANNOTATION]) if filter_for_annotation else np.full((len(enriched_features),), True)
     if len(annotated_features[annotated_features_idx]) == 0:
         return pd.DataFrame(), None, None, genes, None
 
@@ -154,7 +211,146 @@ def module2features_auc1st_impl(db: Type[RankingDatabase], module: Regulon, moti
     # TODO: Solution could be to go for an iterative approach boosted by numba. But before doing so investigate the
     # broader issue with creep in memory usage when using the dask framework: use a memory profile tool
     # (https://pythonhosted.org/Pympler/muppy.html) to check what is kept in memory in all subprocesses/workers.
-    rccs, _ = recovery(df, db.total_genes, weights, rank_threshold, auc_threshold, no_auc=True)
+    if df is None:
+        # Ranks beyond the depth of the index do not influence the recovery curves up to the rank threshold.
+        with phase('load_rankings'):
+            df = rank_index.rankings(module) if rank_index.depth >= rank_threshold else db.load(module)
+        genes, rankings = df.columns.values, df.values
+        weights = get_weights(genes)
+    with phase('recovery_curves'):
+        rccs, _ = recovery(df, db.total_genes, weights, rank_threshold, auc_threshold, no_auc=True)
+        avgrcc = rccs.mean(axis=0)
+        avg2stdrcc = avgrcc + 2.0 * rccs.std(axis=0)
+
+    rccs = rccs[enriched_features_idx, :][annotated_features_idx, :]
+    rankings = rankings[enriched_features_idx, :][annotated_features_idx, :]
+
+    # Add additional information to the dataframe.
+    annotated_features = annotated_features[annotated_features_idx]
+    context = frozenset(chain(module.context, [db.name]))
+    annotated_features[COLUMN_NAME_CONTEXT] = len(annotated_features) * [context]
+
+    return annotated_features, rccs, rankings, genes, avg2stdrcc
+
+
+@attr.s
+class RecoveryCache:
+    """
+    The state that is carried over from one module to the next when enrichment is calculated incrementally for nested
+    modules of the same transcription factor.
+
+    The (unnormalized) AUC and the recovery curve of a feature are additive in the genes of a signature: the AUC of a
+    module that is a superset of a previously processed module equals the AUC of that smaller module plus the
+    contribution of the added genes. The same holds for the recovery curves.
+    """
+    db_name = attr.ib(default=None)  # str
+    features = attr.ib(default=None)  # np.ndarray with the features of the database.
+    genes = attr.ib(default=None)  # np.ndarray with the genes of the previous module that are ranked in the database.
+    weights = attr.ib(default=None)  # np.ndarray with the weights of these genes.
+    rankings = attr.ib(default=None)  # np.ndarray (n_features, n_genes)
+    raw_aucs = attr.ib(default=None)  # np.ndarray with the unnormalized AUCs (n_features).
+    rccs = attr.ib(default=None)  # np.ndarray (n_features, rank_threshold) or None if not calculated.
+
+    def is_subset_of(self, db: Type[RankingDatabase], module: Regulon, weighted_recovery: bool) -> bool:
+        """
+        Can the supplied module be derived from the cached state by only adding genes?
+        """
+        if self.genes is None or self.db_name != db.name:
+            return False
+        if not all(gene in module for gene in self.genes):
+            return False
+        # The contribution of a gene depends on its weight, therefore the weights of the shared genes must be equal.
+        return not weighted_recovery or np.array_equal(self.weights, [module[gene] for gene in self.genes])
+
+
+def module2features_incremental_impl(db: Type[RankingDatabase], module: Regulon,
+                                     motif_annotations: Union[pd.DataFrame, MotifAnnotations],
+                                     rank_threshold: int = 1500, auc_threshold: float = 0.05, nes_threshold=3.0,
+                                     weighted_recovery=False,
+                                     filter_for_annotation=True,
+                                     cache: Optional[RecoveryCache] = None):
+    """
+    Create a dataframe of enriched and annotated features a given ranking database and a co-expression module.
+
+    Same as module2features_auc1st_impl but reuses the rankings, AUCs and recovery curves of the previously processed
+    module (stored in the supplied cache) when the current module is a superset of that module. Only the rankings of the
+    added genes are loaded from the database.
+
+    :param db: The ranking database.
+    :param module: The co-expression module.
+    :param rank_threshold: The total number of ranked genes to take into account when creating a recovery curve.
+    :param auc_threshold: The fraction of the ranked genome to take into account for the calculation of the
+        Area Under the recovery Curve.
+    :param nes_threshold: The Normalized Enrichment Score (NES) threshold to select enriched features.
+    :param weighted_recovery: Use weighted recovery in the analysis.
+    :param cache: The state of the previously processed module. This object is updated in place.
+    :return: A dataframe with enriched and annotated features.
+    """
+    if cache is None:
+        cache = RecoveryCache()
+
+    def get_weights(genes):
+        return np.asarray([module[gene] for gene in genes]) if weighted_recovery else np.ones(len(genes))
+
+    # Load rank of genes from database: only the genes that were not part of the previous module are loaded.
+    rank_cutoff = derive_rank_cutoff(auc_threshold, db.total_genes)
+    incremental = cache.is_subset_of(db, module, weighted_recovery)
+    if incremental:
+        known_genes = set(cache.genes)
+        added_genes = [gene for gene in module.genes if gene not in known_genes]
+        df = db.load(GeneSignature(name=module.name, gene2weight=added_genes)) if added_genes else None
+    else:
+        df = db.load(module)
+    features = df.index.values if df is not None else cache.features
+    added_genes, added_rankings = (df.columns.values, df.values) if df is not None else (np.array([]), None)
+    added_weights = get_weights(added_genes)
+
+    # Calculate AUC and NES values: the unnormalized AUC of the previous module is complemented with the
+    # contribution of the added genes.
+    raw_aucs = auc2d(added_rankings, added_weights, rank_cutoff, 1.0) if len(added_genes) else np.zeros(len(features))
+    if incremental:
+        genes = np.concatenate([cache.genes, added_genes])
+        weights = np.concatenate([cache.weights, added_weights])
+        rankings = np.hstack([cache.rankings, added_rankings]) if len(added_genes) else cache.rankings
+        raw_aucs = cache.raw_aucs + raw_aucs
+    else:
+        genes, weights, rankings = added_genes, added_weights, added_rankings
+    maxauc = float((rank_cutoff+1) * weights.sum())
+    assert maxauc > 0
+    aucs = raw_aucs / maxauc
+    ness = (aucs - aucs.mean()) / aucs.std()
+
+    # Recovery curves of the previous module can only be reused when they were calculated for that module.
+    prev_rccs = cache.rccs if incremental and cache.rccs is not None and cache.rccs.shape[1] == rank_threshold else None
+    cache.db_name, cache.features, cache.genes, cache.weights, cache.rankings, cache.raw_aucs, cache.rccs = \
+        db.name, features, genes, weights, rankings, raw_aucs, None
+
+    # Keep only features that are enriched, i.e. NES sufficiently high.
+    enriched_features_idx = ness >= nes_threshold
+    enriched_features = pd.DataFrame(index=pd.MultiIndex.from_tuples(list(zip(repeat(module.transcription_factor),
+                                                                              features[enriched_features_idx])),
+                                                                     names=[COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID]),
+                                     data={COLUMN_NAME_AUC: aucs[enriched_features_idx],
+                                           COLUMN_NAME_NES: ness[enriched_features_idx]})
+    if len(enriched_features) == 0:
+        return pd.DataFrame(), None, None, genes, None
+
+    # Find motif annotations for enriched features.
+    annotated_features = annotate_features(enriched_features, motif_annotations)
+    annotated_features_idx = pd.notnull(annotated_features[COLUMN_NAME_ANNOTATION]) if filter_for_annotation else np.full((len(enriched_features),), True)
+    if len(annotated_features[annotated_features_idx]) == 0:
+        return pd.DataFrame(), None, None, genes, None
+
+    # Calculated leading edge for the remaining enriched features that have annotations. The recovery curves are
+    # additive in the genes, so only the curves for the added genes need to be calculated.
+    if prev_rccs is not None:
+        # The datatype of the curves is derived from all weights so that the sum does not overflow.
+        rccs = prev_rccs + recovery(df, db.total_genes, added_weights, rank_threshold, auc_threshold, no_auc=True,
+                                    dtype=derive_rcc_dtype(weights))[0] if len(added_genes) else prev_rccs
+    else:
+        rccs, _ = recovery(pd.DataFrame(index=features, columns=genes, data=rankings),
+                           db.total_genes, weights, rank_threshold, auc_threshold, no_auc=True)
+    cache.rccs = rccs
     avgrcc = rccs.mean(axis=0)
     avg2stdrcc = avgrcc + 2.0 * rccs.std(axis=0)
 
@@ -174,19 +370,19 @@ module2features = partial(module2features_auc1st_impl,
                           filter_for_annotation=True)
 
 
-def module2df(db: Type[RankingDatabase], module: Regulon, motif_annotations: pd.DataFrame,
+def module2df(db: Type[RankingDatabase], module: Regulon, motif_annotations: Union[pd.DataFrame, MotifAnnotations],
               weighted_recovery=False, return_recovery_curves=False, module2features_func=module2features) -> pd.DataFrame:
     """
 
     """
-    # Derive enriched and TF-annotated features for module.
+    # Derive enriched and TF-annotated features for module. Running out of memory is not silently ignored because the
+    # enriched features of the module would be missing from the results (cf. prune2df for planning a memory budget).
     try:
         df_annotated_features, rccs, rankings, genes, avg2stdrcc = module2features_func(db, module, motif_annotations,
                                                                                     weighted_recovery=weighted_recovery)
     except MemoryError:
-        LOGGER.error("Unable to process \"{}\" on database \"{}\" because ran out of memory. Stacktrace:".format(module.name, db.name))
-        LOGGER.error(traceback.format_exc())
-        return DF_META_DATA
+        LOGGER.error("Unable to process \"{}\" on database \"{}\" because ran out of memory.".format(module.name, db.name))
+        raise
     # If less than 80% of the genes are mapped to the ranking database, the module is skipped.
     n_missing = len(module) - len(genes)
     frac_missing = float(n_missing)/len(module)
@@ -199,116 +395,247 @@ def module2df(db: Type[RankingDatabase], module: Regulon, motif_annotations: pd.
         return DF_META_DATA
     rank_threshold = rccs.shape[1]
 
-    # Combine elements into a dataframe.
-    df_annotated_features.columns = pd.MultiIndex.from_tuples(list(zip(repeat("Enrichment"),
-                                                                       df_annotated_features.columns)))
-    df_rnks = pd.DataFrame(index=df_annotated_features.index,
-                           columns=pd.MultiIndex.from_tuples(list(zip(repeat("Ranking"), genes))),
-                           data=rankings)
-    df_rccs = pd.DataFrame(index=df_annotated_features.index,
-                           columns=pd.MultiIndex.from_tuples(list(zip(repeat("Recovery"), np.arange(rank_threshold)))),
-                           data=rccs)
-    df = pd.concat([df_annotated_features, df_rccs, df_rnks], axis=1)
-
-    # Calculate the leading edges for each row. Always return importance from gene inference phase.
+    # Calculate the leading edges for all features at once. Always return importance from gene inference phase.
     weights = np.array([module[gene] for gene in genes])
-    df[[("Enrichment", COLUMN_NAME_TARGET_GENES), ("Enrichment", COLUMN_NAME_RANK_AT_MAX)]] = df.apply(partial(leading_edge4row,
-                                                                                                               avg2stdrcc=avg2stdrcc, genes=genes, weights=weights), axis=1)
-
-    # Remove unnecessary data from dataframe.
-    del df['Ranking']
-    if not return_recovery_curves:
-        del df['Recovery']
+    with phase('leading_edge'):
+        rank_at_max, indptr, indices = leading_edge2d(rccs, avg2stdrcc, rankings)
+    with phase('assembly'):
+        df = df_annotated_features
+        df.columns = pd.MultiIndex.from_tuples(list(zip(repeat("Enrichment"), df.columns)))
+        df[("Enrichment", COLUMN_NAME_TARGET_GENES)] = [list(zip(genes[idx], weights[idx]))
+                                                       for idx in np.split(indices, indptr[1:-1])]
+        df[("Enrichment", COLUMN_NAME_RANK_AT_MAX)] = rank_at_max
+
+        if return_recovery_curves:
+            df_rccs = pd.DataFrame(index=df.index,
+                                   columns=pd.MultiIndex.from_tuples(list(zip(repeat("Recovery"), np.arange(rank_threshold)))),
+                                   data=rccs)
+            df = pd.concat([df, df_rccs], axis=1)
     return df
 
 
-def modules2df(db: Type[RankingDatabase], modules: Sequence[Regulon], motif_annotations: pd.DataFrame,
-               weighted_recovery=False, return_recovery_curves=False, module2features_func=module2features) -> pd.DataFrame:
-    # Make sure return recovery curves is always set to false because the metadata for the distributed dataframe needs
-    # to be fixed for the dask framework.
-    #TODO: Remove this restriction.
-    return pd.concat([module2df(db, module, motif_annotations, weighted_recovery, False, module2features_func)
-                      for module in modules])
+def order_by_inclusion(modules: Sequence[Regulon]) -> Sequence[Sequence[Regulon]]:
+    """
+    Group modules per transcription factor and type of regulation, ordered by increasing size. The modules for a
+    single TF are typically nested (e.g. top-N targets or percentile thresholds), so consecutive modules in a group are
+    often supersets of each other.
 
+    :param modules: The sequence of modules.
+    :return: A sequence of groups of modules.
+    """
+    def key(module):
+        return module.transcription_factor, REPRESSING_MODULE in module.context
+
+    groups = {}
+    for module in modules:
+        groups.setdefault(key(module), []).append(module)
+    return [sorted(group, key=len) for _, group in sorted(groups.items(), key=first)]
 
-def _regulon4group(tf_name, context, df_group) -> Optional[Regulon]:
-    def score(nes, motif_similarity_qval, orthologuous_identity):
-        # The combined score starts from the NES score which is then corrected for less confidence in the TF annotation
-        # in two steps:
-        # 1. The orthologous identifity (a fraction between 0 and 1.0) is used directly to normalize the NES.
-        # 2. The motif similarity q-value is converted to a similar fraction: -log10(q-value)
-        # A motif that is directly annotated for the TF in the correct species is not penalized.
 
-        correction_fraction = 1.0
+def modules2df(db: Type[RankingDatabase], modules: Sequence[Regulon],
+               motif_annotations: Union[pd.DataFrame, MotifAnnotations],
+               weighted_recovery=False, return_recovery_curves=False, module2features_func=module2features,
+               incremental=False, prefetch: int = 0, batch_genes: int = 0, **kwargs) -> pd.DataFrame:
+    """
+    Create a dataframe of enriched and annotated features for a sequence of modules.
+
+    :param incremental: Reuse the recovery of the previous module of the same TF when enrichment is calculated for a
+        superset of that module. The supplied module2features_func must accept a cache keyword argument
+        (cf. module2features_incremental_impl).
+    :param prefetch: The number of modules (or batches of modules) for which the rankings are loaded ahead in a
+        background thread while the enrichment of the current module is calculated (cf. PrefetchDecorator).
+    :param batch_genes: Load the rankings for batches of consecutive modules at once, i.e. the union of their genes
+        with at most this number of genes, and select the rankings of each module from this block
+        (cf. ColumnBlockDecorator). This replaces many small reads from the database by a few large ones.
+        Zero disables batching. Prefetching and batching are not used for the incremental calculation, which only
+        loads the added genes, nor for databases with a top rank index.
+    :param kwargs: Additional keyword arguments for module2features_func. This allows large data structures (e.g. the
+        database indices) to be shipped to the workers separately instead of being bound to the function.
+    """
+    if kwargs:
+        module2features_func = partial(module2features_func, **kwargs)
+    # Make sure return recovery curves is always set to false because the metadata for the distributed dataframe needs
+    # to be fixed for the dask framework.
+    #TODO: Remove this restriction.
+    if not incremental:
+        rank_indices = kwargs.get('rank_indices')
+        if rank_indices and db.name in rank_indices:
+            prefetch, batch_genes = 0, 0
+        batches = union_batches(modules, batch_genes) if batch_genes > 0 else [(None, modules)]
+        # Either the rankings of the individual modules or the blocks of rankings of the batches are prefetched.
+        prefetching_db = PrefetchDecorator(db, modules if batch_genes <= 0 else list(map(first, batches)), prefetch) \
+            if prefetch > 0 else None
         try:
-            max_value = 10  # A q-value smaller than 10**-10 is considered the same as a q-value of 0.0.
-            correction_fraction = min(-math.log(motif_similarity_qval, 10), max_value)/max_value if not math.isnan(motif_similarity_qval) else 1.0
-        except ValueError: # Math domain error
-            pass
-        score = nes * correction_fraction
+            dfs = []
+            for union, batch in batches:
+                batch_db = prefetching_db if prefetching_db is not None else db
+                if union is not None:
+                    batch_db = ColumnBlockDecorator(batch_db, union)
+                dfs.extend(module2df(batch_db, module, motif_annotations, weighted_recovery, False, module2features_func)
+                           for module in batch)
+        finally:
+            if prefetching_db is not None:
+                prefetching_db.close()
+        with phase('concat'):
+            return pd.concat(dfs)
+
+    def iter_module2features_funcs(group):
+        cache = RecoveryCache()
+        for module in group:
+            yield module, partial(module2features_func, cache=cache)
+
+    dfs = [module2df(db, module, motif_annotations, weighted_recovery, False, func)
+           for group in order_by_inclusion(modules)
+               for module, func in iter_module2features_funcs(group)]
+    with phase('concat'):
+        return pd.concat(dfs)
+
+
+def _score(df: pd.DataFrame) -> np.ndarray:
+    """
+    Calculate the combined score for each enriched feature.
 
-        # We assume that a non existing orthologous identity signifies a direct annotation.
-        return score if math.isnan(orthologuous_identity) else score * orthologuous_identity
+    The combined score starts from the NES score which is then corrected for less confidence in the TF annotation in
+    two steps:
+    1. The orthologous identifity (a fraction between 0 and 1.0) is used directly to normalize the NES.
+    2. The motif similarity q-value is converted to a similar fraction: -log10(q-value)
+    A motif that is directly annotated for the TF in the correct species is not penalized.
+    """
+    max_value = 10  # A q-value smaller than 10**-10 is considered the same as a q-value of 0.0.
+    qvals = df[COLUMN_NAME_MOTIF_SIMILARITY_QVALUE].values.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correction_fraction = np.minimum(-np.log10(qvals), max_value) / max_value
+        # Missing q-values and math domain errors (a q-value of zero or less) do not lead to a correction.
+        correction_fraction[~(qvals > 0.0)] = 1.0
+    score = df[COLUMN_NAME_NES].values * correction_fraction
 
-    def derive_interaction_type(ctx):
-        return "(-)" if REPRESSING_MODULE in ctx else "(+)"
+    # We assume that a non existing orthologous identity signifies a direct annotation.
+    identities = df[COLUMN_NAME_ORTHOLOGOUS_IDENTITY].values.astype(np.float64)
+    return np.where(np.isnan(identities), score, score * identities)
 
-    def row2regulon(row):
-        # The target genes as well as their weights/importances are directly taken from the dataframe.
-        return Regulon(name="{}{}".format(tf_name,derive_interaction_type(context)),
-                        score=score(row[COLUMN_NAME_NES],
-                                    row[COLUMN_NAME_MOTIF_SIMILARITY_QVALUE],
-                                    row[COLUMN_NAME_ORTHOLOGOUS_IDENTITY]),
-                        context=context,
-                        transcription_factor=tf_name,
-                        gene2weight=row[COLUMN_NAME_TARGET_GENES])
 
-    # Find most enriched directly annotated motif and add this to the context.
+def _explode_targets(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Explode the target genes of a dataframe of enriched features into a dataframe with a row for each target gene: the
+    position of the enriched feature ('Row'), the gene ('Gene') and its weight ('Weight').
+    """
+    targets = df[COLUMN_NAME_TARGET_GENES].values
+    n_targets = np.fromiter(map(len, targets), dtype=np.int64, count=len(targets))
+    df_targets = pd.DataFrame.from_records(list(chain.from_iterable(targets)), columns=['Gene', 'Weight'])
+    df_targets['Row'] = np.repeat(np.arange(len(df)), n_targets)
+    return df_targets
 
 
-    df_selected = df_group[((df_group[COLUMN_NAME_ANNOTATION] == 'gene is directly annotated')
-                            | (df_group[COLUMN_NAME_ANNOTATION].str.startswith('gene is orthologous to')
-                               & df_group[COLUMN_NAME_ANNOTATION].str.endswith('which is directly annotated for motif')))]
-    df_selected = df_selected.sort_values(by=COLUMN_NAME_NES, ascending=False)
-    motif_logo = '{}.png'.format(df_selected.head(1).reset_index()[COLUMN_NAME_MOTIF_ID].values[0]) if len(df_selected) > 0 else ""
+KEYS4REGULON = [COLUMN_NAME_TF, COLUMN_NAME_TYPE]
 
-    # First we create a regulon for each enriched and annotated feature and then we aggregate these regulons into a
-    # single one using the union operator. This operator combined all target genes into a single set of genes keeping
-    # the maximum weight associated with a gene. In addition, the maximum combined score is kept as the score of the
-    # entire regulon.
-    return reduce(Regulon.union, (row2regulon(row) for _, row in df_group.iterrows())).copy(context=frozenset(set(context).union({motif_logo})))
 
+def _aggregate4regulons(df: pd.DataFrame, targets: Optional[pd.DataFrame] = None) \
+        -> Tuple[pd.Series, pd.DataFrame, pd.Series]:
+    """
+    Aggregate a dataframe of enriched features per TF and type of regulation (activating or repressing).
 
-def df2regulons(df) -> Sequence[Regulon]:
+    :param df: The dataframe.
+    :param targets: The target genes of the enriched features as an exploded dataframe (cf. df2regulons).
+    :return: A tuple with the maximum combined score per regulon, the NES and ID of the most enriched directly annotated
+        motif per regulon and the maximum weight per target gene of a regulon.
+    """
+    # Normally the columns index has two levels. For convenience of the following code only the enrichment part is
+    # retained. Resetting the index also makes a defensive copy.
+    if df.columns.nlevels == 2:
+        df = df['Enrichment']
+    df = df.reset_index()
+
+    # Unpack the type of the module from the context column (dtype = frozenset). Activating is the default!
+    if targets is None:
+        df[COLUMN_NAME_TYPE] = [REPRESSING_MODULE if REPRESSING_MODULE in ctx else ACTIVATING_MODULE
+                                for ctx in df[COLUMN_NAME_CONTEXT].values]
+    df['Score'] = _score(df)
+    scores = df.groupby(by=KEYS4REGULON)['Score'].max()
+
+    # Find most enriched directly annotated motif for each regulon.
+    annotations = df[COLUMN_NAME_ANNOTATION].astype(str)
+    df_selected = df[(annotations == 'gene is directly annotated')
+                     | (annotations.str.startswith('gene is orthologous to')
+                        & annotations.str.endswith('which is directly annotated for motif'))]
+    motifs = _most_enriched(df_selected.set_index(KEYS4REGULON)[[COLUMN_NAME_NES, COLUMN_NAME_MOTIF_ID]])
+
+    # Explode the target genes once and keep the maximum weight for each gene of a regulon.
+    df_targets = _explode_targets(df) if targets is None else targets
+    rows = df_targets['Row'].values
+    df_targets = pd.DataFrame(data={COLUMN_NAME_TF: df[COLUMN_NAME_TF].values[rows],
+                                    COLUMN_NAME_TYPE: df[COLUMN_NAME_TYPE].values[rows],
+                                    'Gene': df_targets['Gene'].values,
+                                    'Weight': df_targets['Weight'].values})
+    weights = df_targets.groupby(by=KEYS4REGULON + ['Gene'])['Weight'].max()
+
+    return scores, motifs, weights
+
+
+def _most_enriched(motifs: pd.DataFrame) -> pd.DataFrame:
+    # A stable sort makes sure the first motif is retained in case of ties.
+    motifs = motifs.sort_values(by=COLUMN_NAME_NES, ascending=False, kind='mergesort')
+    return motifs[~motifs.index.duplicated(keep='first')]
+
+
+def _aggregates2regulons(scores: pd.Series, motifs: pd.DataFrame, weights: pd.Series) -> Sequence[Regulon]:
+    # A regulon for which none of the enriched features has target genes is not valid: creating it raises a ValueError
+    # (cf. GeneSignature).
+    key2targets = {key: grp for key, grp in weights.groupby(level=[0, 1])} if len(weights) else dict()
+    no_targets = pd.Series([], dtype=np.float64)
+
+    def regulons():
+        for tf_name, interaction_type in scores.index:
+            weights_grp = key2targets.get((tf_name, interaction_type), no_targets)
+            motif_logo = '{}.png'.format(motifs.loc[(tf_name, interaction_type), COLUMN_NAME_MOTIF_ID]) \
+                if (tf_name, interaction_type) in motifs.index else ""
+            yield Regulon(name="{}{}".format(tf_name, "(-)" if interaction_type == REPRESSING_MODULE else "(+)"),
+                          score=float(scores[(tf_name, interaction_type)]),
+                          context=frozenset([interaction_type, motif_logo]),
+                          transcription_factor=tf_name,
+                          gene2weight=dict(zip(weights_grp.index.get_level_values(-1).tolist(),
+                                               weights_grp.values.tolist())))
+    return list(regulons())
+
+
+def df2regulons(df, targets: Optional[pd.DataFrame] = None) -> Sequence[Regulon]:
     """
     Create regulons from a dataframe of enriched features.
 
+    All enriched features for a TF and type of regulation (activating or repressing) are aggregated into a single
+    regulon: the target genes are combined keeping the maximum weight associated with a gene and the maximum combined
+    score is kept as the score of the entire regulon. The most enriched directly annotated motif is added to the
+    context of the regulon.
+
     :param df: The dataframe.
+    :param targets: The target genes of the enriched features as an exploded dataframe (cf. _explode_targets). When
+        supplied, the target genes and context column of the dataframe are not used, the type of regulation must then
+        be available as a separate column (cf. pyscenic.arrow.table2regulons).
     :return: A sequence of regulons.
     """
+    if len(df) == 0:
+        return []
+    return _aggregates2regulons(*_aggregate4regulons(df, targets))
 
-    # Because the code below will alter the dataframe we need to make a defensive copy of it.
-    df = df.copy()
-
-    # Normally the columns index has two levels. For convenience of the following code the first level is removed.
-    if df.columns.nlevels == 2:
-        df.columns = df.columns.droplevel(0)
 
-    # Unpack the type of the module from the context column (dtype = frozenset)
-    def get_type(row):
-        ctx = row[COLUMN_NAME_CONTEXT]
-        # Activating is the default!
-        return REPRESSING_MODULE if REPRESSING_MODULE in ctx else ACTIVATING_MODULE
-    df[COLUMN_NAME_TYPE] = df.apply(get_type,axis=1)
+def chunks2regulons(chunks: Iterable[pd.DataFrame]) -> Sequence[Regulon]:
+    """
+    Create regulons from a stream of dataframes of enriched features (e.g. the row groups of a Parquet file written
+    by a streaming sink). Only the aggregates of each chunk are kept in memory, not the enriched features. These
+    aggregates are reduced once after all chunks have been consumed.
 
-    # Group all rows per TF and type (+)/(-). Each group results in a single regulon.
-    not_none = lambda r: r is not None
-    return list(filter(not_none, (_regulon4group(tf_name, frozenset([interaction_type]), df_grp)
-                                  for (tf_name, interaction_type), df_grp in df.groupby(by=[COLUMN_NAME_TF,
-                                                                                                  COLUMN_NAME_TYPE]))))
+    :param chunks: An iterable of dataframes.
+    :return: A sequence of regulons (the same as df2regulons for the concatenation of all chunks).
+    """
+    aggregates = [_aggregate4regulons(df) for df in chunks if len(df) > 0]
+    if not aggregates:
+        return []
+    scores, motifs, weights = zip(*aggregates)
+    return _aggregates2regulons(pd.concat(scores).groupby(level=[0, 1]).max(),
+                                _most_enriched(pd.concat(motifs)),
+                                pd.concat(weights).groupby(level=[0, 1, 2]).max())
 
 
-def module2regulon(db: Type[RankingDatabase], module: Regulon, motif_annotations: pd.DataFrame,
+def module2regulon(db: Type[RankingDatabase], module: Regulon, motif_annotations: Union[pd.DataFrame, MotifAnnotations],
                    weighted_recovery=False, return_recovery_curves=False,
                    module2features_func=module2features) -> Optional[Regulon]:
     # First calculating a dataframe and then derive the regulons from them introduces a performance penalty.
@@ -321,7 +648,8 @@ def module2regulon(db: Type[RankingDatabase], module: Regulon, motif_annotations
     return first(regulons) if len(regulons) > 0 else None
 
 
-def modules2regulons(db: Type[RankingDatabase], modules: Sequence[Regulon], motif_annotations: pd.DataFrame,
+def modules2regulons(db: Type[RankingDatabase], modules: Sequence[Regulon],
+                     motif_annotations: Union[pd.DataFrame, MotifAnnotations],
                      weighted_recovery=False, return_recovery_curves=False,
                      module2features_func=module2features) -> Sequence[Regulon]:
     assert len(modules) > 0
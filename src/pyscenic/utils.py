@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import os
+import hashlib
 import pandas as pd
+import pyarrow as pa
 from urllib.parse import urljoin
 from .genesig import Regulon, GeneSignature
 from .math import masked_rho4pairs
@@ -26,11 +29,47 @@ COLUMN_NAME_ORTHOLOGOUS_IDENTITY = 'OrthologousIdentity'
 COLUMN_NAME_ANNOTATION = 'Annotation'
 
 
+# The version of the layout of the binary cache of motif annotations.
+MOTIF_ANNOTATIONS_CACHE_VERSION = 1
+
+
+def _motif_annotations_cache_fname(fname: str, column_names, motif_similarity_fdr: float,
+                                   orthologous_identity_threshold: float) -> str:
+    # The cache is invalidated when the snapshot is modified or when other columns or thresholds are used.
+    stat = os.stat(fname)
+    key = repr((MOTIF_ANNOTATIONS_CACHE_VERSION, stat.st_size, stat.st_mtime_ns, tuple(column_names),
+                float(motif_similarity_fdr), float(orthologous_identity_threshold)))
+    return "{}.{}.arrow".format(fname, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+
+def _read_motif_annotations_cache(fname: str) -> pd.DataFrame:
+    # The numeric columns are read directly from the memory mapped file. The text columns are dictionary encoded, i.e.
+    # each distinct value is converted to a Python string only once.
+    with pa.memory_map(fname, 'r') as source:
+        df = pa.ipc.open_file(source).read_all().to_pandas()
+    for column in (COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID, COLUMN_NAME_ANNOTATION):
+        df[column] = df[column].astype(np.object)
+    return df.set_index([COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID])
+
+
+def _write_motif_annotations_cache(df: pd.DataFrame, fname: str) -> None:
+    table = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+    table = pa.Table.from_arrays([column.dictionary_encode() if pa.types.is_string(column.type) else column
+                                  for column in table.columns], names=table.column_names)
+    tmp_fname = "{}.tmp".format(fname)
+    with pa.OSFile(tmp_fname, 'wb') as sink:
+        writer = pa.RecordBatchFileWriter(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+    os.replace(tmp_fname, fname)
+
+
 def load_motif_annotations(fname: str,
                            column_names=('#motif_id', 'gene_name',
                                          'motif_similarity_qvalue', 'orthologous_identity', 'description'),
                            motif_similarity_fdr: float = 0.001,
-                           orthologous_identity_threshold: float = 0.0) -> pd.DataFrame:
+                           orthologous_identity_threshold: float = 0.0,
+                           cache: bool = False) -> pd.DataFrame:
     """
     Load motif annotations from a motif2TF snapshot.
 
@@ -39,17 +78,35 @@ def load_motif_annotations(fname: str,
     :param motif_similarity_fdr: The maximum False Discovery Rate to find factor annotations for enriched motifs.
     :param orthologuous_identity_threshold: The minimum orthologuous identity to find factor annotations
         for enriched motifs.
+    :param cache: Store the annotations in a binary (Arrow) file next to the snapshot and load them from that file
+        when available. The cache is specific for the modification time of the snapshot and for the thresholds.
     :return: A dataframe.
     """
+    cache_fname = _motif_annotations_cache_fname(fname, column_names, motif_similarity_fdr,
+                                                 orthologous_identity_threshold) if cache else None
+    if cache_fname and os.path.isfile(cache_fname):
+        return _read_motif_annotations_cache(cache_fname)
+
     # Create a MultiIndex for the index combining unique gene name and motif ID. This should facilitate
-    # later merging.
-    df = pd.read_csv(fname, sep='\t', index_col=[1,0], usecols=column_names)
+    # later merging. Explicit types avoid type inference and the descriptions, which have only a few distinct values,
+    # are parsed as categories to limit the memory needed during parsing.
+    motif_id, gene_name, qvalue, identity, description = column_names
+    df = pd.read_csv(fname, sep='\t', index_col=[1,0], usecols=column_names,
+                     dtype={motif_id: np.object, gene_name: np.object, qvalue: np.float64, identity: np.float64,
+                            description: 'category'})
     df.index.names = [COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID]
     df.rename(columns={'motif_similarity_qvalue': COLUMN_NAME_MOTIF_SIMILARITY_QVALUE,
                        'orthologous_identity': COLUMN_NAME_ORTHOLOGOUS_IDENTITY,
                        'description': COLUMN_NAME_ANNOTATION }, inplace=True)
     df = df[(df[COLUMN_NAME_MOTIF_SIMILARITY_QVALUE] <= motif_similarity_fdr) &
             (df[COLUMN_NAME_ORTHOLOGOUS_IDENTITY] >= orthologous_identity_threshold)]
+    df = df.astype({COLUMN_NAME_ANNOTATION: np.object})
+
+    if cache_fname:
+        try:
+            _write_motif_annotations_cache(df, cache_fname)
+        except OSError as e:
+            LOGGER.warning("Unable to cache motif annotations: {}".format(e))
     return df
 
 
@@ -198,6 +255,14 @@ ACTIVATING_MODULE = "activating"
 REPRESSING_MODULE = "repressing"
 
 
+def _unique_float_exp_matrix(ex_mtx: pd.DataFrame) -> pd.DataFrame:
+    # Duplicate genes need to be removed from the expression matrix to avoid lookup problems in the correlation
+    # matrix.
+    # In addition, also make sure the expression matrix consists of floating point numbers. This requirement might
+    # be violated when dealing with raw counts as input.
+    return ex_mtx.T[~ex_mtx.columns.duplicated(keep='first')].T.astype(float)
+
+
 def modules_from_adjacencies(adjacencies: pd.DataFrame,
                              ex_mtx: pd.DataFrame,
                         thresholds=(0.75, 0.90),
@@ -211,7 +276,10 @@ def modules_from_adjacencies(adjacencies: pd.DataFrame,
                         rho_mask_dropouts=True) -> Sequence[Regulon]:
     """
     Create modules from a dataframe containing weighted adjacencies between a TF and its target genes.
-    
+
+    The correlations are not calculated again when the adjacencies already have a regulation column (i.e. the result
+    of add_correlation). The rho_threshold and rho_mask_dropouts parameters are ignored in that case.
+
     :param adjacencies: The dataframe with the TF-target links. This dataframe should have the following columns:
         :py:const:`pyscenic.utils.COLUMN_NAME_TF`, :py:const:`pyscenic.utils.COLUMN_NAME_TARGET` and :py:const:`pyscenic.utils.COLUMN_NAME_WEIGHT` .
     :param ex_mtx: The expression matrix (n_cells x n_genes).
@@ -230,11 +298,7 @@ def modules_from_adjacencies(adjacencies: pd.DataFrame,
     :return: A sequence of regulons.
     """
 
-    # Duplicate genes need to be removed from the expression matrix to avoid lookup problems in the correlation
-    # matrix.
-    # In addition, also make sure the expression matrix consists of floating point numbers. This requirement might
-    # be violated when dealing with raw counts as input.
-    ex_mtx = ex_mtx.T[~ex_mtx.columns.duplicated(keep='first')].T.astype(float)
+    ex_mtx = _unique_float_exp_matrix(ex_mtx)
 
     # To make the pySCENIC code more robust to the selection of the network inference method in the first step of
     # the pipeline, it is better to use percentiles instead of absolute values for the weight thresholds.
@@ -258,10 +322,12 @@ def modules_from_adjacencies(adjacencies: pd.DataFrame,
         # Relationship between TF and its target, i.e. activator or repressor, is derived using the original expression
         # profiles. The Pearson product-moment correlation coefficient is used to derive this information.
 
-        # Add correlation column and create two disjoint set of adjacencies.
-        LOGGER.info("Calculating Pearson correlations.")
-        adjacencies = add_correlation(adjacencies, ex_mtx,
-                                  rho_threshold=rho_threshold, mask_dropouts=rho_mask_dropouts)
+        # Add correlation column and create two disjoint set of adjacencies. Adjacencies to which the correlation was
+        # already added (cf. add_correlation) are used as is.
+        if COLUMN_NAME_REGULATION not in adjacencies.columns:
+            LOGGER.info("Calculating Pearson correlations.")
+            adjacencies = add_correlation(adjacencies, ex_mtx,
+                                          rho_threshold=rho_threshold, mask_dropouts=rho_mask_dropouts)
         activating_modules = adjacencies[adjacencies[COLUMN_NAME_REGULATION] > 0.0]
         if keep_only_activating:
             modules_iter = iter_modules(activating_modules, frozenset([ACTIVATING_MODULE]))
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import numpy as np
+import pandas as pd
+from pyscenic.rnkdb import DataFrameRankingDatabase
+
+
+N_FEATURES = 200
+N_GENES = 2000
+
+
+@pytest.fixture
+def genes():
+    return np.array(["G{}".format(idx) for idx in range(N_GENES)])
+
+
+@pytest.fixture
+def features():
+    return np.array(["M{}".format(idx) for idx in range(N_FEATURES)])
+
+
+@pytest.fixture
+def db(genes, features):
+    # Random whole genome rankings in which the first 100 genes are ranked at the top for the first 10 features.
+    rs = np.random.RandomState(seed=42)
+    rankings = np.array([rs.permutation(N_GENES) for _ in range(N_FEATURES)], dtype=np.int16)
+    for idx in range(10):
+        rankings[idx, :] = np.concatenate([rs.permutation(100), 100 + rs.permutation(N_GENES - 100)])
+    return DataFrameRankingDatabase(pd.DataFrame(data=rankings, index=features, columns=genes), name="synthetic")
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+import pytest
+import numpy as np
+import pandas as pd
+from pyscenic.utils import load_motif_annotations, COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID, \
+    COLUMN_NAME_MOTIF_SIMILARITY_QVALUE, COLUMN_NAME_ORTHOLOGOUS_IDENTITY, COLUMN_NAME_ANNOTATION
+from pyscenic.annotations import MotifAnnotations, annotate_features, load_filtered_motif_annotations
+
+
+def _annotations():
+    index = pd.MultiIndex.from_tuples([("TF1", "M1"), ("TF1", "M3"), ("TF2", "M1"), ("TF1", "M1"), ("TF3", "M2")],
+                                      names=[COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID])
+    return pd.DataFrame(index=index, data={COLUMN_NAME_MOTIF_SIMILARITY_QVALUE: [0.0, 0.001, 0.0, 0.0005, 0.0],
+                                           COLUMN_NAME_ORTHOLOGOUS_IDENTITY: [1.0, 1.0, 0.5, 1.0, 0.8],
+                                           COLUMN_NAME_ANNOTATION: ["direct", "similar", "direct", "orthologous",
+                                                                    "direct"]})
+
+
+def _enriched_features(tf, motif_ids):
+    index = pd.MultiIndex.from_tuples([(tf, motif_id) for motif_id in motif_ids],
+                                      names=[COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID])
+    return pd.DataFrame(index=index, data={'AUC': np.linspace(0.1, 0.2, len(motif_ids)),
+                                           'NES': np.linspace(3.0, 5.0, len(motif_ids))})
+
+
+def test_annotate_features():
+    df = _annotations()
+    compiled = MotifAnnotations.from_dataframe(df)
+    assert len(compiled) == len(df)
+    # Strings are stored only once.
+    assert len(compiled.categories[2]) == 3
+    for tf, motif_ids in (("TF1", ["M3", "M1", "M2"]), ("TF3", ["M1"]), ("TF4", ["M1", "M2"]), ("TF1", [])):
+        enriched_features = _enriched_features(tf, motif_ids)
+        expected = annotate_features(enriched_features, df)
+        actual = annotate_features(enriched_features, pickle.loads(pickle.dumps(compiled)))
+        # Contrary to a join of dataframes, the order of the enriched features is retained.
+        assert list(actual.index.get_level_values(1).unique()) == motif_ids
+        pd.testing.assert_frame_equal(actual.sort_index(kind='mergesort'), expected.sort_index(kind='mergesort'),
+                                      check_dtype=False)
+
+
+@pytest.fixture
+def annotations_fname(tmpdir):
+    fname = os.path.join(str(tmpdir), "motifs.tsv")
+    df = _annotations().reset_index().rename(columns={COLUMN_NAME_TF: 'gene_name', COLUMN_NAME_MOTIF_ID: '#motif_id',
+                                                      COLUMN_NAME_MOTIF_SIMILARITY_QVALUE: 'motif_similarity_qvalue',
+                                                      COLUMN_NAME_ORTHOLOGOUS_IDENTITY: 'orthologous_identity',
+                                                      COLUMN_NAME_ANNOTATION: 'description'})
+    df[['#motif_id', 'gene_name', 'motif_similarity_qvalue', 'orthologous_identity', 'description']].to_csv(
+        fname, sep='\t', index=False)
+    return fname
+
+
+def test_load_motif_annotations_cache(tmpdir, annotations_fname):
+    expected = load_motif_annotations(annotations_fname)
+    assert len(expected) == 5
+    assert load_motif_annotations(annotations_fname, cache=True).equals(expected)
+    assert len([fname for fname in os.listdir(str(tmpdir)) if fname.endswith(".arrow")]) == 1
+    # The second load is served from the cache.
+    pd.testing.assert_frame_equal(load_motif_annotations(annotations_fname, cache=True), expected)
+    # Other thresholds use a separate cache.
+    assert len(load_motif_annotations(annotations_fname, motif_similarity_fdr=0.0, cache=True)) == 3
+    assert len([fname for fname in os.listdir(str(tmpdir)) if fname.endswith(".arrow")]) == 2
+
+
+def test_load_filtered_motif_annotations(annotations_fname):
+    fname = annotations_fname
+    assert len(load_filtered_motif_annotations(fname)) == 5
+    assert len(load_filtered_motif_annotations(fname, tfs={"TF1", "TF3"})) == 4
+    motif_annotations = load_filtered_motif_annotations(fname, tfs={"TF1", "TF3"}, features={"M1", "M4"})
+    assert len(motif_annotations) == 2
+    assert list(motif_annotations.tfs) == ["TF1"]
+    # Subsequent loads are served from the cache.
+    assert load_filtered_motif_annotations(fname, tfs=["TF3", "TF1"], features=["M4", "M1"]) is motif_annotations
+    assert load_filtered_motif_annotations(fname, tfs={"TF1", "TF3"}, features={"M1", "M4"},
+                                           motif_similarity_fdr=0.0) is not motif_annotations
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pyarrow as pa
+from pyscenic.transform import DF_META_DATA, df2regulons
+from pyscenic.arrow import enriched_motifs2table, table2enriched_motifs, table2regulons
+from test_cli_utils import enriched_motifs
+
+
+def test_schema_independent_of_content():
+    df = enriched_motifs()
+    missing = df.copy()
+    # Only missing values in a chunk, the dtype of the columns is retained.
+    for column in missing.columns[2:5]:
+        missing[column] = missing[column].where(np.zeros(len(missing), dtype=bool))
+    assert enriched_motifs2table(df).schema.equals(enriched_motifs2table(missing).schema)
+    assert enriched_motifs2table(df).schema.equals(enriched_motifs2table(DF_META_DATA).schema)
+
+
+def test_table2regulons():
+    df = enriched_motifs()
+    table = enriched_motifs2table(df)
+    # Multiple chunks per column.
+    table = pa.Table.from_batches(table.to_batches(max_chunksize=2))
+    expected = df2regulons(df)
+    actual = table2regulons(table)
+    assert [r.name for r in expected] == [r.name for r in actual]
+    assert [r.gene2weight for r in expected] == [r.gene2weight for r in actual]
+    assert [r.context for r in expected] == [r.context for r in actual]
+    assert [r.score for r in expected] == [r.score for r in actual]
+    assert len(table2enriched_motifs(table)) == len(df)
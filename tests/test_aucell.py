@@ -2,10 +2,11 @@
 
 import pytest
 
+import numpy as np
 import pandas as pd
 
 from pyscenic.genesig import GeneSignature
-from pyscenic.aucell import derive_auc_threshold, aucell, create_rankings
+from pyscenic.aucell import derive_auc_threshold, aucell, aucell4r, create_rankings
 from pkg_resources import resource_filename
 
 
@@ -33,6 +34,14 @@ def test_create_rankings(exp_matrix):
     assert (df_rnk + 1).sum(axis=1).unique()[0] == (n_genes * (n_genes+1))/2.0
 
 
+def test_create_rankings_dtype():
+    genes = ["G{}".format(idx) for idx in range(2**15)]
+    exp_matrix = pd.DataFrame(data=np.random.RandomState(seed=3).uniform(size=(2, len(genes))), columns=genes)
+    df_rnk = create_rankings(exp_matrix)
+    assert (df_rnk.dtypes == np.int16).all()
+    assert df_rnk.values.max() == len(genes) - 1
+
+
 def test_aucell_w1(exp_matrix, gs):
     percentiles = derive_auc_threshold(exp_matrix)
     aucs_mtx = aucell(exp_matrix, gs, auc_threshold=percentiles[0.01], num_workers=1)
@@ -50,4 +59,15 @@ def test_aucell_mismatch(exp_matrix, gs):
     print(aucs_mtx.head())
 
 
-
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_aucell_batch_genes(num_workers):
+    rs = np.random.RandomState(seed=3)
+    genes = ["G{}".format(idx) for idx in range(500)]
+    exp_matrix = pd.DataFrame(data=rs.poisson(lam=2.0, size=(20, len(genes))), columns=genes,
+                              index=["C{}".format(idx) for idx in range(20)])
+    df_rnk = create_rankings(exp_matrix)
+    gss = [GeneSignature(name="S{}".format(idx), gene2weight=list(rs.choice(genes, size=50, replace=False)))
+           for idx in range(6)]
+    aucs1 = aucell4r(df_rnk, gss, auc_threshold=0.1, num_workers=num_workers)
+    aucs2 = aucell4r(df_rnk, gss, auc_threshold=0.1, num_workers=num_workers, batch_genes=120)
+    assert np.allclose(aucs1.values, aucs2.values)
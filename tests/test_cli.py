@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import subprocess
+
+
+def imported_modules(code):
+    """ The modules imported by running code in a fresh interpreter. """
+    code += "\nimport sys\nprint(' '.join(sys.modules.keys()))"
+    return set(subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                              universal_newlines=True).stdout.split())
+
+
+def test_import_pyscenic():
+    # The version is only derived on request.
+    assert 'pyscenic._version' not in imported_modules("import pyscenic")
+    assert 'pyscenic._version' in imported_modules("import pyscenic\npyscenic.__version__")
+
+
+def test_argument_parser_imports():
+    # Parsing the arguments of a command (or showing its help) does not import the dependencies of the commands.
+    modules = imported_modules("from pyscenic.cli.pyscenic import create_argument_parser\n"
+                               "create_argument_parser().parse_args(['aucell', {0!r}, {0!r}])".format(__file__))
+    for name in ('arboreto', 'dask', 'distributed', 'loompy', 'sklearn', 'numba', 'pyarrow', 'psutil'):
+        assert name not in modules
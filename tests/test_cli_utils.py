@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import pandas as pd
+from pyscenic.utils import COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID, COLUMN_NAME_MOTIF_SIMILARITY_QVALUE, \
+    COLUMN_NAME_ORTHOLOGOUS_IDENTITY, COLUMN_NAME_ANNOTATION
+from pyscenic.transform import COLUMN_NAME_NES, COLUMN_NAME_AUC, COLUMN_NAME_CONTEXT, COLUMN_NAME_TARGET_GENES, \
+    COLUMN_NAME_RANK_AT_MAX, df2regulons
+from pyscenic.cli.utils import save_enriched_motifs, load_enriched_motifs, load_signatures
+
+
+def enriched_motifs():
+    index = pd.MultiIndex.from_tuples([("TF1", "M1"), ("TF1", "M2"), ("TF2", "M1")],
+                                      names=[COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID])
+    df = pd.DataFrame(index=index, data={
+        COLUMN_NAME_AUC: [0.1, 0.2, 0.3],
+        COLUMN_NAME_NES: [3.5, 4.0, 5.5],
+        COLUMN_NAME_MOTIF_SIMILARITY_QVALUE: [0.0, 0.0001, np.nan],
+        COLUMN_NAME_ORTHOLOGOUS_IDENTITY: [1.0, np.nan, 0.8],
+        COLUMN_NAME_ANNOTATION: ["gene is directly annotated", np.nan, "gene is orthologous"],
+        COLUMN_NAME_CONTEXT: [frozenset(["activating", "db1"]), frozenset(["repressing", "db1"]), frozenset(["db2"])],
+        COLUMN_NAME_TARGET_GENES: [[("G1", 1.0), ("G2", 0.5)], [("G3", 0.25)], [("G1", 0.75)]],
+        COLUMN_NAME_RANK_AT_MAX: [10, 20, 30]})
+    df.columns = pd.MultiIndex.from_tuples([("Enrichment", c) for c in df.columns])
+    return df
+
+
+def test_save_load_parquet(tmpdir):
+    fname = os.path.join(str(tmpdir), "motifs.parquet")
+    df = enriched_motifs()
+    save_enriched_motifs(df, fname)
+    other = load_enriched_motifs(fname)
+    pd.testing.assert_frame_equal(df, other[df.columns])
+    assert [r.gene2weight for r in df2regulons(df)] == [r.gene2weight for r in load_signatures(fname)]
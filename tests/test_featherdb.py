@@ -35,3 +35,6 @@ def test_load(db, gs):
     rankings = db.load(gs)
     assert len(rankings.index) == 5
     assert len(rankings.columns) == 29
+
+def test_features(db):
+    assert db.features == tuple(db.load_full().index)
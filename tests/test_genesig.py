@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from pyscenic.genesig import GeneSignature, Regulon
+from pyscenic.genesig import GeneSignature, Regulon, union_batches
 from configparser import ConfigParser
 import os
 import pytest
@@ -172,3 +172,10 @@ def test_head():
     assert gs2['SOX4'] == 0.75
     assert len(gs2) == 2
 
+
+def test_union_batches():
+    gss = [GeneSignature(name="gs{}".format(idx), gene2weight=genes)
+           for idx, genes in enumerate([['A', 'B'], ['B', 'C'], ['D', 'E', 'F', 'G'], ['H']])]
+    batches = union_batches(gss, max_genes=3)
+    assert [[gs.name for gs in batch] for _, batch in batches] == [['gs0', 'gs1'], ['gs2'], ['gs3']]
+    assert [union.genes for union, _ in batches] == [('A', 'B', 'C'), ('D', 'E', 'F', 'G'), ('H',)]
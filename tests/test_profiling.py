@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import pytest
+import numpy as np
+import pandas as pd
+from pyscenic.genesig import GeneSignature
+from pyscenic.profiling import Profiler
+
+
+def test_stage():
+    profiler = Profiler(interval=0.01)
+    with profiler.stage('allocate'):
+        data = np.ones(shape=(1000, 1000))
+    with pytest.raises(ValueError):
+        with profiler.stage('failure'):
+            raise ValueError()
+    assert [stage['stage'] for stage in profiler.stages] == ['allocate', 'failure']
+    assert [stage['completed'] for stage in profiler.stages] == [True, False]
+    stage = profiler.stages[0]
+    assert stage['wall_time'] > 0.0
+    assert stage['cpu_time'] >= 0.0
+    assert stage['peak_rss'] >= data.nbytes
+
+
+def test_report(tmpdir):
+    profiler = Profiler()
+    profiler.observe_database("db1", 0.5)
+    signatures = [GeneSignature(name="gs{}".format(idx), gene2weight=["G{}".format(i) for i in range(n)])
+                  for idx, n in enumerate((10, 20, 30))]
+    profiler.observe("db1", signatures[:2], 1.0, pd.DataFrame(index=range(5)))
+    profiler.observe("db1", signatures[2:], 2.0, pd.DataFrame(index=range(3)))
+    profiler.observe("db2", signatures, 4.0)
+    report = profiler.report()
+    assert report['databases']['db1'] == {'open_time': 0.5, 'n_chunks': 2, 'n_modules': 3, 'seconds': 3.0, 'n_rows': 8}
+    assert report['databases']['db2'] == {'n_chunks': 1, 'n_modules': 3, 'seconds': 4.0}
+    assert report['chunks'][0] == {'database': "db1", 'n_modules': 2, 'n_genes': 30, 'seconds': 1.0, 'n_rows': 5}
+
+    fname = os.path.join(str(tmpdir), "profile.json")
+    with profiler.stage('stage'):
+        pass
+    profiler.save(fname)
+    with open(fname, 'r') as f:
+        assert json.load(f) == json.loads(json.dumps(profiler.report()))
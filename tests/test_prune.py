@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import tempfile
+import pytest
+import numpy as np
+import pandas as pd
+from functools import partial
+from dask.distributed import Client, LocalCluster
+from pyscenic.genesig import Regulon
+from pyscenic import prune
+from pyscenic.prune import prune2df
+from pyscenic.rnkdb import MemoryDecorator, DataFrameRankingDatabase
+from pyscenic.checkpoint import MANIFEST_FNAME
+from pyscenic.schedule import CostModel, WORKER_OVERHEAD, module_memory
+from pyscenic.profiling import Profiler
+from pyscenic.timers import PhaseTimings
+from pyscenic.utils import load_motif_annotations
+from pyscenic.transform import modules2df, module2features_auc1st_impl, df2regulons, chunks2regulons, COLUMN_NAME_CONTEXT
+
+
+TF_NAME = "TF1"
+
+
+@pytest.fixture
+def motif_annotations_fname(tmpdir, features):
+    fname = os.path.join(str(tmpdir), "motifs.tsv")
+    pd.DataFrame(data={'#motif_id': features, 'gene_name': TF_NAME, 'motif_similarity_qvalue': 0.0,
+                       'orthologous_identity': 1.0, 'description': 'gene is directly annotated'}).to_csv(fname, sep='\t',
+                                                                                                       index=False)
+    return fname
+
+
+@pytest.fixture
+def modules(genes):
+    rs = np.random.RandomState(seed=7)
+    weights = rs.uniform(size=len(genes))
+    return [Regulon(name="Regulon for {}".format(TF_NAME), context=frozenset(["top{}".format(n)]),
+                    transcription_factor=TF_NAME, gene2weight=list(zip(genes[:n], weights[:n])))
+            for n in (50, 60, 70, 80, 100, 150)]
+
+
+def _key(df):
+    return sorted(zip(map(sorted, df[('Enrichment', COLUMN_NAME_CONTEXT)]), df.index.get_level_values(1)))
+
+
+def _prune(db, modules, motif_annotations_fname, client_or_address, **kwargs):
+    return prune2df([db], modules, motif_annotations_fname, rank_threshold=500, client_or_address=client_or_address,
+                    num_workers=2, module_chunksize=2, **kwargs)
+
+
+@pytest.fixture
+def expected(db, modules, motif_annotations_fname):
+    return modules2df(db, modules, load_motif_annotations(motif_annotations_fname),
+                      module2features_func=partial(module2features_auc1st_impl, rank_threshold=500))
+
+
+@pytest.mark.parametrize("client_or_address", ['dask_multiprocessing', 'threaded'])
+def test_prune2df(db, modules, motif_annotations_fname, expected, client_or_address):
+    assert _key(_prune(db, modules, motif_annotations_fname, client_or_address)) == _key(expected)
+
+
+@pytest.mark.parametrize("client_or_address", ['custom_multiprocessing', 'dask_multiprocessing', 'threaded'])
+def test_prune2df_sink(db, modules, motif_annotations_fname, expected, client_or_address):
+    chunks = []
+    assert _prune(db, modules, motif_annotations_fname, client_or_address, sink=chunks.append) is None
+    assert len(expected) > 0
+    assert len(chunks) == (2 if client_or_address == 'custom_multiprocessing' else 3)
+    df = pd.concat(chunks)
+    assert _key(df) == _key(expected)
+    assert [(r.name, r.gene2weight, r.score) for r in chunks2regulons(chunks)] == \
+           [(r.name, r.gene2weight, r.score) for r in df2regulons(expected)]
+
+
+def test_prune2df_sink_distributed(db, modules, motif_annotations_fname, expected):
+    client = Client(LocalCluster(processes=False, n_workers=1, threads_per_worker=2))
+    try:
+        chunks = []
+        assert _prune(db, modules, motif_annotations_fname, client, sink=chunks.append) is None
+        # Chunking of modules is overruled for dask.distributed.
+        assert len(chunks) == len(modules)
+        assert _key(pd.concat(chunks)) == _key(expected)
+    finally:
+        client.close()
+
+
+def test_prune2df_checkpoint(tmpdir, db, modules, motif_annotations_fname, expected):
+    checkpoint_dir = os.path.join(str(tmpdir), "checkpoint")
+    df = _prune(db, modules[:4], motif_annotations_fname, 'dask_multiprocessing', checkpoint_dir=checkpoint_dir)
+    assert len(df) > 0
+    with open(os.path.join(checkpoint_dir, MANIFEST_FNAME), 'r') as f:
+        assert len(json.load(f)['tasks']) == 2
+    # Resuming only calculates the remaining chunk of modules.
+    chunks = []
+    assert _prune(db, modules, motif_annotations_fname, 'dask_multiprocessing', sink=chunks.append,
+                  checkpoint_dir=checkpoint_dir, resume=True) is None
+    assert len(chunks) == 3
+    assert _key(pd.concat(chunks)) == _key(expected)
+    assert len(os.listdir(checkpoint_dir)) == 4
+    # Other parameters cannot be resumed.
+    with pytest.raises(ValueError):
+        prune2df([db], modules, motif_annotations_fname, rank_threshold=400, checkpoint_dir=checkpoint_dir,
+                 resume=True)
+
+
+@pytest.mark.parametrize("client_or_address", ['custom_multiprocessing', 'dask_multiprocessing'])
+def test_prune2df_cost_model(db, modules, motif_annotations_fname, expected, client_or_address):
+    cost_model = CostModel()
+    chunks = []
+    assert _prune(db, modules, motif_annotations_fname, client_or_address, sink=chunks.append,
+                  cost_model=cost_model) is None
+    assert _key(pd.concat(chunks)) == _key(expected)
+    assert cost_model.units[db.name] == CostModel.cost_units(modules)
+    assert cost_model.seconds[db.name] > 0.0
+
+
+def test_prune2df_task_observer(db, modules, motif_annotations_fname, expected):
+    profiler = Profiler()
+    df = _prune(db, modules, motif_annotations_fname, 'dask_multiprocessing', task_observer=profiler.observe)
+    assert _key(df) == _key(expected)
+    assert sum(chunk['n_modules'] for chunk in profiler.chunks) == len(modules)
+    assert sum(chunk['n_rows'] for chunk in profiler.chunks) == len(df)
+    assert profiler.report()['databases'][db.name]['n_chunks'] == 3
+
+
+@pytest.mark.parametrize("client_or_address", ['custom_multiprocessing', 'dask_multiprocessing', 'threaded'])
+def test_prune2df_phase_timings(db, modules, motif_annotations_fname, expected, client_or_address):
+    phase_timings = PhaseTimings()
+    df = _prune(db, modules, motif_annotations_fname, client_or_address, phase_timings=phase_timings)
+    assert _key(df) == _key(expected)
+    assert phase_timings.counts['load_rankings'] == len(modules)
+    assert phase_timings.counts['auc'] == len(modules)
+    assert {'nes', 'annotation', 'recovery_curves', 'leading_edge', 'assembly', 'concat'} <= set(phase_timings.counts)
+
+
+@pytest.mark.parametrize("client_or_address", ['custom_multiprocessing', 'threaded'])
+def test_prune2df_memory_budget(db, modules, motif_annotations_fname, expected, client_or_address):
+    # A budget for a single worker without the database in memory.
+    memory_budget = WORKER_OVERHEAD + module_memory(200, max(map(len, modules)), 2, 500)
+    assert _key(_prune(db, modules, motif_annotations_fname, client_or_address,
+                       memory_budget=memory_budget)) == _key(expected)
+    with pytest.raises(ValueError):
+        _prune(db, modules, motif_annotations_fname, client_or_address, memory_budget=memory_budget - 1)
+
+
+def test_prune2df_db_affinity(db, modules, motif_annotations_fname, expected):
+    client = Client(LocalCluster(processes=False, n_workers=2, threads_per_worker=1))
+    try:
+        chunks = []
+        assert _prune(db, modules, motif_annotations_fname, client, sink=chunks.append, db_affinity=True,
+                      db_replication={db.name: 2}) is None
+        assert _key(pd.concat(chunks)) == _key(expected)
+        # The workers run in this process and keep the database in memory.
+        assert isinstance(prune._RESIDENT_DBS.pop(db.name), MemoryDecorator)
+    finally:
+        client.close()
+
+
+def test_prune2df_custom_multiprocessing(tmpdir, monkeypatch, db, modules, motif_annotations_fname, expected):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+    assert _key(_prune(db, modules, motif_annotations_fname, 'custom_multiprocessing')) == _key(expected)
+    # The outputs of the workers are removed.
+    assert not [fname for fname in os.listdir(str(tmpdir)) if fname.startswith("pyscenic-")]
+
+
+class FailingDatabase(DataFrameRankingDatabase):
+    def load_full(self) -> pd.DataFrame:
+        raise ValueError("Unable to load database.")
+
+
+def test_prune2df_custom_multiprocessing_failure(tmpdir, monkeypatch, db, modules, motif_annotations_fname):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+    failing_db = FailingDatabase(db.load_full(), name=db.name)
+    with pytest.raises(RuntimeError, match="Unable to load database"):
+        _prune(failing_db, modules, motif_annotations_fname, 'custom_multiprocessing')
+    assert not [fname for fname in os.listdir(str(tmpdir)) if fname.startswith("pyscenic-")]
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-from pyscenic.recovery import enrichment4features as enrichment, auc1d, weighted_auc1d, rcc2d
+from pyscenic.recovery import enrichment4features as enrichment, auc1d, weighted_auc1d, rcc2d, leading_edge, \
+    leading_edge2d, derive_rcc_dtype
 
 import pytest
 import numpy as np
@@ -91,3 +92,42 @@ def test_weighted_rcc2d_batch():
         weights = np.ones(n_genes)
         auc_max = 1.0 # Disable normalization.
         assert rcc2d(rankings, np.insert(weights, len(weights), 0.0), total_genes)[:, :auc_rank_threshold].sum(axis=1) == weighted_auc1d(ranking, weights, auc_rank_threshold, auc_max)
+
+
+def test_leading_edge2d():
+    # The vectorised implementation should give the same leading edges as the row by row implementation.
+    total_genes, n_genes, n_features, rank_threshold = 1000, 50, 20, 200
+    rankings = np.array([np.random.permutation(total_genes)[:n_genes] for _ in range(n_features)])
+    genes = np.array(["G{}".format(idx) for idx in range(n_genes)])
+    weights = np.random.uniform(size=n_genes)
+    rccs = rcc2d(np.append(rankings, np.full(shape=(n_features, 1), fill_value=total_genes), axis=1),
+                 np.insert(weights, n_genes, 0.0), rank_threshold)
+    avg2stdrcc = rccs.mean(axis=0) + 2.0 * rccs.std(axis=0)
+    rank_at_max, indptr, indices = leading_edge2d(rccs, avg2stdrcc, rankings)
+    for row_idx in range(n_features):
+        targets, expected_rank_at_max = leading_edge(rccs[row_idx, :], avg2stdrcc, rankings[row_idx, :], genes, weights)
+        idx = indices[indptr[row_idx]:indptr[row_idx + 1]]
+        assert rank_at_max[row_idx] == expected_rank_at_max
+        assert list(zip(genes[idx], weights[idx])) == targets
+
+
+def test_derive_rcc_dtype():
+    assert derive_rcc_dtype(np.ones(100)) == np.uint16
+    assert derive_rcc_dtype(np.full(100, 1000.0)) == np.uint32
+    assert derive_rcc_dtype(np.random.uniform(size=100)) == np.float64
+    assert derive_rcc_dtype(np.random.uniform(size=100), float32=True) == np.float32
+    assert derive_rcc_dtype(-np.ones(100)) == np.float64
+
+
+def test_rcc2d_dtype():
+    # The recovery curves in the smallest datatype should be identical to the ones in double precision.
+    total_genes, n_genes, n_features, rank_threshold = 1000, 50, 20, 200
+    rankings = np.array([np.random.permutation(total_genes)[:n_genes] for _ in range(n_features)], dtype=np.int16)
+    weights = np.ones(n_genes)
+    rccs = rcc2d(rankings, weights, rank_threshold)
+    assert rccs.dtype == np.uint16
+    assert np.array_equal(rccs, rcc2d(rankings, weights, rank_threshold, dtype=np.float64))
+    weights = np.random.uniform(size=n_genes)
+    rccs = rcc2d(rankings, weights, rank_threshold, dtype=np.float32)
+    assert rccs.dtype == np.float32
+    assert np.allclose(rccs, rcc2d(rankings, weights, rank_threshold), rtol=1e-5)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+import numpy as np
+from pyscenic.rnkidx import AUCNullIndex, TopRankIndex
+from pyscenic.genesig import GeneSignature
+from pyscenic.recovery import aucs, derive_rank_cutoff, auc2d
+
+
+@pytest.fixture
+def index(db):
+    return AUCNullIndex.create(db, auc_threshold=0.05, n_samples=5, block_size=300)
+
+
+def test_null_distribution_mean(db, index):
+    gs = GeneSignature(name="test", gene2weight=["G{}".format(idx) for idx in range(0, 2000, 13)])
+    df = db.load(gs)
+    weights = np.random.uniform(size=len(df.columns))
+    raw_aucs = auc2d(df.values, weights, derive_rank_cutoff(0.05, db.total_genes), 1.0)
+    mean, std = index.null_distribution(df.columns.values, weights)
+    assert mean == pytest.approx(raw_aucs.mean())
+    assert std > 0
+
+
+def test_save_load(tmpdir, index):
+    fname = os.path.join(str(tmpdir), "synthetic.aucnull.npz")
+    index.save(fname)
+    other = AUCNullIndex.load(fname)
+    assert other.name == index.name
+    assert other.rank_cutoff == index.rank_cutoff
+    assert np.array_equal(other.genes, index.genes)
+    assert np.allclose(other.means, index.means)
+    assert np.allclose(other.ratios, index.ratios)
+
+
+def test_enrichment(db, index):
+    gs = GeneSignature(name="test", gene2weight=["G{}".format(idx) for idx in range(100)])
+    df = db.load(gs)
+    weights = np.ones(len(df.columns))
+    approx_aucs, approx_ness = index.enrichment(df, weights, 3.0)
+    exact_aucs = aucs(df, db.total_genes, weights, 0.05)
+    exact_ness = (exact_aucs - exact_aucs.mean()) / exact_aucs.std()
+    assert np.array_equal(approx_ness >= 3.0, exact_ness >= 3.0)
+    candidates = ~np.isnan(approx_aucs)
+    assert np.allclose(approx_aucs[candidates], exact_aucs[candidates])
+
+
+@pytest.fixture
+def rank_index(db):
+    return TopRankIndex.create(db, depth=500, block_size=300)
+
+
+def test_top_rank_aucs(db, rank_index):
+    gs = GeneSignature(name="test", gene2weight=["G{}".format(idx) for idx in range(0, 2000, 7)])
+    df = db.load(gs)
+    weights = np.random.uniform(size=len(df.columns))
+    expected = aucs(df, db.total_genes, weights, 0.05)
+    assert np.allclose(rank_index.aucs(df.columns.values, weights, 0.05), expected)
+
+
+def test_top_rank_load(db, rank_index):
+    gs = GeneSignature(name="test", gene2weight=["G{}".format(idx) for idx in range(0, 2000, 7)] + ["UNKNOWN"])
+    df = db.load(gs)
+    other = rank_index.rankings(gs)
+    assert list(other.index) == list(df.index)
+    assert np.array_equal(np.minimum(df[other.columns].values, 500), other.values)
+
+
+def test_top_rank_save_load(tmpdir, rank_index):
+    fname = os.path.join(str(tmpdir), "synthetic.toprank.npz")
+    rank_index.save(fname)
+    other = TopRankIndex.load(fname)
+    assert other.depth == rank_index.depth
+    assert np.array_equal(other.features, rank_index.features)
+    assert np.array_equal(other.indptr, rank_index.indptr)
+    assert np.array_equal(other.ranks, rank_index.ranks)
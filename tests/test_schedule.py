@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+from pyscenic.genesig import GeneSignature
+from pyscenic.schedule import CostModel, lpt_partition, load_imbalance, balanced_chunks, assign_databases, \
+    FIXED_COST_IN_GENES, WORKER_OVERHEAD, database_shape, module_memory, plan_execution
+
+
+@pytest.fixture
+def signatures(genes):
+    return [GeneSignature(name="sig{}".format(n), gene2weight=genes[:n]) for n in (10, 200, 20, 400, 30, 50, 300, 40)]
+
+
+def test_lpt_partition():
+    costs = [7, 5, 4, 4, 3, 3]
+    partition = lpt_partition(costs, 3)
+    assert sorted(idx for b in partition for idx in b) == list(range(len(costs)))
+    # LPT is not optimal (i.e. 9, 9 and 8) but guaranteed to be within 4/3 of the optimal maximum load.
+    assert sorted(sum(costs[idx] for idx in b) for b in partition) == [8, 8, 10]
+    # Empty bins are dropped.
+    assert len(lpt_partition([1.0, 2.0], 4)) == 2
+
+
+def test_load_imbalance():
+    assert load_imbalance([2.0, 2.0]) == 1.0
+    assert load_imbalance([3.0, 1.0]) == 1.5
+    assert load_imbalance([]) == 1.0
+
+
+def test_cost_model(tmpdir, db, signatures):
+    model = CostModel()
+    assert model.factor(db.name) == 1.0
+    assert model.cost(db, signatures[:1]) == FIXED_COST_IN_GENES + 10
+    model.observe(db.name, signatures[:1], 2.0 * (FIXED_COST_IN_GENES + 10))
+    assert model.factor(db.name) == pytest.approx(2.0)
+    # Unobserved databases get the average factor of the observed ones.
+    assert model.factor("other") == pytest.approx(2.0)
+
+    fname = os.path.join(str(tmpdir), "cost_model.json")
+    model.save(fname)
+    assert CostModel.load(fname).factor(db.name) == pytest.approx(2.0)
+
+
+def test_balanced_chunks(db, signatures):
+    chunks, before, after = balanced_chunks(db, signatures, 4, CostModel())
+    assert sorted(s.name for c in chunks for s in c) == sorted(s.name for s in signatures)
+    assert len(chunks) == 4
+    assert after < before
+    # The balance is limited by the most expensive signature.
+    costs = [FIXED_COST_IN_GENES + len(s) for s in signatures]
+    assert after == pytest.approx(max(costs) / (sum(costs) / 4.0))
+    # The most expensive chunk comes first.
+    assert len(chunks[0]) == 1 and chunks[0][0].name == "sig400"
+
+
+def test_assign_databases():
+    workers = ["w{}".format(idx) for idx in range(5)]
+    db2workers = assign_databases(["db1", "db2"], workers, {"db2": 3})
+    # The idle fifth worker becomes an extra replica of the most replicated database.
+    assert len(db2workers["db2"]) == 4
+    assert sorted(db2workers["db1"] + db2workers["db2"]) == workers
+    # Each worker is assigned to a single database when there are enough workers.
+    assert not set(db2workers["db1"]) & set(db2workers["db2"])
+    # Databases share workers when there are more databases than workers.
+    db2workers = assign_databases(["db1", "db2", "db3"], workers[:2])
+    assert all(len(w) == 1 for w in db2workers.values())
+    assert sorted(w for ws in db2workers.values() for w in ws) == ["w0", "w0", "w1"]
+
+
+def test_database_shape(db):
+    assert database_shape(db) == (200, 2000, 2)
+
+
+def test_plan_execution(db, signatures):
+    worker_memory = WORKER_OVERHEAD + module_memory(200, 400, 2, 500)
+    db_memory = 200 * 2000 * 2
+
+    def plan(budget, mode='custom_multiprocessing'):
+        return plan_execution([db], signatures, 500, budget, mode, num_workers=4, module_chunksize=100)
+
+    p = plan(4 * (worker_memory + db_memory))
+    assert (p.num_workers, p.in_memory, p.module_chunksize) == (4, True, 2)
+    assert p.memory == 4 * (worker_memory + db_memory)
+    # Streaming the rankings allows for more workers than keeping a copy of the database for each worker.
+    p = plan(3 * worker_memory + db_memory)
+    assert (p.num_workers, p.in_memory, p.module_chunksize) == (3, False, 3)
+    # For the same number of workers the databases are kept in memory.
+    p = plan(2 * (worker_memory + db_memory))
+    assert (p.num_workers, p.in_memory) == (2, True)
+    # The threads of a single process share the database.
+    p = plan(4 * worker_memory + db_memory, 'threaded')
+    assert (p.num_workers, p.in_memory) == (4, True)
+    p = plan(4 * (worker_memory + db_memory), 'dask_multiprocessing')
+    assert (p.num_workers, p.in_memory) == (4, False)
+    with pytest.raises(ValueError):
+        plan(worker_memory - 1)
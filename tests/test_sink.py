@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from pyscenic.utils import load_motifs, COLUMN_NAME_ANNOTATION
+from pyscenic.transform import chunks2regulons, df2regulons
+from pyscenic.sink import CSVSink, ParquetSink, open_sink, iter_enriched_motifs
+from test_cli_utils import enriched_motifs
+
+
+def test_csv_sink(tmpdir):
+    fname = os.path.join(str(tmpdir), "motifs.csv")
+    df = enriched_motifs()
+    with CSVSink(fname) as sink:
+        sink(df.iloc[:2])
+        sink(df.iloc[:0])
+        # The columns of later chunks are aligned with the header.
+        sink(df.iloc[2:][list(reversed(df.columns))])
+    assert sink.n_rows == len(df)
+    assert [r.gene2weight for r in df2regulons(load_motifs(fname))] == [r.gene2weight for r in df2regulons(df)]
+
+
+def test_parquet_sink(tmpdir):
+    fname = os.path.join(str(tmpdir), "motifs.parquet")
+    df = enriched_motifs()
+    with ParquetSink(fname) as sink:
+        sink(df.iloc[:2])
+        # A chunk that only has missing annotations must have the same schema.
+        chunk = df.iloc[2:].copy()
+        chunk[('Enrichment', COLUMN_NAME_ANNOTATION)] = np.nan
+        chunk[('Enrichment', COLUMN_NAME_ANNOTATION)] = chunk[('Enrichment', COLUMN_NAME_ANNOTATION)].astype(object)
+        sink(chunk)
+    assert pq.ParquetFile(fname).num_row_groups == 2
+    chunks = list(iter_enriched_motifs(fname))
+    assert sum(map(len, chunks)) == len(df)
+    pd.testing.assert_frame_equal(df.iloc[:2], chunks[0][df.columns])
+
+
+def test_empty_sink(tmpdir):
+    for extension in ('csv', 'tsv', 'parquet'):
+        fname = os.path.join(str(tmpdir), "motifs.{}".format(extension))
+        with open_sink(fname):
+            pass
+        assert os.path.isfile(fname)
+    assert len(list(iter_enriched_motifs(fname))[0]) == 0
+
+
+def test_sink_discard_on_failure(tmpdir):
+    for extension in ('csv', 'parquet'):
+        fname = os.path.join(str(tmpdir), "motifs.{}".format(extension))
+        with pytest.raises(RuntimeError):
+            with open_sink(fname) as sink:
+                sink(enriched_motifs())
+                raise RuntimeError()
+        assert not os.path.exists(fname)
+
+
+def test_chunks2regulons():
+    df = enriched_motifs()
+    expected = df2regulons(df)
+    actual = chunks2regulons(df.iloc[idx:idx+1] for idx in range(len(df)))
+    assert [(r.name, r.gene2weight, r.score, r.context) for r in expected] == \
+           [(r.name, r.gene2weight, r.score, r.context) for r in actual]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+import pytest
+from pyscenic.timers import PhaseTimings, phase, collect_phases, BIN_EDGES
+
+
+def test_phase_disabled():
+    # Without collecting timings the same context manager is returned for every phase.
+    assert phase('auc') is phase('nes')
+    with collect_phases(False) as timings:
+        assert timings is None
+        with phase('auc'):
+            pass
+
+
+def test_collect_phases():
+    with collect_phases() as timings:
+        with phase('auc'):
+            pass
+        with collect_phases() as inner:
+            with phase('nes'):
+                pass
+        with pytest.raises(ValueError):
+            with phase('auc'):
+                raise ValueError()
+    with phase('auc'):
+        pass
+    assert timings.counts == {'auc': 2}
+    assert inner.counts == {'nes': 1}
+
+
+def test_phase_timings():
+    timings = PhaseTimings()
+    for seconds in (0.001, 0.002, 0.004, 2.0):
+        timings.add('load_rankings', seconds)
+    other = PhaseTimings()
+    other.add('load_rankings', 5000.0)
+    other.add('auc', 0.01)
+    timings = pickle.loads(pickle.dumps(timings)).merge(other).merge(None)
+    assert timings.counts == {'load_rankings': 5, 'auc': 1}
+    assert timings.seconds['load_rankings'] == pytest.approx(5002.007)
+    assert timings.max_seconds['load_rankings'] == 5000.0
+    assert timings.histograms['load_rankings'].sum() == 5
+    assert timings.histograms['load_rankings'][-1] == 1
+    assert timings.percentile('load_rankings', 50) == pytest.approx(BIN_EDGES[BIN_EDGES >= 0.004][0])
+    assert timings.percentile('load_rankings', 100) == 5000.0
+    report = timings.report()
+    assert report['auc']['count'] == 1 and len(report['auc']['histogram']) == len(BIN_EDGES) + 1
+    assert timings.format().splitlines()[1].startswith('load_rankings')
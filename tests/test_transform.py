@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import numpy as np
+import pandas as pd
+from functools import partial
+from pyscenic.rnkidx import AUCNullIndex, TopRankIndex
+from pyscenic.rnkdb import PrefetchDecorator
+from pyscenic.genesig import Regulon
+from pyscenic.utils import COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID, COLUMN_NAME_MOTIF_SIMILARITY_QVALUE, \
+    COLUMN_NAME_ORTHOLOGOUS_IDENTITY, COLUMN_NAME_ANNOTATION
+from pyscenic.transform import module2features_auc1st_impl, module2features_incremental_impl, modules2df, \
+    module2df, order_by_inclusion, df2regulons, COLUMN_NAME_NES, COLUMN_NAME_AUC, COLUMN_NAME_TARGET_GENES, \
+    COLUMN_NAME_CONTEXT
+
+
+TF_NAME = "TF1"
+
+
+@pytest.fixture
+def motif_annotations(features):
+    return pd.DataFrame(index=pd.MultiIndex.from_tuples([(TF_NAME, feature) for feature in features],
+                                                        names=[COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID]),
+                        data={COLUMN_NAME_MOTIF_SIMILARITY_QVALUE: 0.0,
+                              COLUMN_NAME_ORTHOLOGOUS_IDENTITY: 1.0,
+                              COLUMN_NAME_ANNOTATION: 'gene is directly annotated'})
+
+
+@pytest.fixture
+def modules(genes):
+    # Nested modules for a single TF.
+    rs = np.random.RandomState(seed=7)
+    weights = rs.uniform(size=len(genes))
+    return [Regulon(name="Regulon for {}".format(TF_NAME), context=frozenset(["top{}".format(n)]),
+                    transcription_factor=TF_NAME, gene2weight=list(zip(genes[:n], weights[:n])))
+            for n in (150, 50, 100)]
+
+
+def _sort_by_context(df):
+    df = df.copy()
+    df[('Enrichment', 'Key')] = [str(sorted(ctx)) + motif_id for ctx, motif_id in
+                                 zip(df[('Enrichment', COLUMN_NAME_CONTEXT)], df.index.get_level_values(1))]
+    return df.sort_values(by=[('Enrichment', 'Key')])
+
+
+def test_order_by_inclusion(modules):
+    groups = order_by_inclusion(modules)
+    assert len(groups) == 1
+    assert list(map(len, groups[0])) == [50, 100, 150]
+
+
+@pytest.mark.parametrize("weighted_recovery", [False, True])
+def test_modules2df_incremental(db, motif_annotations, modules, weighted_recovery):
+    kwargs = dict(rank_threshold=500, auc_threshold=0.05, nes_threshold=3.0, filter_for_annotation=True)
+    df1 = modules2df(db, modules, motif_annotations, weighted_recovery=weighted_recovery,
+                     module2features_func=partial(module2features_auc1st_impl, **kwargs))
+    df2 = modules2df(db, modules, motif_annotations, weighted_recovery=weighted_recovery,
+                     module2features_func=partial(module2features_incremental_impl, **kwargs), incremental=True)
+    assert len(df1) > 0
+    assert len(df1) == len(df2)
+
+    df1, df2 = _sort_by_context(df1), _sort_by_context(df2)
+    assert np.allclose(df1[('Enrichment', COLUMN_NAME_AUC)].values, df2[('Enrichment', COLUMN_NAME_AUC)].values)
+    assert np.allclose(df1[('Enrichment', COLUMN_NAME_NES)].values, df2[('Enrichment', COLUMN_NAME_NES)].values)
+    assert all(set(t1) == set(t2) for t1, t2 in zip(df1[('Enrichment', COLUMN_NAME_TARGET_GENES)],
+                                                    df2[('Enrichment', COLUMN_NAME_TARGET_GENES)]))
+
+
+def test_module2df_top_rank_index(db, motif_annotations, modules):
+    rank_index = TopRankIndex.create(db, depth=600)
+    kwargs = dict(rank_threshold=500, auc_threshold=0.05, nes_threshold=3.0, filter_for_annotation=True)
+    df1 = modules2df(db, modules, motif_annotations,
+                     module2features_func=partial(module2features_auc1st_impl, **kwargs))
+    df2 = modules2df(db, modules, motif_annotations,
+                     module2features_func=partial(module2features_auc1st_impl, rank_indices={db.name: rank_index},
+                                                  **kwargs))
+    assert len(df1) > 0
+    assert len(df1) == len(df2)
+    df1, df2 = _sort_by_context(df1), _sort_by_context(df2)
+    assert np.allclose(df1[('Enrichment', COLUMN_NAME_NES)].values, df2[('Enrichment', COLUMN_NAME_NES)].values)
+    assert all(set(t1) == set(t2) for t1, t2 in zip(df1[('Enrichment', COLUMN_NAME_TARGET_GENES)],
+                                                    df2[('Enrichment', COLUMN_NAME_TARGET_GENES)]))
+
+
+def test_module2df_top_rank_index_mismatch(db, motif_annotations, modules):
+    rank_index = TopRankIndex.create(db, depth=600)
+    rank_index.name = "other"
+    with pytest.raises(AssertionError):
+        module2features_auc1st_impl(db, modules[0], motif_annotations, rank_threshold=500,
+                                    rank_indices={db.name: rank_index})
+
+
+def test_module2df_memory_error(db, motif_annotations, modules):
+    def out_of_memory(*args, **kwargs):
+        raise MemoryError()
+    # The module is not silently skipped.
+    with pytest.raises(MemoryError):
+        module2df(db, modules[0], motif_annotations, module2features_func=out_of_memory)
+
+
+def test_modules2df_null_index(db, motif_annotations, modules):
+    null_index = AUCNullIndex.create(db, auc_threshold=0.05, n_samples=5)
+    kwargs = dict(rank_threshold=500, auc_threshold=0.05, nes_threshold=3.0, filter_for_annotation=True)
+    df1 = modules2df(db, modules, motif_annotations,
+                     module2features_func=partial(module2features_auc1st_impl, **kwargs))
+    # The index is supplied as separate keyword argument, i.e. not bound to the function.
+    df2 = modules2df(db, modules, motif_annotations, null_indices={db.name: null_index},
+                     module2features_func=partial(module2features_auc1st_impl, exact_nes=True, **kwargs))
+    df3 = modules2df(db, modules, motif_annotations, null_indices={db.name: null_index},
+                     module2features_func=partial(module2features_auc1st_impl, **kwargs))
+    assert len(df1) > 0
+    assert len(df1) == len(df2)
+    df1, df2 = _sort_by_context(df1), _sort_by_context(df2)
+    assert np.allclose(df1[('Enrichment', COLUMN_NAME_NES)].values, df2[('Enrichment', COLUMN_NAME_NES)].values)
+    # The approximation only retains features for which the AUC is calculated exactly.
+    df3 = _sort_by_context(df3)
+    assert len(df3) > 0
+    key2auc = dict(zip(df1[('Enrichment', 'Key')], df1[('Enrichment', COLUMN_NAME_AUC)]))
+    assert np.allclose(df3[('Enrichment', COLUMN_NAME_AUC)].values,
+                       [key2auc[key] for key in df3[('Enrichment', 'Key')]])
+
+
+def test_prefetch_decorator(db, modules):
+    with PrefetchDecorator(db, modules, depth=1) as prefetching_db:
+        # The rankings of the second module are not requested and a module that was not supplied is loaded directly.
+        assert prefetching_db.load(modules[0]).equals(db.load(modules[0]))
+        assert prefetching_db.load(modules[2]).equals(db.load(modules[2]))
+        assert prefetching_db.load(modules[1]).equals(db.load(modules[1]))
+    assert prefetching_db.n_hits == 2
+    assert prefetching_db.n_misses == 1
+
+
+@pytest.mark.parametrize("prefetch,batch_genes", [(2, 0), (0, 120), (1, 120)])
+def test_modules2df_prefetch_and_batch(db, motif_annotations, modules, prefetch, batch_genes):
+    kwargs = dict(rank_threshold=500, auc_threshold=0.05, nes_threshold=3.0, filter_for_annotation=True)
+    df1 = modules2df(db, modules, motif_annotations,
+                     module2features_func=partial(module2features_auc1st_impl, **kwargs))
+    df2 = modules2df(db, modules, motif_annotations, prefetch=prefetch, batch_genes=batch_genes,
+                     module2features_func=partial(module2features_auc1st_impl, **kwargs))
+    assert len(df1) > 0
+    assert df1.index.equals(df2.index)
+    assert np.allclose(df1[('Enrichment', COLUMN_NAME_NES)].values, df2[('Enrichment', COLUMN_NAME_NES)].values)
+    assert all(t1 == t2 for t1, t2 in zip(df1[('Enrichment', COLUMN_NAME_TARGET_GENES)],
+                                          df2[('Enrichment', COLUMN_NAME_TARGET_GENES)]))
+
+
+def test_df2regulons():
+    index = pd.MultiIndex.from_tuples([(TF_NAME, "M1"), (TF_NAME, "M2"), (TF_NAME, "M3")],
+                                      names=[COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID])
+    df = pd.DataFrame(index=index, data={
+        COLUMN_NAME_NES: [3.0, 5.0, 4.0],
+        COLUMN_NAME_MOTIF_SIMILARITY_QVALUE: [np.nan, 1e-5, 0.0],
+        COLUMN_NAME_ORTHOLOGOUS_IDENTITY: [np.nan, np.nan, 0.5],
+        COLUMN_NAME_ANNOTATION: ["gene is directly annotated", "motif is similar", "gene is directly annotated"],
+        COLUMN_NAME_CONTEXT: [frozenset(["top50"]), frozenset(["top50"]), frozenset(["top50", "repressing"])],
+        COLUMN_NAME_TARGET_GENES: [[("G1", 1.0), ("G2", 0.5)], [("G2", 0.75), ("G3", 0.25)], [("G4", 1.0)]]})
+    df.columns = pd.MultiIndex.from_tuples([("Enrichment", c) for c in df.columns])
+    activating, repressing = df2regulons(df)
+    assert activating.name == "{}(+)".format(TF_NAME)
+    assert dict(activating.gene2weight) == {"G1": 1.0, "G2": 0.75, "G3": 0.25}
+    assert activating.score == pytest.approx(3.0)
+    assert activating.context == frozenset(["activating", "M1.png"])
+    assert repressing.name == "{}(-)".format(TF_NAME)
+    assert dict(repressing.gene2weight) == {"G4": 1.0}
+    assert repressing.score == pytest.approx(2.0)
+    assert repressing.context == frozenset(["repressing", "M3.png"])
+
+
+def test_df2regulons_no_targets():
+    index = pd.MultiIndex.from_tuples([(TF_NAME, "M1")], names=[COLUMN_NAME_TF, COLUMN_NAME_MOTIF_ID])
+    df = pd.DataFrame(index=index, data={
+        COLUMN_NAME_NES: [3.0],
+        COLUMN_NAME_MOTIF_SIMILARITY_QVALUE: [0.0],
+        COLUMN_NAME_ORTHOLOGOUS_IDENTITY: [1.0],
+        COLUMN_NAME_ANNOTATION: ["gene is directly annotated"],
+        COLUMN_NAME_CONTEXT: [frozenset(["top50"])],
+        COLUMN_NAME_TARGET_GENES: [[]]})
+    df.columns = pd.MultiIndex.from_tuples([("Enrichment", c) for c in df.columns])
+    with pytest.raises(ValueError):
+        df2regulons(df)